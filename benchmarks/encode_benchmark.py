@@ -0,0 +1,135 @@
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmarks.synthetic_dataset import add_dataset_arguments, create_ers_tree
+from src.image_encoder import WEBP_LOSSLESS_PARAMS
+from src.image_writer import MASK_THRESHOLD
+
+# Encoders of frames and masks as (name, PIL format, parameters, mode of encoded image). None mode keeps the decoded one.
+FRAME_ENCODERS = [
+    ("png-0", "PNG", {'compress_level': 0}, None),
+    ("png-1", "PNG", {'compress_level': 1}, None),
+    ("png-3", "PNG", {'compress_level': 3}, None),
+    ("png-6", "PNG", {'compress_level': 6}, None),
+    ("png-9", "PNG", {'compress_level': 9}, None),
+    ("webp-lossless-fast", "WEBP", WEBP_LOSSLESS_PARAMS, None),
+    ("webp-lossless-default", "WEBP", {'lossless': True}, None)
+]
+MASK_ENCODERS = [
+    ("png-1 L", "PNG", {'compress_level': 1}, 'L'),
+    ("png-6 L", "PNG", {'compress_level': 6}, 'L'),
+    ("png-9 L", "PNG", {'compress_level': 9}, 'L'),
+    ("png-1 1-bit", "PNG", {'compress_level': 1}, '1'),
+    ("png-6 1-bit", "PNG", {'compress_level': 6}, '1'),
+    ("png-9 1-bit", "PNG", {'compress_level': 9}, '1')
+]
+
+
+def list_images(root: str, limit: int, parent_dir_name: Optional[str] = None) -> List[str]:
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        if parent_dir_name is not None and os.path.basename(dir_path) != parent_dir_name:
+            continue
+        for file_name in sorted(file_names):
+            if Image.registered_extensions().get(os.path.splitext(file_name)[1].lower()) is not None:
+                paths.append(os.path.join(dir_path, file_name))
+                if len(paths) >= limit:
+                    return paths
+    return paths
+
+
+def load_images(paths: List[str], mask: bool) -> List[Image.Image]:
+    images = []
+    for path in paths:
+        if os.path.getsize(path) == 0:
+            continue # Empty ERS masks are not images
+        with Image.open(path) as img:
+            # Masks are thresholded as ImageWriter does for mode '1', so both modes encode the same pixels
+            images.append(img.convert('L').point(lambda value: 255 if value >= MASK_THRESHOLD else 0) if mask else img.convert(img.mode))
+    return images
+
+
+def measure_encoder(images: List[Image.Image], format: str, params: Dict, mode: str, repeats: int) -> Dict:
+    converted = [img.convert(mode) if mode is not None and img.mode != mode else img for img in images]
+    raw_bytes = sum(img.width * img.height * len(img.getbands()) for img in images)
+    pixels = sum(img.width * img.height for img in images)
+
+    # Fastest repeat is reported, it is the least affected by noise of other processes
+    best_time = None
+    for _ in range(repeats):
+        encoded_bytes = 0
+        start = time.perf_counter()
+        for img in converted:
+            stream = io.BytesIO()
+            img.save(stream, format=format, **params)
+            encoded_bytes += stream.tell()
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+
+    return {
+        'images': len(images),
+        'encode_s': best_time,
+        'megapixels_per_s': pixels / best_time / 1e6 if best_time > 0 else None,
+        'encoded_bytes': encoded_bytes,
+        'ratio_to_raw': encoded_bytes / raw_bytes if raw_bytes > 0 else None
+    }
+
+
+def run(images: List[Image.Image], encoders: List[Tuple], repeats: int, kind: str) -> List[Dict]:
+    results = []
+    for name, format, params, mode in encoders:
+        result = {'kind': kind, 'encoder': name, 'format': format, 'params': params, **measure_encoder(images, format, params, mode, repeats)}
+        results.append(result)
+        print(f"{kind:>6} {name:>22} {result['images']:>7} {result['encode_s']:>10.3f} {result['megapixels_per_s'] or 0:>10.1f} {result['encoded_bytes'] / 2**20:>10.2f} {result['ratio_to_raw'] or 0:>8.3f}")
+    return results
+
+
+def main(argv) -> None:
+    parser = argparse.ArgumentParser(description="Measures encode throughput and size of PNG levels, lossless WebP and 1-bit PNG masks on frames and masks of a dataset.")
+    add_dataset_arguments(parser)
+    parser.add_argument("--frames-path", help="Directory with frames, searched recursively. ERS frames of a synthetic dataset are used if not specified")
+    parser.add_argument("--masks-path", help="Directory with masks, searched recursively. ERS masks of a synthetic dataset are used if not specified")
+    parser.add_argument("--limit", type=int, default=200, help="Maximal number of frames and of masks to encode")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of measurements of every encoder, the fastest one is reported")
+    parser.add_argument("--results-path", default="encode-benchmark-results.json", help="Path of JSON file with results")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.frames_path is None or args.masks_path is None:
+            # Synthetic frames are random noise, so their sizes show the worst case rather than real compression ratios
+            ers_path = os.path.join(temp_dir, "ers")
+            create_ers_tree(ers_path, args)
+        frame_paths = list_images(args.frames_path, args.limit) if args.frames_path is not None else list_images(ers_path, args.limit, "frames")
+        mask_paths = list_images(args.masks_path, args.limit) if args.masks_path is not None else list_images(ers_path, args.limit, "labels")
+        frames = load_images(frame_paths, mask=False)
+        masks = load_images(mask_paths, mask=True)
+
+    print(f"{'kind':>6} {'encoder':>22} {'images':>7} {'time [s]':>10} {'MPix/s':>10} {'size [MB]':>10} {'ratio':>8}")
+    results = run(frames, FRAME_ENCODERS, args.repeats, "frame") + run(masks, MASK_ENCODERS, args.repeats, "mask")
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'frames_path': os.path.abspath(args.frames_path) if args.frames_path is not None else None,
+        'masks_path': os.path.abspath(args.masks_path) if args.masks_path is not None else None,
+        'repeats': args.repeats,
+        'results': results
+    }
+    with open(args.results_path, "w") as stream:
+        json.dump(report, stream, indent=2)
+    print(f"Results written to {args.results_path}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
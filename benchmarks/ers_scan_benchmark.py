@@ -0,0 +1,66 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.ers_preparator import ErsPreparator
+from src.scan_cache import ScanCache
+from src.training_type import TrainingType
+
+DEFAULT_SEQUENCE_LENGTHS = [1000, 2000, 4000, 8000]
+CLASS_CODES = ['c01', 'c02', 'h01', 'h02']
+
+
+def create_sequence(root: str, frames_count: int, masks_per_frame: int) -> None:
+    frames_dir = os.path.join(root, "0001", "seq_01", "frames")
+    labels_dir = os.path.join(root, "0001", "seq_01", "labels")
+    os.makedirs(frames_dir)
+    os.makedirs(labels_dir)
+
+    for frame_index in range(frames_count):
+        frame_name = f"{frame_index:06d}"
+        open(os.path.join(frames_dir, f"{frame_name}.png"), "wb").close()
+        for mask_index in range(masks_per_frame):
+            mask_class = CLASS_CODES[mask_index % len(CLASS_CODES)]
+            open(os.path.join(labels_dir, f"{frame_name}_{mask_class}.png"), "wb").close()
+
+
+def time_scan(root: str, repeats: int) -> float:
+    args = Namespace(
+        ers_path=root,
+        ers_class_mapper_path=None,
+        ers_use_seq=True,
+        ers_use_empty_masks=True,
+        training_type=TrainingType.MULTILABEL_SEG)
+
+    best_time = float("inf")
+    for _ in range(repeats):
+        preparator = ErsPreparator(args, ScanCache(None))
+        start = time.perf_counter()
+        for _ in preparator.generate_records():
+            pass
+        best_time = min(best_time, time.perf_counter() - start)
+    return best_time
+
+
+def main(argv) -> None:
+    parser = argparse.ArgumentParser(description="Measures ErsPreparator scan time for growing sequence lengths. Time per frame should stay constant.")
+    parser.add_argument("--lengths", type=int, nargs="+", default=DEFAULT_SEQUENCE_LENGTHS, help="Sequence lengths (frames) to measure")
+    parser.add_argument("--masks-per-frame", type=int, default=2, help="Number of mask files created for every frame")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of measurements per length, the best one is reported")
+    args = parser.parse_args(argv)
+
+    print(f"{'frames':>10} {'masks':>10} {'scan [s]':>10} {'per frame [us]':>15}")
+    for frames_count in args.lengths:
+        with tempfile.TemporaryDirectory() as root:
+            create_sequence(root, frames_count, args.masks_per_frame)
+            scan_time = time_scan(root, args.repeats)
+        print(f"{frames_count:>10} {frames_count * args.masks_per_frame:>10} {scan_time:>10.3f} {scan_time / frames_count * 1e6:>15.1f}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
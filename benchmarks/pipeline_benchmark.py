@@ -0,0 +1,123 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main as program
+from benchmarks.synthetic_dataset import add_dataset_arguments, create_ers_tree, create_hyperkvasir_tree
+from src.copy_strategy import CopyStrategy
+from src.dataset_creator import DatasetCreator
+from src.metrics import metrics
+from src.training_type import TrainingType
+
+REPOSITORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MAPPER_PATHS = {
+    TrainingType.BINARY_SEG: os.path.join(REPOSITORY_PATH, "mappers", "2-class-disease.yaml"),
+    TrainingType.MULTILABEL_SEG: os.path.join(REPOSITORY_PATH, "mappers", "5-class.yaml"),
+    TrainingType.MULTILABEL_CLASSIFICATION: os.path.join(REPOSITORY_PATH, "mappers", "10-class.yaml")
+}
+SPLITS = ['train', 'validation', 'test']
+
+
+# Phases are read from metrics of a whole run, the same ones --metrics-out reports. Fill is the preparation of the
+# output and writing of all splits.
+def run_phases(dataset_path: str, output_path: str, training_type: TrainingType, copy_strategy: CopyStrategy, args) -> Dict:
+    program_args = [
+        "--ers-path", os.path.join(dataset_path, "ers"),
+        "--ers-class-mapper-path", MAPPER_PATHS[training_type],
+        "--ers-use-seq",
+        "--training-type", str(training_type),
+        "--copy-strategy", str(copy_strategy),
+        "--workers", str(args.workers),
+        "--output-path", output_path,
+        "-f"]
+    if args.hyperkvasir_images > 0 and training_type == TrainingType.BINARY_SEG:
+        program_args += ["--hyperkvasir-path", os.path.join(dataset_path, "hyperkvasir")]
+    DatasetCreator(program.parse_args(program_args)).create()
+
+    report = metrics.create_report()
+    phases = report['phases_s']
+    counters = report['counters']
+    return {
+        'records': counters.get('records_written', 0) + counters.get('records_failed', 0),
+        'scan_s': phases['scan'],
+        'split_s': phases['split'],
+        'fill_s': phases['prepare_output'] + sum(phases[f'write_{split}'] for split in SPLITS)
+    }
+
+
+def summarize(samples: List[Dict]) -> Dict:
+    # Fastest sample of every phase is reported, it is the least affected by noise of other processes
+    summary = {'records': samples[0]['records']}
+    for phase in ['scan_s', 'split_s', 'fill_s']:
+        summary[phase] = min(sample[phase] for sample in samples)
+    summary['fill_records_per_s'] = summary['records'] / summary['fill_s'] if summary['fill_s'] > 0 else None
+    summary['samples'] = samples
+    return summary
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv) -> None:
+    parser = argparse.ArgumentParser(description="Times scan, split and fill phases of dataset preparation on a synthetic dataset for every training type and copy strategy.")
+    add_dataset_arguments(parser)
+    parser.add_argument("--training-types", type=TrainingType, nargs="+", default=list(TrainingType), choices=list(TrainingType), help="Training types to measure")
+    parser.add_argument("--copy-strategies", type=CopyStrategy, nargs="+", default=[CopyStrategy.DUPLICATE, CopyStrategy.SYMLINK, CopyStrategy.HARDLINK], choices=list(CopyStrategy), help="Copy strategies to measure")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes writing output")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of measurements of every combination, the fastest one is reported")
+    parser.add_argument("--dataset-path", help="Existing synthetic dataset to use, generated into a temporary directory if not specified")
+    parser.add_argument("--results-path", default="benchmark-results.json", help="Path of JSON file with results")
+    parser.add_argument("--verbose", action="store_true", help="Show output of dataset preparation")
+    args = parser.parse_args(argv)
+    program.setup_argument_parser()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dataset_path = args.dataset_path
+        if dataset_path is None:
+            dataset_path = os.path.join(temp_dir, "dataset")
+            create_ers_tree(os.path.join(dataset_path, "ers"), args)
+            if args.hyperkvasir_images > 0:
+                create_hyperkvasir_tree(os.path.join(dataset_path, "hyperkvasir"), args)
+
+        results = []
+        print(f"{'training type':>26} {'copy strategy':>14} {'records':>8} {'scan [s]':>9} {'split [s]':>10} {'fill [s]':>9}")
+        for training_type, copy_strategy in itertools.product(args.training_types, args.copy_strategies):
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+                samples = [
+                    run_phases(dataset_path, os.path.join(temp_dir, "output"), training_type, copy_strategy, args)
+                    for _ in range(args.repeats)]
+            summary = summarize(samples)
+            results.append({'training_type': str(training_type), 'copy_strategy': str(copy_strategy), **summary})
+            print(f"{str(training_type):>26} {str(copy_strategy):>14} {summary['records']:>8} {summary['scan_s']:>9.3f} {summary['split_s']:>10.3f} {summary['fill_s']:>9.3f}")
+
+    dataset = {name: getattr(args, name) for name in ['patients', 'sequences', 'frames', 'masks_per_frame', 'image_size', 'empty_mask_ratio', 'hyperkvasir_images', 'seed']}
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'dataset': dataset if args.dataset_path is None else {'path': os.path.abspath(args.dataset_path)},
+        'workers': args.workers,
+        'repeats': args.repeats,
+        'results': results
+    }
+    with open(args.results_path, "w") as stream:
+        json.dump(report, stream, indent=2)
+    print(f"Results written to {args.results_path}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
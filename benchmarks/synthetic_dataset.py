@@ -0,0 +1,154 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from argparse import Namespace
+from typing import List, Tuple
+import numpy as np
+from PIL import Image
+
+# Codes of disease (c, g, b) and healthy (h) classes used in mappers, masks of healthy classes may be empty files
+CLASS_CODES = ['c01', 'c02', 'c05', 'c22', 'g14', 'g19', 'b02', 'h01', 'h02', 'h03']
+IMAGE_VARIANTS = 8
+# Organs, categories and findings of Hyperkvasir labeled images as named in its index
+HYPERKVASIR_FINDINGS = [
+    ('Lower GI', 'pathological-findings', 'polyps'),
+    ('Lower GI', 'anatomical-landmarks', 'cecum'),
+    ('Upper GI', 'anatomical-landmarks', 'z-line'),
+    ('Upper GI', 'pathological-findings', 'esophagitis-a'),
+]
+
+
+# Trees follow the layout of original datasets:
+# ERS: (root)/(patient)/(samples|seq_NN)/frames/(frame).png and (root)/(patient)/(samples|seq_NN)/labels/(frame)_(class)_(class).png
+# Hyperkvasir: (root)/segmented-images/images/(name).jpg and (root)/segmented-images/masks/(name).jpg listed in
+# (root)/segmented-images/bounding-boxes.json, (root)/labeled-images/(organ)-tract/(category)/(finding)/(name).jpg
+# listed in (root)/labeled-images/image-labels.csv
+# Image contents are random, a few variants are encoded once and reused, so generation is dominated by writing files.
+def create_ers_tree(root: str, params: Namespace) -> int:
+    rng = np.random.default_rng(params.seed)
+    frames = create_image_variants(rng, params.image_size, "RGB", "PNG", mask=False)
+    masks = create_image_variants(rng, params.image_size, "L", "PNG", mask=True)
+
+    files_count = 0
+    for patient_index in range(params.patients):
+        patient_dir = os.path.join(root, f"{patient_index + 1:04d}")
+        data_dirs = ["samples"] + [f"seq_{sequence_index + 1:02d}" for sequence_index in range(params.sequences)]
+        for data_dir in data_dirs:
+            frames_dir = os.path.join(patient_dir, data_dir, "frames")
+            labels_dir = os.path.join(patient_dir, data_dir, "labels")
+            os.makedirs(frames_dir)
+            os.makedirs(labels_dir)
+
+            for frame_index in range(params.frames):
+                frame_name = f"{frame_index + 1:06d}"
+                write_file(os.path.join(frames_dir, f"{frame_name}.png"), frames[rng.integers(len(frames))])
+                for mask_classes in draw_mask_classes(rng, params.masks_per_frame):
+                    content = b"" if rng.random() < params.empty_mask_ratio else masks[rng.integers(len(masks))]
+                    write_file(os.path.join(labels_dir, f"{frame_name}_{'_'.join(mask_classes)}.png"), content)
+                files_count += 1 + params.masks_per_frame
+    return files_count
+
+
+def create_hyperkvasir_tree(root: str, params: Namespace) -> int:
+    rng = np.random.default_rng(params.seed)
+    frames = create_image_variants(rng, params.image_size, "RGB", "JPEG", mask=False)
+    masks = create_image_variants(rng, params.image_size, "RGB", "JPEG", mask=True)
+
+    images_dir = os.path.join(root, "segmented-images", "images")
+    masks_dir = os.path.join(root, "segmented-images", "masks")
+    os.makedirs(images_dir)
+    os.makedirs(masks_dir)
+    (width, height) = params.image_size
+    bounding_boxes = {}
+    for image_index in range(params.hyperkvasir_images):
+        image_id = f"{image_index:08x}-synthetic"
+        write_file(os.path.join(images_dir, f"{image_id}.jpg"), frames[rng.integers(len(frames))])
+        write_file(os.path.join(masks_dir, f"{image_id}.jpg"), masks[rng.integers(len(masks))])
+        bounding_boxes[image_id] = {'height': height, 'width': width, 'bbox': [{'label': 'polyp', 'xmin': 0, 'ymin': 0, 'xmax': width, 'ymax': height}]}
+    write_file(os.path.join(root, "segmented-images", "bounding-boxes.json"), json.dumps(bounding_boxes).encode())
+
+    labeled_dir = os.path.join(root, "labeled-images")
+    os.makedirs(labeled_dir)
+    with open(os.path.join(labeled_dir, "image-labels.csv"), "w", newline='') as stream:
+        writer = csv.writer(stream)
+        writer.writerow(['Video file', 'Organ', 'Finding', 'Classification'])
+        for image_index in range(params.hyperkvasir_labeled_images):
+            image_id = f"{image_index:08x}-labeled"
+            (organ, category, finding) = HYPERKVASIR_FINDINGS[rng.integers(len(HYPERKVASIR_FINDINGS))]
+            image_dir = os.path.join(labeled_dir, f"{organ.lower().replace(' ', '-')}-tract", category, finding)
+            os.makedirs(image_dir, exist_ok=True)
+            write_file(os.path.join(image_dir, f"{image_id}.jpg"), frames[rng.integers(len(frames))])
+            writer.writerow([image_id, organ, finding, category])
+    return 2 * params.hyperkvasir_images + params.hyperkvasir_labeled_images
+
+
+def draw_mask_classes(rng: np.random.Generator, masks_count: int) -> List[List[str]]:
+    # Classes of masks of one frame are distinct, so mask file names do not collide
+    codes = list(rng.permutation(CLASS_CODES))
+    mask_classes = []
+    for _ in range(masks_count):
+        classes_count = min(int(rng.integers(1, 3)), len(codes))
+        mask_classes.append(codes[:classes_count])
+        codes = codes[classes_count:] if len(codes) > classes_count else list(rng.permutation(CLASS_CODES))
+    return mask_classes
+
+
+def create_image_variants(rng: np.random.Generator, size: Tuple[int, int], mode: str, format: str, mask: bool) -> List[bytes]:
+    (width, height) = size
+    variants = []
+    for _ in range(IMAGE_VARIANTS):
+        if mask:
+            # A white rectangle on black background
+            pixels = np.zeros((height, width), dtype=np.uint8)
+            (top, left) = rng.integers(0, [max(height // 2, 1), max(width // 2, 1)])
+            pixels[top:top + height // 3 + 1, left:left + width // 3 + 1] = 255
+        else:
+            pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        stream = io.BytesIO()
+        Image.fromarray(pixels).convert(mode).save(stream, format=format)
+        variants.append(stream.getvalue())
+    return variants
+
+
+def write_file(path: str, content: bytes) -> None:
+    with open(path, "wb") as stream:
+        stream.write(content)
+
+
+def image_size(value: str) -> Tuple[int, int]:
+    try:
+        (width, height) = (int(dimension) for dimension in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a size in form WIDTHxHEIGHT")
+    return (width, height)
+
+
+def add_dataset_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--patients", type=int, default=4, help="Number of ERS patients")
+    parser.add_argument("--sequences", type=int, default=2, help="Number of sequence directories per patient, next to samples directory")
+    parser.add_argument("--frames", type=int, default=50, help="Number of frames per samples or sequence directory")
+    parser.add_argument("--masks-per-frame", type=int, default=2, help="Number of mask files per ERS frame")
+    parser.add_argument("--image-size", type=image_size, default=(256, 256), help="Size of frames and masks as WIDTHxHEIGHT")
+    parser.add_argument("--empty-mask-ratio", type=float, default=0.2, help="Fraction of ERS masks written as empty files")
+    parser.add_argument("--hyperkvasir-images", type=int, default=100, help="Number of Hyperkvasir segmented images, 0 to skip the dataset")
+    parser.add_argument("--hyperkvasir-labeled-images", type=int, default=100, help="Number of Hyperkvasir labeled images")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of random generator, the same seed gives the same trees")
+
+
+def main(argv) -> None:
+    parser = argparse.ArgumentParser(description="Generates synthetic ERS and Hyperkvasir dataset trees.")
+    parser.add_argument("output_path", help="Directory where ers and hyperkvasir trees are created")
+    add_dataset_arguments(parser)
+    args = parser.parse_args(argv)
+
+    files_count = create_ers_tree(os.path.join(args.output_path, "ers"), args)
+    if args.hyperkvasir_images > 0:
+        files_count += create_hyperkvasir_tree(os.path.join(args.output_path, "hyperkvasir"), args)
+    print(f"Created {files_count} files in {args.output_path}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
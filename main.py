@@ -1,15 +1,27 @@
 import argparse
 import os
 import sys
+import yaml
+from PIL import features
 
 from src.training_type import TrainingType
 from src.copy_strategy import CopyStrategy
+from src.output_format import OutputFormat
+from src.image_format import ImageFormat
+from src.resample_filter import ResampleFilter
+from src.split_mode import SplitMode
+from src.splitter import DEFAULT_SPLIT_SEED
 from src.dataset_creator import DatasetCreator
+from src.dataset_fan_out import DatasetFanOut
+from src.output_manifest import OutputManifest
 
 DEFAULT_VALIDATION_SIZE = 0.2
 DEFAULT_TEST_SIZE = 0.1
 DEFAULT_TRAIN_SIZE = 0.7
+DEFAULT_SHARD_MAX_SIZE = 1024
 EMPTY_FLOAT = -1
+# Options of sources and of the whole run, they cannot differ between configurations of a configs file
+SHARED_CONFIG_OPTIONS = ['hyperkvasir_path', 'ers_path', 'ers_use_seq', 'metadata_index_path', 'scan_cache_path', 'metrics_out', 'profile', 'dry_run', 'partition_index', 'num_partitions']
 
 def dir_path(path):
     if os.path.isdir(path):
@@ -21,6 +33,27 @@ def file_path(path):
         return path
     raise FileNotFoundError(path)
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a non-negative integer")
+    return number
+
+def image_size(value):
+    try:
+        (width, height) = (int(dimension) for dimension in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a size in form WIDTHxHEIGHT")
+    if width < 1 or height < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive size")
+    return (width, height)
+
 def is_dir_empty(path):
     return not next(os.scandir(path), None)
 
@@ -47,6 +80,25 @@ def setup_argument_parser():
                         default=EMPTY_FLOAT,
                         help="Size of validation set split (sum of train+test+validation size must equal 1)",
                         required=False)
+    parser.add_argument("--split-mode",
+                        help="How patients are assigned to train/validation/test sets. 'group-shuffle' shuffles patients of the whole dataset, so adding a patient can move others to another set. 'hash' assigns every patient by a seeded hash of its id, patients never move when others are added or removed",
+                        default=SplitMode.GROUP_SHUFFLE,
+                        type=SplitMode,
+                        choices=list(SplitMode),
+                        required=False)
+    parser.add_argument("--split-seed",
+                        help="Seed of the split and of the order of records within every set",
+                        default=DEFAULT_SPLIT_SEED,
+                        type=int,
+                        required=False)
+    parser.add_argument("--split-out",
+                        help="Path of CSV file with the set of every patient (frame path for records without patient) written by this run",
+                        default=None,
+                        required=False)
+    parser.add_argument("--split-in",
+                        help="Path of CSV file written with --split-out. Listed patients keep their sets, other patients are assigned as with '--split-mode hash'",
+                        type=file_path,
+                        required=False)
 
     #Dataset output options
     parser.add_argument("--path-ignore-dataset-type",
@@ -64,22 +116,108 @@ def setup_argument_parser():
                         default="./data",
                         type=str,
                         required=False)
+    parser.add_argument("--output-format",
+                        help="Format of generated data. 'directory' writes images and masks as separate files, 'shards' writes each of train/validation/test as size-bounded tar files ((output-path)/(dataset-type)-000000.tar) where frame, masks and JSON with class labels of a sample share a key (WebDataset convention), 'memmap' writes each of train/validation/test as preallocated NumPy arrays of frames and masks (requires frames of equal size) with an index of rows, 'coco' writes frames as files and masks of each of train/validation/test as run-length encoded annotations in one COCO-style JSON file ((output-path)/annotations/(dataset-type).json)",
+                        default=OutputFormat.DIRECTORY,
+                        type=OutputFormat,
+                        choices=list(OutputFormat),
+                        required=False)
+    parser.add_argument("--shard-max-size",
+                        help="Maximal size of a single shard in MB, used with '--output-format shards'",
+                        default=DEFAULT_SHARD_MAX_SIZE,
+                        type=positive_int,
+                        required=False)
     parser.add_argument("-f", "--force",
                         action="store_true",
                         help="Clears output-path if anything exists")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Keeps a manifest of written files in output-path. Subsequent runs with this flag write, rewrite or delete only files whose sources or options changed, and resume interrupted runs")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="Plans operations (link, copy, convert, merge or synthesize masks, copy outputs) of every record and prints their counts and estimated output size per split, without writing anything. Supported only for 'directory' output format")
+    parser.add_argument("--plan-out",
+                        help="Path of JSON Lines file with planned operations (split, kind, row, source, destination, masks, source and estimated output bytes), written with or without --dry-run",
+                        default=None,
+                        required=False)
+    parser.add_argument("--configs-path",
+                        help="Path of YAML file with a list of configurations created in one run, e.g. [{training-type: binary-seg, ers-class-mapper-path: mappers/2-class-polyp.yaml, output-path: ./polyp}, {training-type: multilabel-classification, output-path: ./classes}]. Keys are long names of options, values override options of the command line (flags can only be turned on). Sources are scanned once and outputs equal in several configurations are computed once and copied with the output copy strategy (hardlinks for symlink and hardlink strategies)",
+                        type=file_path,
+                        required=False)
     parser.add_argument("--copy-strategy",
-                        help="Strategy used when copying unmodified files to output dir",
+                        help="Strategy used when copying unmodified files to output dir. 'auto' uses reflinks (copy-on-write clones) where the filesystem supports them and full copies otherwise, never hardlinks",
                         default=CopyStrategy.DUPLICATE if sys.platform == "win32" else CopyStrategy.SYMLINK,
                         type=CopyStrategy,
                         choices=list(CopyStrategy),
                         required=False)                        
+    parser.add_argument("--workers",
+                        help="Number of worker processes used to write output records. Records are sent to workers in chunks, output is the same as with a single process",
+                        default=1,
+                        type=positive_int,
+                        required=False)
+    parser.add_argument("--num-partitions",
+                        help="Number of partitions of the export, e.g. machines of a cluster writing to a shared output-path. Every partition scans sources and computes the same split, then writes only its share of records (every N-th record of every split) and lists its outputs in a partial manifest. Merge partial manifests with merge_partitions.py when all partitions finish. Supported only for 'directory' output format",
+                        default=1,
+                        type=positive_int,
+                        required=False)
+    parser.add_argument("--partition-index",
+                        help="Index of the partition written by this run, from 0 to --num-partitions - 1",
+                        default=0,
+                        type=non_negative_int,
+                        required=False)
+
+    parser.add_argument("--metadata-index-path",
+                        help="Path of SQLite file with metadata (size, mode, byte size, mtime) of source images. The file is created if missing and reused in subsequent runs, so images and masks do not have to be opened again. If not specified, metadata is kept in memory for a single run only",
+                        type=str,
+                        required=False)
+    parser.add_argument("--scan-cache-path",
+                        help="Path of SQLite file with listings of ERS frames and labels directories (frame and mask names, empty mask flags). The file is created if missing, a cached listing is reused while modification time and number of entries of its directories do not change, so changing only split, mapper or output options does not rescan the dataset",
+                        type=str,
+                        required=False)
+    parser.add_argument("--metrics-out",
+                        help="Path of JSON file with metrics of the run: time of phases, records per second, histogram of per-record latency, counters of image opens, decodes, encodes, copies, links and bytes read and written, peak memory",
+                        default=None,
+                        required=False)
+    parser.add_argument("--profile",
+                        help="Traces memory allocations of the main process to report its peak Python heap in metrics. Slows the script down, requires --metrics-out",
+                        action="store_true",
+                        required=False)
 
     #Image options
     parser.add_argument('--img-mode',
                         help="Output image mode compatible with PIL. Examples are 'L' for grayscale, RGB, RGBA. If not selected then image will be copied as is.",
                         required=False)
     parser.add_argument('--mask-mode',
-                        help="Output mask image mode compatible with PIL. Examples are 'L' for grayscale, RGB, RGBA. If not selected then mask will be copied as is.",
+                        help="Output mask image mode compatible with PIL. Examples are 'L' for grayscale, RGB, RGBA, '1' for 1-bit masks (thresholded at half of intensity). If not selected then mask will be copied as is.",
+                        required=False)
+    parser.add_argument('--frame-format',
+                        help="Format of output frames, written with its extension. Frames in another format are converted, WebP is written lossless. If not selected then frames keep the format of source files",
+                        type=ImageFormat,
+                        choices=list(ImageFormat),
+                        required=False)
+    parser.add_argument('--mask-format',
+                        help="Format of output masks, written with its extension. Masks in another format are converted, WebP is written lossless. If not selected then masks keep the format of source frames (e.g. JPEG for Hyperkvasir)",
+                        type=ImageFormat,
+                        choices=list(ImageFormat),
+                        required=False)
+    parser.add_argument('--png-compress-level',
+                        help="zlib compression level (0-9) of written PNG files. Lower levels encode faster and produce larger files. If not selected then PIL default (6) is used",
+                        type=int,
+                        choices=range(10),
+                        metavar="{0-9}",
+                        required=False)
+    parser.add_argument('--target-size',
+                        help="Size of output frames and masks as WIDTHxHEIGHT, e.g. 512x512. Images are resized on export in workers, so sources of another size are never copied. If not selected then images keep their size",
+                        type=image_size,
+                        required=False)
+    parser.add_argument('--crop',
+                        help="Crop images to the largest centered box with the aspect ratio of --target-size before resizing, instead of stretching them",
+                        action="store_true",
+                        required=False)
+    parser.add_argument('--resample',
+                        help="Resampling filter of frames resized to --target-size, masks are always resized with nearest neighbour. Defaults to bilinear",
+                        type=ResampleFilter,
+                        choices=list(ResampleFilter),
                         required=False)
 
     #Training specific
@@ -94,6 +232,10 @@ def setup_argument_parser():
                         help="Path for HyperKvasir dataset (contains folders \"labeled-images\" and \"segmented-images\")",
                         type=dir_path,
                         required=False)
+    parser.add_argument("--hyperkvasir-class-mapper-path",
+                        type=file_path,
+                        help="Localization of class mapper yaml file for HyperKvasir. Findings of labeled images (e.g. \"polyps\") and labels of bounding boxes of segmented images (\"polyp\") are mapped as ERS class codes. Images with findings or labels that are not mapped in the file will be skipped.",
+                        required=False)
 
     #ERS
     parser.add_argument("--ers-path",
@@ -149,27 +291,97 @@ def parse_args(args):
         args.validation_size = 1 - args.test_size - args.train_size
     if round(args.train_size + args.test_size + args.validation_size) != 1.0:
         parser.error("Sum of --train-size,--test-size and --validation-size should be equal 1.0")
-    if args.force is False and os.path.isdir(args.output_path) and not is_dir_empty(args.output_path):
-        parser.error("Output directory should be empty. Use -f to force clean")
+    if args.dry_run and args.force:
+        args.force = False
+        print("[INFO] Ignoring '-f' parameter, since nothing is written in dry run")
+    if args.partition_index >= args.num_partitions:
+        parser.error("--partition-index should be lower than --num-partitions")
+    if args.num_partitions > 1 and args.output_format != OutputFormat.DIRECTORY:
+        parser.error("--num-partitions is supported only for 'directory' output format")
+    if args.num_partitions > 1 and args.force:
+        parser.error("-f cannot be used with --num-partitions, since partitions share output-path. Clear it before starting partitions")
+    # Other partitions write to the same output directory
+    if args.num_partitions == 1 and args.dry_run is False and args.force is False and os.path.isdir(args.output_path) and not is_dir_empty(args.output_path):
+        if not args.incremental:
+            parser.error("Output directory should be empty. Use -f to force clean")
+        elif not OutputManifest.exists(args.output_path):
+            parser.error("Output directory is not empty and does not contain a manifest of a previous --incremental run. Use -f to force clean")
+    if args.profile and args.metrics_out is None:
+        parser.error("--profile requires --metrics-out")
+    if args.incremental and args.output_format != OutputFormat.DIRECTORY:
+        parser.error("--incremental is supported only for 'directory' output format")
+    if (args.dry_run or args.plan_out is not None) and args.output_format != OutputFormat.DIRECTORY:
+        parser.error("--dry-run and --plan-out are supported only for 'directory' output format")
+    if args.output_format == OutputFormat.COCO and args.training_type == TrainingType.MULTILABEL_CLASSIFICATION:
+        parser.error("--output-format coco requires a segmentation training type")
+    if args.output_format not in [OutputFormat.DIRECTORY, OutputFormat.COCO] and (args.path_ignore_dataset_type or args.path_ignore_dataset_name):
+        print(f"[INFO] Ignoring '--path-ignore-*' parameters, since output format is {args.output_format}")
+    if ImageFormat.WEBP in [args.frame_format, args.mask_format] and not features.check('webp'):
+        parser.error("--frame-format webp and --mask-format webp require PIL built with WebP support")
+    if args.output_format == OutputFormat.MEMMAP and (args.frame_format is not None or args.mask_format is not None or args.png_compress_level is not None):
+        print("[INFO] Ignoring '--frame-format', '--mask-format' and '--png-compress-level' parameters, since output format is memmap")
+    if args.output_format == OutputFormat.COCO and (args.mask_format is not None or args.mask_mode is not None):
+        print("[INFO] Ignoring '--mask-format' and '--mask-mode' parameters, since masks are stored as run-length encoded annotations")
+    if args.target_size is None and (args.crop or args.resample is not None):
+        parser.error("--crop and --resample require --target-size")
+    if args.mask_mode == '1' and args.mask_format is not None and args.mask_format != ImageFormat.PNG:
+        print("[INFO] 1-bit masks are stored in 1 bit per pixel only as PNG, use '--mask-format png'")
     if args.ers_use_empty_masks == False and args.training_type == TrainingType.MULTILABEL_CLASSIFICATION:
         args.ers_use_empty_masks = True
         print("[INFO] Ignoring '--ers-use-empty-masks' parameter, since training type is classification")
     if args.copy_strategy == CopyStrategy.SYMLINK:
-        print("[INFO] Chosen copy strategy is SYMLINK. Keep in mind that the script may still sometimes create new image files in the output dataset")
+        print("[INFO] Chosen copy strategy is SYMLINK. Keep in mind that the script may still sometimes create new image files in the output dataset, "
+              "and files copied from other output files (e.g. masks of a single color) are hard links to them")
+    if args.copy_strategy == CopyStrategy.HARDLINK:
+        print("[INFO] Chosen copy strategy is HARDLINK. Keep in mind that modifying output files in place modifies the source dataset as well")
     if args.ers_class_mapper_path is None and args.ers_path is not None:
         print("[INFO] No ERS mapper specified. Default behaviour will be used.")
     if args.training_type == TrainingType.MULTILABEL_CLASSIFICATION and args.mask_mode is not None:
         print("[INFO] Ignoring mask-mode parameter for classification training type")
-    if args.hyperkvasir_path is not None and args.training_type != TrainingType.BINARY_SEG:
-        print("[INFO] It is not recommended to use hyperkvasir feature of this script for non binary segmentation purposes")
+    if args.hyperkvasir_path is not None and args.training_type != TrainingType.MULTILABEL_CLASSIFICATION:
+        print("[INFO] Hyperkvasir labeled images have no masks, only segmented images (polyps) are used for segmentation")
 
     return args
 
 
+def parse_configs(args):
+    configs_parser = argparse.ArgumentParser(add_help=False)
+    configs_parser.add_argument("--configs-path", type=file_path)
+    configs_path = configs_parser.parse_known_args(args)[0].configs_path
+    if configs_path is None:
+        return [parse_args(args)]
+
+    parser = setup_argument_parser()
+    with open(configs_path, "r") as stream:
+        entries = yaml.safe_load(stream)
+    if not isinstance(entries, list) or len(entries) == 0 or not all(isinstance(entry, dict) for entry in entries):
+        parser.error("--configs-path should contain a non-empty list of configurations")
+    configs = [parse_args(args + config_to_args(entry, parser)) for entry in entries]
+
+    for option in SHARED_CONFIG_OPTIONS:
+        if len(set(getattr(config, option) for config in configs)) > 1:
+            parser.error(f"Option '{option}' should be equal in all configurations of --configs-path")
+    if len(set(os.path.abspath(config.output_path) for config in configs)) < len(configs):
+        parser.error("Output paths of configurations of --configs-path should differ")
+    return configs
+
+
+def config_to_args(entry, parser):
+    config_args = []
+    for key, value in entry.items():
+        if value is False or value is None:
+            parser.error(f"Option '{key}' of --configs-path cannot be turned off, remove it instead")
+        config_args += [f"--{key}"] if value is True else [f"--{key}", str(value)]
+    return config_args
+
+
 def main(args):
     setup_argument_parser()
-    args = parse_args(args)
-    DatasetCreator(args).create()
+    configs = parse_configs(args)
+    if len(configs) == 1:
+        DatasetCreator(configs[0]).create()
+    else:
+        DatasetFanOut(configs).create()
 
 
 if __name__ == '__main__':
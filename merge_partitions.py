@@ -0,0 +1,36 @@
+import argparse
+import os
+import sys
+
+from src.output_manifest import merge_partial_manifests, MANIFEST_FILE_NAME
+
+
+def dir_path(path):
+    if os.path.isdir(path):
+        return path
+    raise NotADirectoryError(path)
+
+
+def setup_argument_parser():
+    parser = argparse.ArgumentParser(
+        description=f"Validates partial manifests written by all partitions of a run with --num-partitions and merges them into {MANIFEST_FILE_NAME} of the output directory")
+    parser.add_argument("output_paths",
+                        help="Output paths of the run, one for every configuration of --configs-path",
+                        type=dir_path,
+                        nargs="+")
+    return parser
+
+
+def main(args):
+    parser = setup_argument_parser()
+    args = parser.parse_args(args)
+    for output_path in args.output_paths:
+        try:
+            outputs_count = merge_partial_manifests(output_path)
+        except ValueError as e:
+            parser.error(f"Cannot merge partitions of {output_path}: {e}")
+        print(f"Merged partitions of {output_path}, {outputs_count} files listed in {MANIFEST_FILE_NAME}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,7 @@
+import numpy as np
+import yaml
 from abc import ABC, abstractmethod
-from typing import List, Dict
+from typing import List, Dict, FrozenSet, Optional, Set
 
 class AbstractClassMapper(ABC):
     @abstractmethod
@@ -10,6 +12,9 @@ class AbstractClassMapper(ABC):
     def is_positive(self, name: str) -> bool:
         raise NotImplementedError
 
+    def compile(self, codes: List[str]) -> 'ClassLookupTable':
+        return ClassLookupTable(self, codes)
+
 class DictClassMapper(AbstractClassMapper):
 
     def __init__(self, mappings: Dict) -> None:
@@ -40,4 +45,38 @@ class DummyClassMapper(AbstractClassMapper):
     
     def is_positive(self, name: str) -> bool:
         return True
-    
+
+
+def load_class_mapper(class_mapper_path: Optional[str]) -> AbstractClassMapper:
+    if class_mapper_path is None:
+        return DummyClassMapper()
+    with open(class_mapper_path, "r") as stream:
+        return DictClassMapper(yaml.safe_load(stream))
+
+
+# Mapping of a list of class codes compiled to integer arrays indexed by position of a code in the list, so masks
+# of many frames are mapped with array operations. Mapper is called once per code.
+class ClassLookupTable:
+    def __init__(self, mapper: AbstractClassMapper, codes: List[str]) -> None:
+        self.class_names: List[str] = []
+        class_ids: Dict[str, int] = {}
+        mapped_class_ids: List[int] = []
+        set_ids: Dict[FrozenSet[str], int] = {frozenset(): 0} # Id 0 is the empty set of codes that are not mapped
+        self.code_class_sets: List[Set[str]] = []
+        self.class_offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        self.set_ids = np.zeros(len(codes), dtype=np.int64)
+
+        for code_id, code in enumerate(codes):
+            mapped_classes = mapper.map(code)
+            for class_name in mapped_classes:
+                if class_name not in class_ids:
+                    class_ids[class_name] = len(self.class_names)
+                    self.class_names.append(class_name)
+                mapped_class_ids.append(class_ids[class_name])
+            self.class_offsets[code_id + 1] = len(mapped_class_ids)
+            self.set_ids[code_id] = set_ids.setdefault(frozenset(mapped_classes), len(set_ids))
+            self.code_class_sets.append(set(mapped_classes))
+
+        # Mapped classes of code i, in the order given by the mapper, are class_ids[class_offsets[i]:class_offsets[i + 1]]
+        self.class_ids = np.array(mapped_class_ids, dtype=np.int64)
+        self.positive = np.array([mapper.is_positive(class_name) for class_name in self.class_names], dtype=bool)
@@ -1,37 +1,146 @@
+import errno
 import os
 import shutil
-from enum import Enum
+from src.extended_enum import ExtendedEnum
 from abc import ABC, abstractmethod
+from typing import Callable, Dict, Optional, Tuple
+from src.metrics import metrics
 
+try:
+    import fcntl
+except ImportError: # Not available on Windows, reflinks fall back to copies there
+    fcntl = None
 
-class ExtendedEnum(Enum):
-    @classmethod
-    def list(cls):
-        return list(map(lambda c: c.value, cls))
+FICLONE = 0x40049409 # Linux ioctl request, see ioctl_ficlone(2)
+LINK_NOT_SUPPORTED_ERRORS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS}
 
 
+# Callers that know the byte size of the source pass it, so a full copy does not stat the copied file to count bytes
 class AbstractCopyStrategy(ABC):
     @abstractmethod
-    def copy(self, src: str, dest: str) -> None:
+    def copy(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
         raise NotImplementedError
 
 
+# Links cannot overwrite files, existing destination is replaced as it is by shutil.copy
+def replace_existing(copy: Callable, src: str, dest: str):
+    try:
+        return copy(src, dest)
+    except FileExistsError:
+        os.remove(dest)
+        return copy(src, dest)
+
+
 class DuplicateCopyStrategy(AbstractCopyStrategy):
-    def copy(self, src: str, dest: str) -> None:
+    def copy(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
         shutil.copy(src, dest)
+        if byte_size is None:
+            byte_size = os.path.getsize(dest)
+        metrics.count('files_duplicated')
+        metrics.count('bytes_read', byte_size)
+        metrics.count('bytes_written', byte_size)
 
 
 class SymlinkCopyStrategy(AbstractCopyStrategy):
-    def copy(self, src: str, dest: str) -> None:
-        os.symlink(src, dest)
+    def copy(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        replace_existing(os.symlink, src, dest)
+        metrics.count('files_symlinked')
+
+
+class HardlinkCopyStrategy(AbstractCopyStrategy):
+    def __init__(self) -> None:
+        self.fallback_strategy = DuplicateCopyStrategy()
+
+    def copy(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        try:
+            replace_existing(HardlinkCopyStrategy.link, src, dest)
+        except OSError as e:
+            if e.errno not in LINK_NOT_SUPPORTED_ERRORS:
+                raise
+            self.fallback_strategy.copy(src, dest, byte_size)
+
+    @staticmethod
+    def link(src: str, dest: str) -> None:
+        os.link(src, dest)
+        metrics.count('files_hardlinked')
+
+
+class ReflinkCopyStrategy(AbstractCopyStrategy):
+    def __init__(self) -> None:
+        self.fallback_strategy = DuplicateCopyStrategy()
+
+    def copy(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        try:
+            replace_existing(ReflinkCopyStrategy.clone, src, dest)
+        except OSError as e:
+            if e.errno not in LINK_NOT_SUPPORTED_ERRORS:
+                raise
+            self.fallback_strategy.copy(src, dest, byte_size)
+
+    @staticmethod
+    def clone(src: str, dest: str) -> None:
+        if fcntl is None:
+            raise OSError(errno.ENOTSUP, "Reflinks are not supported on this platform", dest)
+        with open(src, "rb") as src_file, open(dest, "xb") as dest_file:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                dest_file.close()
+                os.remove(dest)
+                raise
+        shutil.copymode(src, dest)
+        metrics.count('files_reflinked')
+
+
+class AutoCopyStrategy(AbstractCopyStrategy):
+    # Copy-on-write clone is preferred, otherwise the file is copied in full. Hardlinks are never chosen, since a hardlinked
+    # output shares its content with the source and modifying one in place modifies the other. The choice is made on
+    # the first copy between each pair of source and destination filesystems and reused afterwards.
+    def __init__(self) -> None:
+        self.device_per_dir: Dict[str, int] = {}
+        self.strategy_per_devices: Dict[Tuple[int, int], AbstractCopyStrategy] = {}
+
+    def copy(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        devices = (self.__get_device(os.path.dirname(src)), self.__get_device(os.path.dirname(dest)))
+        if devices in self.strategy_per_devices:
+            self.strategy_per_devices[devices].copy(src, dest, byte_size)
+        else:
+            self.strategy_per_devices[devices] = replace_existing(lambda src, dest: AutoCopyStrategy.__probe(src, dest, byte_size), src, dest)
+
+    def __get_device(self, path: str) -> int:
+        if path not in self.device_per_dir:
+            self.device_per_dir[path] = os.stat(path or os.curdir).st_dev
+        return self.device_per_dir[path]
+
+    @staticmethod
+    def __probe(src: str, dest: str, byte_size: Optional[int]) -> AbstractCopyStrategy:
+        try:
+            ReflinkCopyStrategy.clone(src, dest)
+            return ReflinkCopyStrategy()
+        except OSError as e:
+            if e.errno not in LINK_NOT_SUPPORTED_ERRORS:
+                raise
+        strategy = DuplicateCopyStrategy()
+        strategy.copy(src, dest, byte_size)
+        return strategy
 
 
 class CopyStrategy(ExtendedEnum):
     DUPLICATE = "duplicate"
     SYMLINK = "symlink"
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+    AUTO = "auto"
 
     def __str__(self):
         return self.value.lower()
 
     def create(self) -> AbstractCopyStrategy:
-        return DuplicateCopyStrategy() if self == CopyStrategy.DUPLICATE else SymlinkCopyStrategy()
+        strategies = {
+            CopyStrategy.DUPLICATE: DuplicateCopyStrategy,
+            CopyStrategy.SYMLINK: SymlinkCopyStrategy,
+            CopyStrategy.HARDLINK: HardlinkCopyStrategy,
+            CopyStrategy.REFLINK: ReflinkCopyStrategy,
+            CopyStrategy.AUTO: AutoCopyStrategy
+        }
+        return strategies[self]()
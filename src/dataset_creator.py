@@ -1,59 +1,430 @@
+import contextlib
+import hashlib
+import itertools
+import json
+import time
+import tracemalloc
 import pandas as pd
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, ContextManager, Deque, Dict, Iterator, List, Optional, Tuple
 from src.training_type import TrainingType
+from src.output_format import OutputFormat
 from src.ers_preparator import ErsPreparator
 from src.hyperkvasir_preparator import HyperkvasirPreparator
 from src.splitter import DataSplitter
-from src.output_record_generator import SegmentationOutputRecordGenerator, ClassificationOutputRecordGenerator, OutputRecordGenerator
+from src.image_metadata_index import ImageMetadataIndex
+from src.output_manifest import OutputManifest
+from src.record_store import RecordStore
+from src.scan_cache import ScanCache
+from src.export_plan import ExportPlan
+from src.operation_kind import OperationKind, EXECUTION_STAGES
+from src.structs import Record, Operation
+from src.metrics import metrics, Metrics
+from src.output_record_generator import SegmentationOutputRecordGenerator, ClassificationOutputRecordGenerator, ShardOutputRecordGenerator, MemmapOutputRecordGenerator, CocoOutputRecordGenerator, OutputRecordGenerator, PlannedOutputRecordGenerator
+
+ITEMS_PER_CHUNK = 64 # Records or planned operations sent to a worker at once
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+PROGRESS_INTERVAL = 100
+
+RecordFailure = Tuple[str, str]
+RecordResult = Tuple[Optional[str], Any]
+OperationResult = Tuple[Optional[str], float]
 
 
 class DatasetCreator:
-    def __init__(self, args) -> None:
-        self.output_record_generator = DatasetCreator.__prepare_record_generator(args)
+    def __init__(self, args, metadata_index: Optional[ImageMetadataIndex] = None, computed_outputs: Optional[Dict[Tuple, str]] = None) -> None:
+        # Index of metadata and outputs computed so far can be shared with creators of other configurations
+        self.metadata_index = metadata_index if metadata_index is not None else ImageMetadataIndex(args.metadata_index_path)
+        self.computed_outputs = computed_outputs if computed_outputs is not None else {}
+        self.output_record_generator = DatasetCreator.__prepare_record_generator(args, self.metadata_index)
+        # Only files of planned records are listed, so only they can be tracked in a manifest
+        if (args.incremental or args.num_partitions > 1) and not isinstance(self.output_record_generator, PlannedOutputRecordGenerator):
+            raise ValueError(f"--incremental and --num-partitions are not supported for '{args.output_format}' output format")
         self.data_splitter = DatasetCreator.__prepare_data_splitter(args)
+        self.workers = args.workers
+        # Every partition writes records at positions K, K + N, ... of every split, its outputs are listed in its own
+        # partial manifest, merged when all partitions finish
+        self.partition = (args.partition_index, args.num_partitions)
+        self.partitioned = args.num_partitions > 1
+        self.incremental = args.incremental
+        self.manifest = OutputManifest(args.output_path, OutputManifest.options_from_args(args), self.partition if self.partitioned else None, resume=args.incremental) \
+            if args.incremental or self.partitioned else None
+        self.metrics_path = args.metrics_out
+        self.dry_run = args.dry_run
+        self.plan_path = args.plan_out
+        self.plan_stream = None
+        self.profile_memory = args.profile
 
-        self.ers_preparator = ErsPreparator(args)
+        self.ers_preparator = ErsPreparator(args, ScanCache(args.scan_cache_path))
         self.hkvs_preparator = HyperkvasirPreparator(args)
 
 
     def create(self) -> None:
-        df = self.__generate_dataframes()
-        train_df, val_df, test_df = self.data_splitter.split_and_prepare(df)
+        metrics.reset()
+        if self.profile_memory:
+            tracemalloc.start()
+        record_store = RecordStore()
+        try:
+            with metrics.measure('total'):
+                with metrics.measure('scan'):
+                    self.__scan_records(record_store)
+                    self.metadata_index.flush()
+                failures_count = self.create_from_records(record_store)
+        finally:
+            record_store.close()
+            self.metadata_index.close()
+            if self.metrics_path is not None:
+                write_metrics(self.metrics_path)
+            if self.profile_memory:
+                tracemalloc.stop()
+        if failures_count > 0:
+            raise RuntimeError(f"Failed to process {failures_count} records, see [ERROR] messages above")
+        print("Dry run finished, nothing was written" if self.dry_run else "Dataset prepared")
+
+    def create_from_records(self, record_store: RecordStore) -> int:
+        # Splits and writes records scanned before, returns the number of records that failed
+        self.plan_stream = open(self.plan_path, "w") if self.plan_path is not None else None
+        try:
+            return len(self.__create(record_store))
+        finally:
+            if self.plan_stream is not None:
+                self.plan_stream.close()
+                self.plan_stream = None
+                print(f"Plan written to {self.plan_path}")
 
-        print(f"Data of size {df.shape[0]} split to sizes: \n train_size={train_df.shape[0]} \n validation_size={val_df.shape[0]} \n test_size={test_df.shape[0]}")
+    def __create(self, record_store: RecordStore) -> List[RecordFailure]:
+        with metrics.measure('split'):
+            split_table = record_store.load_split_table()
+            train_df, val_df, test_df = self.data_splitter.split_and_prepare(split_table)
+        with metrics.measure('prepare_output'):
+            self.output_record_generator.begin_dataset(record_store.iter_all_records())
 
-        self.__fill_output_dir(train_df, 'train')
-        self.__fill_output_dir(val_df, 'validation')
-        self.__fill_output_dir(test_df, 'test')
+        print(f"Data of size {split_table.shape[0]} split to sizes: \n train_size={train_df.shape[0]} \n validation_size={val_df.shape[0]} \n test_size={test_df.shape[0]}")
 
-        print("Dataset prepared")
+        failures = []
+        splits = [(train_df, 'train'), (val_df, 'validation'), (test_df, 'test')]
+        if self.manifest is not None and not self.dry_run:
+            self.manifest.open_journal()
+        try:
+            for df, type in splits:
+                with metrics.measure(f'write_{type}'):
+                    failures += self.__fill_output_dir(record_store, df, type)
+        finally:
+            if self.manifest is not None:
+                self.manifest.close() # Journal of an interrupted run is kept to resume it
 
-    def __fill_output_dir(self, df: pd.DataFrame, type: str):
+        self.metadata_index.flush()
+        if self.manifest is not None and not self.dry_run:
+            if self.incremental:
+                removed_count = self.manifest.remove_unseen_outputs()
+                print(f"Removed {removed_count} outdated files from output dir")
+            self.manifest.save(self.__describe_partition(splits, failures) if self.partitioned else None)
+        return failures
+
+    def __describe_partition(self, splits: List[Tuple[pd.DataFrame, str]], failures: List[RecordFailure]) -> Dict:
+        # Splits are identified by digests of their frames in order, partitions of one run have to compute equal splits
+        (partition_index, partitions_count) = self.partition
+        return {
+            'index': partition_index,
+            'count': partitions_count,
+            'splits': {type: {'records': df.shape[0], 'digest': hashlib.sha1("\n".join(df['frame_path']).encode()).hexdigest()} for df, type in splits},
+            'failures': [proposed_name for proposed_name, _ in failures]}
+
+    def __fill_output_dir(self, record_store: RecordStore, df: pd.DataFrame, type: str) -> List[RecordFailure]:
         print(f"Processing images from {type} dataset")
+        self.output_record_generator.begin_split(df.shape[0], type)
+        # Records are read from the store while being written, position of a record in its split is passed along
+        ids = df['id'].tolist()
+        (partition_index, partitions_count) = self.partition
+        rows = range(partition_index, len(ids), partitions_count)
+        if self.partitioned:
+            print(f"Partition {partition_index} of {partitions_count} writes {len(rows)} of {len(ids)} images from {type} dataset")
+        records = self.__select_records_to_write(zip(rows, record_store.iter_records(ids[partition_index::partitions_count])), type)
 
-        for loop_index, data in enumerate(df.iterrows()):
-            self.output_record_generator.generate_output_record(data, type)
-        
-            if loop_index % 100 == 0 and loop_index > 0:
-                print(f"Processed {loop_index} images")
-            
+        if isinstance(self.output_record_generator, PlannedOutputRecordGenerator):
+            failures = self.__export_planned_records(records, type)
+        else:
+            failures = self.__write_records(records, type)
+
+        self.output_record_generator.end_split(type)
+        for proposed_name, error in failures:
+            print(f"[ERROR] Failed to process record {proposed_name} from {type} dataset: {error}")
         print(f"Processed all images from {type} dataset")
+        return failures
+
+    def __write_records(self, records: Iterator[Tuple[int, Record]], type: str) -> List[RecordFailure]:
+        failures = []
+        processed_count = 0
+
+        def complete(chunk: List[Tuple[int, Record]], results: List[RecordResult]) -> None:
+            nonlocal processed_count
+            failures.extend(self.__complete_records(chunk, results, type))
+            processed_count = DatasetCreator.__report_progress(processed_count, len(chunk), "images")
+
+        with self.__create_executor() as executor:
+            self.__process_chunks(executor, DatasetCreator.__chunk(records), _generate_output_records, type, complete)
+        return failures
+
+    def __export_planned_records(self, records: Iterator[Tuple[int, Record]], type: str) -> List[RecordFailure]:
+        # Whole split is planned in the main process first, metadata of images read while planning is passed to workers
+        plan = ExportPlan()
+        try:
+            with metrics.measure('plan'):
+                failures = self.__plan_records(records, plan, type)
+            self.__report_plan(plan, type)
+            if not self.dry_run:
+                with metrics.measure('execute'):
+                    failures += self.__execute_plan(plan, type)
+        finally:
+            plan.close()
+        return failures
+
+    def __plan_records(self, records: Iterator[Tuple[int, Record]], plan: ExportPlan, type: str) -> List[RecordFailure]:
+        failures = []
+        for data in records:
+            (row, record) = data
+            try:
+                operations = self.output_record_generator.plan_output_record(data, type)
+            except Exception as e:
+                failures.append((record.proposed_name, _describe_error(e)))
+                metrics.count('records_failed')
+                continue
+            outputs = self.output_record_generator.list_outputs(data, type) if self.manifest is not None else None
+            plan.add(row, record.proposed_name, self.__reuse_computed_outputs(operations), outputs)
+        return failures
+
+    def __reuse_computed_outputs(self, operations: List[Operation]) -> List[Operation]:
+        # An output equal to one computed before, e.g. a frame converted for another class or another configuration,
+        # is copied from it instead. Copies of a replaced output within the record copy its source directly, since
+        # they are executed together with the replacing copy. Replaced operations are kept as fallbacks, they compute
+        # the output when the copied one was not written, e.g. its record failed in another configuration.
+        reused_operations: Dict[str, Operation] = {}
+        reusing_operations = []
+        for operation in operations:
+            if operation.kind == OperationKind.COPY_OUTPUT and operation.src in reused_operations:
+                reused = reused_operations[operation.src]
+                fallback = Operation(reused.fallback.kind, operation.row, operation.dest, reused.fallback.src, reused.fallback.mask_reps, reused.fallback.source_bytes, reused.fallback.estimated_bytes)
+                operation = Operation(operation.kind, operation.row, operation.dest, reused.src, None, operation.source_bytes, operation.estimated_bytes, fallback)
+            key = self.output_record_generator.computed_output_key(operation)
+            if key is not None:
+                computed_path = self.computed_outputs.setdefault(key, operation.dest)
+                if computed_path != operation.dest:
+                    reused = self.output_record_generator.image_writer.plan_copy_output(computed_path, operation.dest, operation.row, operation.estimated_bytes)
+                    reused.fallback = operation
+                    reused_operations[operation.dest] = reused
+                    operation = reused
+                    metrics.count('computed_outputs_reused')
+            reusing_operations.append(operation)
+        return reusing_operations
+
+    def __report_plan(self, plan: ExportPlan, type: str) -> None:
+        print(f"Planned {plan.records_count} images from {type} dataset into {len(plan.dirs)} directories:")
+        for kind, summary in plan.summarize().items():
+            print(f" {kind:>12}: {summary['operations']:>8} operations, {summary['source_bytes'] / 2**20:>10.1f} MB of sources, ~{summary['estimated_bytes'] / 2**20:.1f} MB written")
+        if self.plan_stream is not None:
+            plan.write(self.plan_stream, type)
+
+    def __execute_plan(self, plan: ExportPlan, type: str) -> List[RecordFailure]:
+        # Directories are created once, before workers start, so they are not created again for every file.
+        # Stages of kinds are executed one after another, operations of records that already failed are skipped.
+        # A record is added to the manifest as soon as its last operation succeeds, so an interrupted run resumes
+        # from records written in any stage.
+        self.output_record_generator.create_dirs(sorted(plan.dirs))
+        errors: Dict[int, str] = {}
+        durations: Dict[int, float] = {}
+        pending_counts: Dict[int, int] = dict(plan.iter_operations_counts()) if self.manifest is not None else {}
+
+        def complete(chunk: List[Operation], results: List[OperationResult]) -> None:
+            nonlocal executed_count
+            for operation, (error, seconds) in zip(chunk, results):
+                durations[operation.row] = durations.get(operation.row, 0.0) + seconds
+                if error is not None:
+                    errors.setdefault(operation.row, error)
+                if operation.row in pending_counts:
+                    pending_counts[operation.row] -= 1
+                    if pending_counts[operation.row] == 0 and operation.row not in errors:
+                        self.manifest.add(plan.get_outputs(operation.row))
+                        del pending_counts[operation.row]
+            executed_count = DatasetCreator.__report_progress(executed_count, len(chunk), f"{stage_name} operations")
+
+        with self.__create_executor() as executor:
+            for kinds in EXECUTION_STAGES:
+                executed_count = 0
+                stage_name = ", ".join(str(kind) for kind in kinds)
+                operations = (operation for operation in plan.iter_operations(kinds) if operation.row not in errors)
+                self.__process_chunks(executor, DatasetCreator.__chunk(operations), _execute_operations, type, complete)
+
+        failures = []
+        for (row, proposed_name, outputs) in plan.iter_records():
+            metrics.observe_latency(durations.get(row, 0.0))
+            if row in errors:
+                failures.append((proposed_name, errors[row]))
+                metrics.count('records_failed')
+                continue
+            metrics.count('records_written')
+            if row in pending_counts: # Records without operations
+                self.manifest.add(outputs)
+        return failures
+
+    def __create_executor(self) -> ContextManager[Optional[ProcessPoolExecutor]]:
+        if self.workers == 1:
+            return contextlib.nullcontext()
+        self.metadata_index.flush() # Workers read entries of the main process from the index file
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.output_record_generator, self.metadata_index))
+
+    def __process_chunks(self, executor: Optional[ProcessPoolExecutor], chunks: Iterator[List], process: Callable, type: str, complete: Callable[[List, List], None]) -> None:
+        # Without workers chunks are processed in place. With workers chunks are completed in submission order, so results
+        # are committed in the same order as without workers. Number of chunks in flight is limited to keep results waiting
+        # for commit in bounded memory.
+        if executor is None:
+            for chunk in chunks:
+                complete(chunk, process(self.output_record_generator, chunk, type))
+            return
+
+        pending_chunks: Deque[Tuple[Future, List]] = deque()
+        for chunk in chunks:
+            pending_chunks.append((executor.submit(_process_in_worker, process, chunk, type), chunk))
+            if len(pending_chunks) >= self.workers * CHUNKS_IN_FLIGHT_PER_WORKER:
+                DatasetCreator.__complete_oldest_chunk(pending_chunks, complete)
+
+        while len(pending_chunks) > 0:
+            DatasetCreator.__complete_oldest_chunk(pending_chunks, complete)
+
+    @staticmethod
+    def __complete_oldest_chunk(pending_chunks: Deque[Tuple[Future, List]], complete: Callable[[List, List], None]) -> None:
+        future, chunk = pending_chunks.popleft()
+        results, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        complete(chunk, results)
+
+    @staticmethod
+    def __report_progress(processed_count: int, chunk_size: int, name: str) -> int:
+        if (processed_count + chunk_size) // PROGRESS_INTERVAL > processed_count // PROGRESS_INTERVAL:
+            print(f"Processed {processed_count + chunk_size} {name}")
+        return processed_count + chunk_size
+
+    def __select_records_to_write(self, records: Iterator[Tuple[int, Record]], type: str) -> Iterator[Tuple[int, Record]]:
+        if not self.incremental:
+            yield from records
+            return
+
+        skipped_count = 0
+        for data in records:
+            outputs = self.output_record_generator.list_outputs(data, type)
+            if self.manifest.is_up_to_date(outputs):
+                self.manifest.keep(outputs)
+                skipped_count += 1
+            else:
+                if not self.dry_run:
+                    self.manifest.remove_outputs(outputs)
+                yield data
+
+        print(f"Skipped {skipped_count} up-to-date images")
+
+    def __complete_records(self, records: List[Tuple[int, Record]], results: List[RecordResult], type: str) -> List[RecordFailure]:
+        failures = []
+        for data, (error, result) in zip(records, results):
+            if error is not None:
+                (_, record) = data
+                failures.append((record.proposed_name, error))
+                metrics.count('records_failed')
+                continue
+
+            self.output_record_generator.commit_output_record(result, type)
+            metrics.count('records_written')
+        return failures
+
+    @staticmethod
+    def __chunk(items: Iterator) -> Iterator[List]:
+        while True:
+            chunk = list(itertools.islice(items, ITEMS_PER_CHUNK))
+            if len(chunk) == 0:
+                return
+            yield chunk
 
     
-    def __generate_dataframes(self) -> pd.DataFrame:
-        return pd.concat([
-            self.ers_preparator.generate_dataframe(),
-            self.hkvs_preparator.generate_dataframe()])
+    def __scan_records(self, record_store: RecordStore) -> None:
+        for record in itertools.chain(self.ers_preparator.generate_records(), self.hkvs_preparator.generate_records()):
+            record_store.add(record)
 
     
     @staticmethod
-    def __prepare_record_generator(args) -> OutputRecordGenerator:
+    def __prepare_record_generator(args, metadata_index: ImageMetadataIndex) -> OutputRecordGenerator:
+        if args.output_format == OutputFormat.SHARDS:
+            return ShardOutputRecordGenerator(args, metadata_index)
+        if args.output_format == OutputFormat.MEMMAP:
+            return MemmapOutputRecordGenerator(args, metadata_index)
+        if args.output_format == OutputFormat.COCO:
+            return CocoOutputRecordGenerator(args, metadata_index)
         if args.training_type == TrainingType.MULTILABEL_CLASSIFICATION:
-            return ClassificationOutputRecordGenerator(args)
+            return ClassificationOutputRecordGenerator(args, metadata_index)
         else:
-            return SegmentationOutputRecordGenerator(args)
+            return SegmentationOutputRecordGenerator(args, metadata_index)
     
     @staticmethod
     def __prepare_data_splitter(args) -> DataSplitter:
         return DataSplitter(
             train_part=args.train_size,
-            val_part=args.validation_size)
\ No newline at end of file
+            val_part=args.validation_size,
+            mode=args.split_mode,
+            seed=args.split_seed,
+            import_path=args.split_in,
+            export_path=args.split_out if args.partition_index == 0 else None) # Partitions compute the same split, one writes it
+
+
+def write_metrics(metrics_path: str) -> None:
+    with open(metrics_path, "w") as stream:
+        json.dump(metrics.create_report(), stream, indent=2)
+    print(f"Metrics written to {metrics_path}")
+
+
+_worker_record_generator = None
+_worker_metadata_index = None
+
+def _init_worker(output_record_generator: OutputRecordGenerator, metadata_index: ImageMetadataIndex) -> None:
+    global _worker_record_generator, _worker_metadata_index
+    _worker_record_generator = output_record_generator
+    _worker_metadata_index = metadata_index
+    _worker_metadata_index.detach_connection()
+    metrics.reset() # Forked workers inherit metrics of the main process
+
+def _process_in_worker(process: Callable, items: List, type: str) -> Tuple[List, Metrics]:
+    results = process(_worker_record_generator, items, type)
+    _worker_metadata_index.flush()
+    return results, metrics.take()
+
+def _generate_output_records(output_record_generator: OutputRecordGenerator, records: List[Tuple[int, Record]], type: str) -> List[RecordResult]:
+    results = []
+    for data in records:
+        start = time.perf_counter()
+        try:
+            results.append((None, output_record_generator.generate_output_record(data, type)))
+        except Exception as e:
+            results.append((_describe_error(e), None))
+        metrics.observe_latency(time.perf_counter() - start)
+    return results
+
+def _execute_operations(output_record_generator: PlannedOutputRecordGenerator, operations: List[Operation], type: str) -> List[OperationResult]:
+    # Latency of a record is the sum of its operations, it is observed when all kinds are executed.
+    # Operations of a record that failed within the chunk are skipped, as in later stages.
+    results = []
+    failed_rows = set()
+    for operation in operations:
+        if operation.row in failed_rows:
+            results.append((None, 0.0))
+            continue
+        start = time.perf_counter()
+        error = None
+        try:
+            output_record_generator.execute_operation(operation)
+        except Exception as e:
+            error = _describe_error(e)
+            failed_rows.add(operation.row)
+        results.append((error, time.perf_counter() - start))
+        metrics.count(f'operations_{operation.kind}')
+    output_record_generator.image_writer.release_images()
+    return results
+
+def _describe_error(e: Exception) -> str:
+    return f"{e.__class__.__name__}: {e}"
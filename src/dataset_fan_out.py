@@ -0,0 +1,62 @@
+import tracemalloc
+from typing import Dict, List, Tuple
+from src.dataset_creator import DatasetCreator, write_metrics
+from src.ers_preparator import ErsPreparator
+from src.image_metadata_index import ImageMetadataIndex
+from src.record_store import RecordStore
+from src.metrics import metrics
+
+
+# Creates datasets of several configurations (e.g. class mapper, training type and output path) from a single scan
+# of sources. Every batch of listings of ERS data directories is mapped by the preparator of every configuration,
+# Hyperkvasir records are read from its index files by every configuration. Configurations share metadata of images
+# and outputs computed from sources, so an output equal to one written for a previous configuration is copied from it
+# by the output copy strategy.
+class DatasetFanOut:
+    def __init__(self, configs: List) -> None:
+        self.metadata_index = ImageMetadataIndex(configs[0].metadata_index_path)
+        computed_outputs: Dict[Tuple, str] = {}
+        self.creators = [DatasetCreator(args, self.metadata_index, computed_outputs) for args in configs]
+        self.output_paths = [args.output_path for args in configs]
+        # Options below are equal in all configurations
+        self.metrics_path = configs[0].metrics_out
+        self.dry_run = configs[0].dry_run
+        self.profile_memory = configs[0].profile
+
+    def create(self) -> None:
+        metrics.reset()
+        if self.profile_memory:
+            tracemalloc.start()
+        record_stores = [RecordStore() for _ in self.creators]
+        failures_count = 0
+        try:
+            with metrics.measure('total'):
+                with metrics.measure('scan'):
+                    self.__scan_records(record_stores)
+                    self.metadata_index.flush()
+                for creator, record_store, output_path in zip(self.creators, record_stores, self.output_paths):
+                    print(f"Creating dataset in {output_path}")
+                    failures_count += creator.create_from_records(record_store)
+        finally:
+            for record_store in record_stores:
+                record_store.close()
+            self.metadata_index.close()
+            if self.metrics_path is not None:
+                write_metrics(self.metrics_path)
+            if self.profile_memory:
+                tracemalloc.stop()
+        if failures_count > 0:
+            raise RuntimeError(f"Failed to process {failures_count} records, see [ERROR] messages above")
+        print("Dry run finished, nothing was written" if self.dry_run else f"Prepared {len(self.creators)} datasets")
+
+    def __scan_records(self, record_stores: List[RecordStore]) -> None:
+        ers_preparators = [creator.ers_preparator for creator in self.creators]
+        read_mask_sizes = any(not ers_preparator.use_empty_masks for ers_preparator in ers_preparators)
+        for scans in ErsPreparator.batch_scans(ers_preparators[0].scan_data_dirs(read_mask_sizes)):
+            for ers_preparator, record_store in zip(ers_preparators, record_stores):
+                for record in ers_preparator.create_records(scans):
+                    record_store.add(record)
+
+        for creator, record_store in zip(self.creators, record_stores):
+            for record in creator.hkvs_preparator.generate_records():
+                record_store.add(record)
@@ -1,88 +1,206 @@
-import pandas as pd
 import os
-import yaml
-from typing import List, Dict
-from src.mask_data_merger import MaskDataMerger
-from src.structs import UnmergedMaskData
-from src.class_mappers import AbstractClassMapper, DummyClassMapper, DictClassMapper
+import itertools
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+from src.mask_data_merger import MaskDataMerger, MaskTable, expand_lists
+from src.structs import MergedMaskData, Record
+from src.scan_cache import ScanCache, DirsState
+from src.metrics import metrics
+from src.class_mappers import load_class_mapper
+
+SCAN_THREADS = 8
+DIRS_IN_FLIGHT_PER_THREAD = 4
+SCAN_BATCH_SIZE = 50000 # Frames and masks mapped at once
+
+# Sorted names of frames of a data directory and of its masks, each mask with a flag of empty file
+DataDirScan = Tuple[List[str], List[Tuple[str, bool]]]
+
 
 class ErsPreparator:
 
-    def __init__(self, args) -> None:
+    def __init__(self, args, scan_cache: ScanCache) -> None:
         self.dataset_path = args.ers_path
-        self.class_mapper = ErsPreparator.__create_class_mapper(args.ers_class_mapper_path)
+        self.class_mapper = load_class_mapper(args.ers_class_mapper_path)
         self.use_seq = args.ers_use_seq
         self.use_empty_masks = args.ers_use_empty_masks
         self.mask_data_merger = MaskDataMerger(args)
+        self.scan_cache = scan_cache
         self.acceptable_empty_mask_file_classes = ['h01', 'h02', 'h03', 'h04', 'h05', 'h06', 'h07', 'b02']
         
-    def generate_dataframe(self) -> pd.DataFrame:
+    def generate_records(self) -> Iterator[Record]:
+        for scans in ErsPreparator.batch_scans(self.scan_data_dirs()):
+            yield from self.create_records(scans)
+
+    def scan_data_dirs(self, read_mask_sizes: Optional[bool] = None) -> Iterator[Tuple[str, Optional[DataDirScan]]]:
+        # Listings do not depend on the class mapper nor on the training type, so one scan can be mapped by preparators
+        # of several configurations. Sizes of masks are read when any of them skips empty masks.
         if not self.dataset_path:
-            return pd.DataFrame()
-
-        data = []
-        for patient_dir in self.__list_dirs(self.dataset_path):
-            patient_id = os.path.basename(patient_dir)
-            for data_dir in self.__get_data_dirs(patient_dir, self.use_seq):
-                data_dir_basename = os.path.basename(data_dir)
-
-                frames_dir = os.path.join(data_dir, "frames")
-                labels_dir = os.path.join(data_dir, "labels")
-                if not os.path.isdir(labels_dir):
-                    continue
-
-                frames_paths = self.__list_files(frames_dir)
-                masks_paths = self.__list_files(labels_dir)
-
-                for frame_path in frames_paths:
-                    frame_name = os.path.splitext(os.path.basename(frame_path))[0]
-                    masks_for_frame = [mask_path for mask_path in masks_paths if os.path.basename(mask_path).startswith(frame_name)]
-                    unmapped_masks_data = self.__create_masks_data(masks_for_frame)
-
-                    merged_mask_data = self.mask_data_merger.merge(masks_data=unmapped_masks_data, mapper=self.class_mapper)
-                    if merged_mask_data is not None:
-                        data.append({
-                            'dataset': 'ers',
-                            'patient_id': patient_id,
-                            'frame_path': frame_path,
-                            'proposed_name': f"{patient_id}_{data_dir_basename}_{frame_name}.png",
-                            'mask_data': merged_mask_data
-                        })
-
-        return pd.DataFrame(data)
-
-    def __create_masks_data(self, masks_paths: List[str]) -> List[UnmergedMaskData]:
-        unmapped_mask_data = []
-        for mask_path in masks_paths:
-            mask_classes = self.__extract_classes_from_mask_name(mask_path)
-
-            for mask_class in mask_classes:
-                unmapped_mask_data.append(UnmergedMaskData(mask_class, mask_path))
-        return unmapped_mask_data
-
-
-    def __extract_classes_from_mask_name(self, mask_path: str) -> List[str]:
-        mask_basename = os.path.basename(mask_path)
-        mask_name_without_extension = os.path.splitext(mask_basename)[0]
-        class_names = [class_name for class_name in mask_name_without_extension.split('_') if len(class_name) == 3]
-        if self.use_empty_masks or os.path.getsize(mask_path) != 0:
-            return class_names
-        return [class_name for class_name in class_names if class_name in self.acceptable_empty_mask_file_classes]
-
-    def __get_data_dirs(self, patient_dir: str, use_seq: bool) -> List[str]:
-        if use_seq:
+            return
+        if read_mask_sizes is None:
+            read_mask_sizes = not self.use_empty_masks
+
+        with ThreadPoolExecutor(max_workers=SCAN_THREADS) as executor:
+            for data_dir, scan in self.__scan_data_dirs(executor, read_mask_sizes):
+                if scan is not None:
+                    metrics.count('data_dirs_scanned')
+                    metrics.count('frames_scanned', len(scan[0]))
+                yield data_dir, scan
+
+    @staticmethod
+    def batch_scans(scans: Iterator[Tuple[str, Optional[DataDirScan]]]) -> Iterator[List[Tuple[str, Optional[DataDirScan]]]]:
+        # Scans are mapped in batches of directories with at least SCAN_BATCH_SIZE frames and masks, so array operations
+        # run on large tables while records are still streamed
+        batch = []
+        batch_size = 0
+        for data_dir, scan in scans:
+            batch.append((data_dir, scan))
+            batch_size += len(scan[0]) + len(scan[1]) if scan is not None else 0
+            if batch_size >= SCAN_BATCH_SIZE:
+                yield batch
+                batch = []
+                batch_size = 0
+        if len(batch) > 0:
+            yield batch
+
+    def create_records(self, scans: List[Tuple[str, Optional[DataDirScan]]]) -> Iterator[Record]:
+        # Frames and masks of all directories of the batch are numbered, class codes are parsed once per mask.
+        # Mapping, dropping of ambiguous masks and grouping by class are done by the merger on the whole table.
+        frames: List[Tuple[str, str, str]] = [] # (data dir, frame file name, frame name)
+        mask_paths: List[str] = []
+        mask_empty_flags: List[bool] = []
+        mask_code_offsets = [0]
+        mask_code_ids: List[int] = []
+        code_ids: Dict[str, int] = {}
+        pair_frames: List[int] = []
+        pair_masks: List[int] = []
+
+        for data_dir, scan in scans:
+            if scan is None:
+                continue
+            (frame_names, masks) = scan
+            labels_prefix = os.path.join(data_dir, "labels", "")
+            (masks_by_frame_name, mask_codes) = self.__index_masks_by_frame_name(masks, len(mask_paths))
+            for (mask_name, is_empty), codes in zip(masks, mask_codes):
+                mask_paths.append(labels_prefix + mask_name)
+                mask_empty_flags.append(is_empty)
+                mask_code_ids.extend(code_ids.setdefault(code, len(code_ids)) for code in codes)
+                mask_code_offsets.append(len(mask_code_ids))
+
+            for frame_file_name in frame_names:
+                frame_name = os.path.splitext(frame_file_name)[0]
+                for mask in masks_by_frame_name.get(frame_name, []):
+                    pair_frames.append(len(frames))
+                    pair_masks.append(mask)
+                frames.append((data_dir, frame_file_name, frame_name))
+
+        with metrics.measure('map_merge'):
+            merged_mask_data = self.__map_and_merge(frames, mask_paths, mask_empty_flags, mask_code_offsets, mask_code_ids, code_ids, pair_frames, pair_masks)
+
+        for (data_dir, frame_file_name, frame_name), frame_mask_data in zip(frames, merged_mask_data):
+            if frame_mask_data is not None:
+                patient_id = os.path.basename(os.path.dirname(data_dir))
+                yield Record(
+                    dataset='ers',
+                    patient_id=patient_id,
+                    frame_path=os.path.join(data_dir, "frames", frame_file_name),
+                    proposed_name=f"{patient_id}_{os.path.basename(data_dir)}_{frame_name}.png",
+                    mask_data=frame_mask_data)
+
+    def __map_and_merge(self, frames: List, mask_paths: List[str], mask_empty_flags: List[bool], mask_code_offsets: List[int], mask_code_ids: List[int], code_ids: Dict[str, int], pair_frames: List[int], pair_masks: List[int]) -> List[Optional[List[MergedMaskData]]]:
+        pair_masks = np.array(pair_masks, dtype=np.int64)
+        (row_pairs, row_codes) = expand_lists(np.array(mask_code_offsets, dtype=np.int64), np.array(mask_code_ids, dtype=np.int64), pair_masks, np.arange(len(pair_masks)))
+
+        codes = list(code_ids)
+        if not self.use_empty_masks:
+            # Codes of empty mask files are used only for classes acceptable as empty
+            is_acceptable = np.array([code in self.acceptable_empty_mask_file_classes for code in codes], dtype=bool)
+            is_empty = np.array(mask_empty_flags, dtype=bool)
+            kept_rows = ~is_empty[pair_masks[row_pairs]] | is_acceptable[row_codes]
+            (row_pairs, row_codes) = (row_pairs[kept_rows], row_codes[kept_rows])
+
+        table = MaskTable(len(frames), mask_paths, np.array(pair_frames, dtype=np.int64), pair_masks, row_pairs, row_codes)
+        return self.mask_data_merger.merge(table, self.class_mapper.compile(codes))
+
+    def __scan_data_dirs(self, executor: ThreadPoolExecutor, read_mask_sizes: bool) -> Iterator[Tuple[str, Optional[DataDirScan]]]:
+        # Directories are listed concurrently, which hides latency of metadata calls e.g. on network filesystems.
+        # Scans are consumed in sorted order of directories, so records always come out in the same order.
+        # Cached scans are looked up in this thread, since the cache connection is not shared between threads.
+        patient_dirs = self.__list_dirs(self.dataset_path)
+        data_dirs = itertools.chain.from_iterable(executor.map(self.__get_data_dirs, patient_dirs))
+
+        pending_scans: Deque[Tuple[str, Future]] = deque()
+        for data_dir in data_dirs:
+            pending_scans.append((data_dir, executor.submit(self.__scan_data_dir, data_dir, self.scan_cache.get(data_dir), read_mask_sizes)))
+            if len(pending_scans) >= SCAN_THREADS * DIRS_IN_FLIGHT_PER_THREAD:
+                yield self.__complete_oldest_scan(pending_scans)
+
+        while len(pending_scans) > 0:
+            yield self.__complete_oldest_scan(pending_scans)
+        self.scan_cache.flush()
+
+    def __complete_oldest_scan(self, pending_scans: Deque[Tuple[str, Future]]) -> Tuple[str, Optional[DataDirScan]]:
+        # Metrics and cache are updated in this thread only
+        (data_dir, future) = pending_scans.popleft()
+        (scan, is_cached, state) = future.result()
+        if self.scan_cache.cache_path is not None:
+            metrics.count('scan_cache_hits' if is_cached else 'scan_cache_misses')
+        if state is not None:
+            self.scan_cache.put(data_dir, state, scan)
+        return data_dir, scan
+
+    def __scan_data_dir(self, data_dir: str, cached_scan: Optional[Tuple[DirsState, Optional[DataDirScan]]], read_mask_sizes: bool) -> Tuple[Optional[DataDirScan], bool, Optional[DirsState]]:
+        # Returns the scan, whether it comes from the cache and the state of directories to cache a new scan with.
+        # State is read before listing, so changes made during the scan invalidate it in the next run.
+        frames_dir = os.path.join(data_dir, "frames")
+        labels_dir = os.path.join(data_dir, "labels")
+        scan_start_ns = time.time_ns()
+        state = ScanCache.read_state([frames_dir, labels_dir]) if self.scan_cache.cache_path is not None else None
+        if cached_scan is not None and cached_scan[0] == state:
+            return cached_scan[1], True, None
+        if state is not None and not ScanCache.is_stable(state, scan_start_ns):
+            state = None
+
+        if not os.path.isdir(labels_dir):
+            return None, False, state
+        return (self.__list_files(frames_dir), self.__list_masks(labels_dir, read_sizes=state is not None or read_mask_sizes)), False, state
+
+    def __list_masks(self, labels_dir: str, read_sizes: bool) -> List[Tuple[str, bool]]:
+        # Sizes are read only when empty masks are skipped or the scan is cached, so a cached scan can be used with any options
+        masks = []
+        with os.scandir(labels_dir) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_file():
+                    masks.append((entry.name, read_sizes and entry.stat().st_size == 0))
+        return masks
+
+    def __index_masks_by_frame_name(self, masks: List[Tuple[str, bool]], first_mask: int) -> Tuple[Dict[str, List[int]], List[List[str]]]:
+        # Mask names have the form {frame_name}_{class}_{class}...; the mask is indexed under every
+        # '_'-separated prefix so frame names containing '_' are matched as well. Class codes are the
+        # 3 characters long parts of the name, they are returned for every mask.
+        masks_by_frame_name = {}
+        mask_codes = []
+        for mask, (mask_name, _) in enumerate(masks, start=first_mask):
+            name_parts = os.path.splitext(mask_name)[0].split('_')
+            prefix = None
+            for name_part in name_parts:
+                prefix = name_part if prefix is None else f"{prefix}_{name_part}"
+                masks_by_frame_name.setdefault(prefix, []).append(mask)
+            mask_codes.append([name_part for name_part in name_parts if len(name_part) == 3])
+        return masks_by_frame_name, mask_codes
+
+    def __get_data_dirs(self, patient_dir: str) -> List[str]:
+        if self.use_seq:
             return self.__list_dirs(patient_dir)
         return [os.path.join(patient_dir, "samples")]
 
+    # Entry types come from the directory listing itself, no additional stat call per entry is needed
     def __list_dirs(self, path: str) -> List[str]:
-        return [os.path.join(path, dirname) for dirname in os.listdir(path) if os.path.isdir(os.path.join(path, dirname))]
+        with os.scandir(path) as entries:
+            return sorted(entry.path for entry in entries if entry.is_dir())
 
     def __list_files(self, path: str) -> List[str]:
-        return [os.path.join(path, dirname) for dirname in os.listdir(path) if os.path.isfile(os.path.join(path, dirname))]
-
-    @staticmethod
-    def __create_class_mapper(class_mapper_path: str) -> AbstractClassMapper: 
-        if class_mapper_path is None:
-            return DummyClassMapper()
-        with open(class_mapper_path, "r") as stream:
-            return DictClassMapper(yaml.safe_load(stream))
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries if entry.is_file())
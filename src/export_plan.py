@@ -0,0 +1,114 @@
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+from typing import Dict, Iterator, List, Optional, Set, TextIO, Tuple
+from src.operation_kind import OperationKind, EXECUTION_STAGES
+from src.structs import Operation, RecordOutput
+
+PENDING_OPERATIONS_LIMIT = 1000
+
+
+# Operations planned for records of a split are spilled to a temporary SQLite file, like scanned records,
+# and read back grouped by kind. Only directories of outputs are kept in memory, to create them up front.
+class ExportPlan:
+    def __init__(self) -> None:
+        self.directory = tempfile.TemporaryDirectory(prefix="endoscopy-plan-")
+        self.connection = sqlite3.connect(os.path.join(self.directory.name, "plan.sqlite"))
+        self.connection.execute(
+            "CREATE TABLE operations (id INTEGER PRIMARY KEY, kind TEXT, row INTEGER, dest TEXT, src TEXT, mask_reps BLOB, source_bytes INTEGER, estimated_bytes INTEGER, fallback BLOB)")
+        self.connection.execute("CREATE INDEX operations_kind ON operations (kind, id)")
+        self.connection.execute("CREATE TABLE records (row INTEGER PRIMARY KEY, proposed_name TEXT, operations_count INTEGER, outputs BLOB)")
+        self.pending_operations: List[Tuple] = []
+        self.pending_records: List[Tuple] = []
+        self.dirs: Set[str] = set()
+        self.records_count = 0
+
+    def add(self, row: int, proposed_name: str, operations: List[Operation], outputs: Optional[List[RecordOutput]]) -> None:
+        for operation in operations:
+            self.pending_operations.append((
+                str(operation.kind),
+                operation.row,
+                operation.dest,
+                operation.src,
+                pickle.dumps(operation.mask_reps, protocol=pickle.HIGHEST_PROTOCOL) if operation.mask_reps is not None else None,
+                operation.source_bytes,
+                operation.estimated_bytes,
+                pickle.dumps(operation.fallback, protocol=pickle.HIGHEST_PROTOCOL) if operation.fallback is not None else None))
+            self.dirs.add(os.path.dirname(operation.dest))
+        self.pending_records.append((row, proposed_name, len(operations), pickle.dumps(outputs, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.records_count += 1
+        if len(self.pending_operations) >= PENDING_OPERATIONS_LIMIT:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO operations (kind, row, dest, src, mask_reps, source_bytes, estimated_bytes, fallback) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self.pending_operations)
+            self.connection.executemany("INSERT INTO records (row, proposed_name, operations_count, outputs) VALUES (?, ?, ?, ?)", self.pending_records)
+        self.pending_operations = []
+        self.pending_records = []
+
+    def iter_operations(self, kinds: List[OperationKind]) -> Iterator[Operation]:
+        # Operations of given kinds are yielded in the order they were planned, i.e. record by record
+        self.flush()
+        rows = self.connection.execute(
+            f"SELECT kind, row, dest, src, mask_reps, source_bytes, estimated_bytes, fallback FROM operations WHERE kind IN ({', '.join('?' * len(kinds))}) ORDER BY id",
+            [str(kind) for kind in kinds])
+        for row in rows:
+            yield ExportPlan.__to_operation(row)
+
+    def iter_records(self) -> Iterator[Tuple[int, str, Optional[List[RecordOutput]]]]:
+        self.flush()
+        for (row, proposed_name, outputs) in self.connection.execute("SELECT row, proposed_name, outputs FROM records ORDER BY row"):
+            yield (row, proposed_name, pickle.loads(outputs))
+
+    def iter_operations_counts(self) -> Iterator[Tuple[int, int]]:
+        self.flush()
+        yield from self.connection.execute("SELECT row, operations_count FROM records ORDER BY row")
+
+    def get_outputs(self, row: int) -> Optional[List[RecordOutput]]:
+        self.flush()
+        (outputs,) = self.connection.execute("SELECT outputs FROM records WHERE row = ?", (row,)).fetchone()
+        return pickle.loads(outputs)
+
+    def summarize(self) -> Dict[str, Dict[str, int]]:
+        self.flush()
+        totals = {
+            kind: (count, source_bytes, estimated_bytes)
+            for (kind, count, source_bytes, estimated_bytes) in self.connection.execute(
+                "SELECT kind, COUNT(*), SUM(source_bytes), SUM(estimated_bytes) FROM operations GROUP BY kind")}
+        summary = {}
+        for kind in OperationKind.list():
+            (count, source_bytes, estimated_bytes) = totals.get(kind, (0, 0, 0))
+            summary[kind] = {'operations': count, 'source_bytes': source_bytes, 'estimated_bytes': estimated_bytes}
+        return summary
+
+    def write(self, stream: TextIO, type: str) -> None:
+        # One JSON object per operation, in the order of execution
+        for kinds in EXECUTION_STAGES:
+            for operation in self.iter_operations(kinds):
+                entry = {
+                    'split': type,
+                    'kind': str(operation.kind),
+                    'row': operation.row,
+                    'src': operation.src,
+                    'dest': operation.dest,
+                    'source_bytes': operation.source_bytes,
+                    'estimated_bytes': operation.estimated_bytes
+                }
+                if operation.mask_reps is not None:
+                    entry['masks'] = [mask_repr.mask_path if not mask_repr.is_of_color() else mask_repr.color.name.lower() for mask_repr in operation.mask_reps]
+                stream.write(json.dumps(entry) + "\n")
+
+    def close(self) -> None:
+        self.connection.close()
+        self.directory.cleanup()
+
+    @staticmethod
+    def __to_operation(row: Tuple) -> Operation:
+        (kind, record_row, dest, src, mask_reps, source_bytes, estimated_bytes, fallback) = row
+        return Operation(OperationKind(kind), record_row, dest, src, pickle.loads(mask_reps) if mask_reps is not None else None, source_bytes, estimated_bytes,
+                         pickle.loads(fallback) if fallback is not None else None)
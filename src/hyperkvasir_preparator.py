@@ -1,38 +1,135 @@
-import pandas as pd
+import csv
+import json
 import os
-from typing import List
-from src.structs import MergedMaskData, MaskRepresentation
+from typing import Iterator, List, Set, Tuple
+from src.class_mappers import load_class_mapper
+from src.training_type import TrainingType
+from src.structs import MergedMaskData, MaskRepresentation, MaskColor, Record
+from src.metrics import metrics
 
+LABELS_INDEX_NAME = "image-labels.csv"
+BOUNDING_BOXES_INDEX_NAME = "bounding-boxes.json"
+LABELS_INDEX_COLUMNS = ['Video file', 'Organ', 'Finding', 'Classification']
+IMAGE_EXTENSION = ".jpg"
+SEGMENTED_IMAGE_LABEL = 'polyp' # Label of segmented images without labeled bounding boxes
 
+
+# Images are found through metadata files of the dataset instead of walking its tree:
+# labeled-images/image-labels.csv lists labeled images (image id, organ, finding and its category), an image is stored
+# at labeled-images/(organ)-tract/(category)/(finding)/(image id).jpg, e.g. lower-gi-tract/pathological-findings/polyps;
+# segmented-images/bounding-boxes.json lists segmented images (image id, size and labeled boxes of polyps), the image
+# and its mask are segmented-images/images/(image id).jpg and segmented-images/masks/(image id).jpg.
+# Findings and box labels are mapped like ERS class codes. Only files of entries with mapped classes are checked.
 class HyperkvasirPreparator:
 
     def __init__(self, args) -> None:
         self.dataset_path = args.hyperkvasir_path
+        self.class_mapper = load_class_mapper(args.hyperkvasir_class_mapper_path)
+        self.binary = args.training_type == TrainingType.BINARY_SEG
+        # Labeled images have no masks, so they are used only for classification
+        self.use_labeled_images = args.training_type == TrainingType.MULTILABEL_CLASSIFICATION
 
-    def generate_dataframe(self) -> pd.DataFrame:
+    def generate_records(self) -> Iterator[Record]:
         if not self.dataset_path:
-            return pd.DataFrame()
+            return
+
+        labeled_names: Set[str] = set()
+        if self.use_labeled_images:
+            for record in self.__generate_labeled_records():
+                labeled_names.add(record.proposed_name)
+                yield record
+
+        # A segmented image that is also labeled is used once, with classes of its label
+        for record in self.__generate_segmented_records():
+            if record.proposed_name not in labeled_names:
+                yield record
+
+    def __generate_labeled_records(self) -> Iterator[Record]:
+        labeled_images_path = os.path.join(self.dataset_path, "labeled-images")
+        index_path = os.path.join(labeled_images_path, LABELS_INDEX_NAME)
+        if not os.path.isfile(index_path):
+            print(f"[WARN] Skipping Hyperkvasir labeled images. Index {index_path} not found.")
+            return
+
+        for (image_id, organ, finding, category) in self.__read_labels_index(index_path):
+            classes = self.class_mapper.map(finding)
+            if len(classes) == 0:
+                continue
+            file_name = image_id + IMAGE_EXTENSION
+            frame_path = os.path.join(labeled_images_path, self.__get_organ_dir(organ), category, finding, file_name)
+            if not self.__files_exist([frame_path]):
+                continue
+            yield Record(
+                dataset='hyperkvasir',
+                patient_id=None,
+                frame_path=frame_path,
+                proposed_name=file_name,
+                mask_data=[MergedMaskData(class_name, []) for class_name in classes])
 
+    def __generate_segmented_records(self) -> Iterator[Record]:
         segmented_images_path = os.path.join(self.dataset_path, "segmented-images")
         masks_path = os.path.join(segmented_images_path, "masks")
         images_path = os.path.join(segmented_images_path, "images")
 
-        images = self.__list_files(images_path)
-        masks = self.__list_files(masks_path)
-        filenames = list(set(masks).intersection(images))
-
-        data = []
-        for filename in filenames:
-            data.append({
-                'dataset': 'hyperkvasir',
-                'patient_id': None,
-                'frame_path': os.path.join(images_path, filename),
-                'proposed_name': filename,
-                'mask_data': [MergedMaskData('polyp', [MaskRepresentation.of_path(os.path.join(masks_path, filename))])]
-            })
-            
-        return pd.DataFrame(data)
+        for (file_name, labels) in self.__read_segmented_index(segmented_images_path, images_path, masks_path):
+            classes = list(dict.fromkeys(class_name for label in labels for class_name in self.class_mapper.map(label)))
+            if len(classes) == 0:
+                continue
+            frame_path = os.path.join(images_path, file_name)
+            mask_path = os.path.join(masks_path, file_name)
+            if not self.__files_exist([frame_path, mask_path]):
+                continue
+            mask = MaskRepresentation.of_path(mask_path)
+            yield Record(
+                dataset='hyperkvasir',
+                patient_id=None,
+                frame_path=frame_path,
+                proposed_name=file_name,
+                mask_data=[MergedMaskData(class_name, [mask if not self.binary or self.class_mapper.is_positive(class_name) else MaskRepresentation.of_color(MaskColor.BLACK)])
+                           for class_name in classes])
+
+    def __read_labels_index(self, index_path: str) -> Iterator[Tuple[str, str, str, str]]:
+        with open(index_path, "r", newline='') as stream:
+            reader = csv.DictReader(stream)
+            missing_columns = [column for column in LABELS_INDEX_COLUMNS if column not in (reader.fieldnames or [])]
+            if len(missing_columns) > 0:
+                raise ValueError(f"Hyperkvasir index {index_path} has no columns {missing_columns}")
+            for row in reader:
+                metrics.count('hyperkvasir_entries_indexed')
+                yield tuple(row[column].strip() for column in LABELS_INDEX_COLUMNS)
+
+    def __read_segmented_index(self, segmented_images_path: str, images_path: str, masks_path: str) -> List[Tuple[str, List[str]]]:
+        # File names of segmented images with labels of their boxes, sorted by name.
+        # Without the index file, images that have a mask of the same name are listed.
+        index_path = os.path.join(segmented_images_path, BOUNDING_BOXES_INDEX_NAME)
+        if not os.path.isfile(index_path):
+            images = self.__list_files(images_path)
+            masks = self.__list_files(masks_path)
+            return [(file_name, [SEGMENTED_IMAGE_LABEL]) for file_name in sorted(set(masks).intersection(images))]
+
+        with open(index_path, "r") as stream:
+            index = json.load(stream)
+        metrics.count('hyperkvasir_entries_indexed', len(index))
+        segmented_images = []
+        for image_id in sorted(index):
+            labels = list(dict.fromkeys(box['label'] for box in index[image_id].get('bbox', [])))
+            segmented_images.append((image_id + IMAGE_EXTENSION, labels if len(labels) > 0 else [SEGMENTED_IMAGE_LABEL]))
+        return segmented_images
+
+    def __files_exist(self, paths: List[str]) -> bool:
+        for path in paths:
+            metrics.count('file_stats')
+            if not os.path.isfile(path):
+                print(f"[WARN] Skipping Hyperkvasir image. File {path} listed in the index not found.")
+                return False
+        return True
+
+    @staticmethod
+    def __get_organ_dir(organ: str) -> str:
+        # Organs in the index are named e.g. "Lower GI", their directories e.g. "lower-gi-tract"
+        organ_dir = organ.lower().replace(' ', '-')
+        return organ_dir if organ_dir.endswith('-tract') else f"{organ_dir}-tract"
 
     def __list_files(self, path: str) -> List[str]:
-        return [filename for filename in os.listdir(path) if os.path.isfile(os.path.join(path, filename))]
-        
\ No newline at end of file
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_file()]
@@ -0,0 +1,30 @@
+import json
+import os
+from typing import Any, BinaryIO, Dict, Optional, Union
+from PIL import Image
+from src.metrics import metrics
+
+# Lossless WebP with the lowest effort is the fastest lossless encoder of frames, at a size close to PNG,
+# see benchmarks/encode_benchmark.py
+WEBP_LOSSLESS_PARAMS = {'lossless': True, 'quality': 0, 'method': 0}
+
+
+# Images are saved in the format given by extension of the destination, with parameters of its encoder.
+# Formats without parameters are saved with PIL defaults.
+class ImageEncoder:
+    def __init__(self, png_compress_level: Optional[int] = None) -> None:
+        self.params: Dict[str, Dict[str, Any]] = {'WEBP': WEBP_LOSSLESS_PARAMS}
+        if png_compress_level is not None:
+            self.params['PNG'] = {'compress_level': png_compress_level}
+
+    def save(self, img: Image.Image, fp: Union[str, BinaryIO], format: str) -> None:
+        img.save(fp, format=format, **self.params.get(format, {}))
+        metrics.count('image_encodes')
+
+    # Encoders with equal keys write equal files of equal images
+    def key(self) -> str:
+        return json.dumps(self.params, sort_keys=True)
+
+    @staticmethod
+    def format_of(path: str) -> Optional[str]:
+        return Image.registered_extensions().get(os.path.splitext(path)[1].lower())
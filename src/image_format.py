@@ -0,0 +1,13 @@
+from src.extended_enum import ExtendedEnum
+
+
+class ImageFormat(ExtendedEnum):
+    PNG = "png"
+    WEBP = "webp"
+
+    def __str__(self):
+        return self.value.lower()
+
+    @property
+    def extension(self) -> str:
+        return f".{self.value}"
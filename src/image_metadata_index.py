@@ -0,0 +1,124 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from PIL import Image, UnidentifiedImageError
+from src.metrics import metrics
+
+PENDING_ENTRIES_LIMIT = 1000
+CACHED_ENTRIES_LIMIT = 10000 # Recently used entries kept in memory, e.g. masks shared by frames of a batch
+
+
+class ImageMetadata:
+    __slots__ = ('width', 'height', 'mode', 'byte_size', 'mtime_ns')
+
+    def __init__(self, width: Optional[int], height: Optional[int], mode: Optional[str], byte_size: int, mtime_ns: int) -> None:
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.byte_size = byte_size
+        self.mtime_ns = mtime_ns
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return (self.width, self.height)
+
+    def is_empty_file(self) -> bool:
+        return self.byte_size == 0
+
+    def is_image(self) -> bool:
+        return self.mode is not None
+
+
+# Entries are read from image headers only and reused across runs as long as file size and mtime did not change.
+# Only recently used entries are kept in memory, others are read back from SQLite, so memory does not grow with the
+# number of images. Without an index path entries are kept in a temporary file for a single run, it is shared with
+# workers, so a header read by the main process or any worker is not read again.
+class ImageMetadataIndex:
+    def __init__(self, index_path: Optional[str]) -> None:
+        self.is_persistent = index_path is not None
+        self.directory = tempfile.mkdtemp(prefix="endoscopy-metadata-") if index_path is None else None
+        self.index_path = index_path if index_path is not None else os.path.join(self.directory, "metadata.sqlite")
+        self.entries: OrderedDict[str, ImageMetadata] = OrderedDict()
+        self.pending_entries: Dict[str, ImageMetadata] = {}
+        self.connection = None
+
+    def get(self, path: str) -> ImageMetadata:
+        key = os.path.abspath(path)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        # Entries of a temporary index were read in this run, only entries kept between runs are validated
+        metadata = self.pending_entries.get(key) or self.__load_entry(key)
+        if metadata is None or self.is_persistent:
+            stat = os.stat(key)
+            metrics.count('file_stats')
+            if metadata is None or metadata.byte_size != stat.st_size or metadata.mtime_ns != stat.st_mtime_ns:
+                metadata = ImageMetadataIndex.__read_metadata(key, stat)
+                self.pending_entries[key] = metadata
+                if len(self.pending_entries) >= PENDING_ENTRIES_LIMIT:
+                    self.flush()
+
+        self.entries[key] = metadata
+        if len(self.entries) > CACHED_ENTRIES_LIMIT:
+            self.entries.popitem(last=False)
+        return metadata
+
+    def flush(self) -> None:
+        if len(self.pending_entries) == 0:
+            return
+        connection = self.__connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO images (path, width, height, mode, byte_size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, m.width, m.height, m.mode, m.byte_size, m.mtime_ns) for path, m in self.pending_entries.items()])
+        self.pending_entries = {}
+
+    def close(self) -> None:
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def detach_connection(self) -> None:
+        # A forked worker inherits the connection and the temporary directory of the main process, it opens its own
+        # connection and leaves the directory to the main process
+        self.connection = None
+        self.directory = None
+
+    def __load_entry(self, key: str) -> Optional[ImageMetadata]:
+        row = self.__connect().execute("SELECT width, height, mode, byte_size, mtime_ns FROM images WHERE path = ?", (key,)).fetchone()
+        return ImageMetadata(*row) if row is not None else None
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.index_path, timeout=60)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, width INTEGER, height INTEGER, mode TEXT, byte_size INTEGER, mtime_ns INTEGER)")
+        return self.connection
+
+    def __getstate__(self) -> Dict:
+        # SQLite connections cannot be shared between processes, workers open their own one.
+        # The temporary file is removed by the main process only.
+        self.flush()
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['directory'] = None
+        return state
+
+    @staticmethod
+    def __read_metadata(path: str, stat: os.stat_result) -> ImageMetadata:
+        if stat.st_size == 0:
+            return ImageMetadata(None, None, None, stat.st_size, stat.st_mtime_ns)
+        metrics.count('image_header_reads')
+        try:
+            with Image.open(path) as img:
+                return ImageMetadata(img.width, img.height, img.mode, stat.st_size, stat.st_mtime_ns)
+        except UnidentifiedImageError:
+            return ImageMetadata(None, None, None, stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,129 @@
+import io
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from PIL import Image
+from src.copy_strategy import AbstractCopyStrategy
+from src.image_encoder import ImageEncoder
+from src.metrics import metrics
+from src.record_images import RecordImages
+
+
+class AbstractImageOutput(ABC):
+    @abstractmethod
+    def prepare(self, dest: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def copy_source(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def copy_output(self, src: str, dest: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, img: Image.Image, dest: str) -> None:
+        raise NotImplementedError
+
+    def retain(self, dest: str) -> None:
+        pass
+
+
+class FileImageOutput(AbstractImageOutput):
+    def __init__(self, copy_strategy: AbstractCopyStrategy, output_copy_strategy: AbstractCopyStrategy, encoder: ImageEncoder) -> None:
+        self.copy_strategy = copy_strategy
+        self.output_copy_strategy = output_copy_strategy
+        self.encoder = encoder
+        self.created_dirs: Set[str] = set()
+
+    def prepare(self, dest: str) -> None:
+        self.create_dirs([os.path.dirname(dest)])
+
+    def create_dirs(self, dirs: Iterable[str]) -> None:
+        # Every directory is created once per process, directories created up front are not touched again
+        for dir in dirs:
+            if dir not in self.created_dirs:
+                os.makedirs(dir, exist_ok=True)
+                self.created_dirs.add(dir)
+                metrics.count('dirs_created')
+
+    def copy_source(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        self.copy_strategy.copy(src, dest, byte_size)
+
+    def copy_output(self, src: str, dest: str) -> None:
+        self.output_copy_strategy.copy(os.path.abspath(src), dest)
+
+    def save(self, img: Image.Image, dest: str) -> None:
+        self.encoder.save(img, dest, ImageEncoder.format_of(dest))
+        metrics.count('bytes_written', os.path.getsize(dest))
+
+
+# Keeps encoded files of a single record in memory until they are taken, e.g. to be written into an archive
+class MemoryImageOutput(AbstractImageOutput):
+    def __init__(self, encoder: ImageEncoder) -> None:
+        self.encoder = encoder
+        self.files: Dict[str, bytes] = {}
+        self.retained_files: Dict[str, bytes] = {}
+
+    def prepare(self, dest: str) -> None:
+        pass
+
+    def copy_source(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        with open(src, "rb") as stream:
+            self.files[dest] = stream.read()
+        metrics.count('bytes_read', len(self.files[dest]))
+
+    def copy_output(self, src: str, dest: str) -> None:
+        self.files[dest] = self.files[src] if src in self.files else self.retained_files[src]
+
+    def save(self, img: Image.Image, dest: str) -> None:
+        stream = io.BytesIO()
+        self.encoder.save(img, stream, ImageEncoder.format_of(dest))
+        self.files[dest] = stream.getvalue()
+
+    def retain(self, dest: str) -> None:
+        # Retained files outlive the record, so later records can copy them
+        self.retained_files[dest] = self.files[dest]
+
+    def take(self) -> List[Tuple[str, bytes]]:
+        files = list(self.files.items())
+        self.files = {}
+        return files
+
+
+# Keeps decoded images of a single record in memory until they are taken, e.g. to be copied into arrays
+class ArrayImageOutput(AbstractImageOutput):
+    def __init__(self, record_images: RecordImages) -> None:
+        self.record_images = record_images
+        self.images: Dict[str, Image.Image] = {}
+        self.retained_images: Dict[str, Image.Image] = {}
+
+    def prepare(self, dest: str) -> None:
+        pass
+
+    def copy_source(self, src: str, dest: str, byte_size: Optional[int] = None) -> None:
+        # Sources are decoded once per record, also when merged into another output of the record
+        self.images[dest] = self.record_images.decode(src, lambda: ArrayImageOutput.__decode(src))
+
+    def copy_output(self, src: str, dest: str) -> None:
+        self.images[dest] = self.images[src] if src in self.images else self.retained_images[src]
+
+    def save(self, img: Image.Image, dest: str) -> None:
+        self.images[dest] = img
+
+    def retain(self, dest: str) -> None:
+        self.retained_images[dest] = self.images[dest]
+
+    def take(self) -> Dict[str, Image.Image]:
+        images = self.images
+        self.images = {}
+        return images
+
+    @staticmethod
+    def __decode(src: str) -> Image.Image:
+        metrics.count('image_opens')
+        metrics.count('image_decodes')
+        img = Image.open(src)
+        img.load()
+        return img
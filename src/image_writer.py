@@ -1,28 +1,54 @@
-import os
-from typing import List, Optional
-from PIL import Image, ImageColor
-from src.copy_strategy import AbstractCopyStrategy
-from src.structs import MaskRepresentation, MaskColor
+import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from PIL import Image, ImageColor, UnidentifiedImageError
+from src.image_encoder import ImageEncoder
+from src.image_output import AbstractImageOutput
+from src.image_metadata_index import ImageMetadataIndex, ImageMetadata
+from src.metrics import metrics
+from src.operation_kind import OperationKind
+from src.record_images import RecordImages
+from src.resample_filter import ResampleFilter
+from src.structs import MaskRepresentation, MaskColor, Operation
+
+BLACK = 0
+WHITE = 255
+MASK_THRESHOLD = 128
+REDUCING_GAP = 2.0 # Large downscales are reduced by an integer factor first, then resampled by the filter
 
 class ImageWriter:
 
-    def __init__(self, img_mode: str, mask_mode: str, copy_strategy: AbstractCopyStrategy) -> None:
+    def __init__(self, img_mode: str, mask_mode: str, output: AbstractImageOutput, metadata_index: ImageMetadataIndex, copy_kind: OperationKind = OperationKind.COPY, record_images: Optional[RecordImages] = None,
+                 target_size: Optional[Tuple[int, int]] = None, crop: bool = False, resample: ResampleFilter = ResampleFilter.BILINEAR) -> None:
         self.img_mode = img_mode
         self.mask_mode = mask_mode
-        self.default_copy_strategy = copy_strategy
+        self.output = output
+        self.metadata_index = metadata_index
+        self.copy_kind = copy_kind # Kind of planned copies of sources, LINK when output copies are links as well
+        # Frame and masks decoded for one output are reused by other outputs of the same record
+        self.record_images = record_images if record_images is not None else RecordImages()
+        # Outputs are resized to the target size, optionally center-cropped to its aspect ratio first instead of stretched.
+        # Sources of another size are never copied.
+        self.target_size = target_size
+        self.crop = crop
+        self.resample = resample
+        # Constant masks are encoded once per (size, mode, color), later occurrences are copied from the first output
+        self.constant_mask_paths: Dict[Tuple, str] = {}
+        self.constant_mask_keys: Dict[str, Tuple] = {}
 
     def write_frame(self, src: str, dest: str) -> None:
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        self.output.prepare(dest)
+        self.__forget_constant_mask(dest)
 
-        img = Image.open(src)
-        if (self.img_mode is None or img.mode == self.img_mode):
-            self.default_copy_strategy.copy(src, dest)
+        metadata = self.__get_image_metadata(src)
+        if self.__can_copy(src, dest, metadata, self.img_mode):
+            self.output.copy_source(src, dest, metadata.byte_size)
         else:
-            img = img.convert(self.img_mode)
-            img.save(dest)
+            img = self.record_images.get((src, 'frame', self.img_mode), lambda: self.__resize(self.__convert_frame(self.__decode_image(src, metadata)), self.resample.pil_filter))
+            self.output.save(img, dest)
 
     def write_mask(self, mask_reps: List[MaskRepresentation], dest: str, base_img_src: str) -> None:
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        self.output.prepare(dest)
+        self.__forget_constant_mask(dest)
 
         if len(mask_reps) > 1:
             self.__write_merged_masks(mask_reps, dest, base_img_src)
@@ -31,58 +57,223 @@ class ImageWriter:
         else:
             raise ValueError("Invalid State: write_masks method called with empty source list.")
 
+    def copy_output(self, src: str, dest: str) -> None:
+        self.output.prepare(dest)
+        self.__forget_constant_mask(dest)
+        self.output.copy_output(src, dest)
+
+    # Plans repeat decisions of write methods from image metadata only, no image is decoded.
+    # Estimated bytes are bytes newly written to output, links and constant masks are counted as free.
+    def plan_frame(self, src: str, dest: str, row: int) -> Operation:
+        metadata = self.__get_image_metadata(src)
+        if self.__can_copy(src, dest, metadata, self.img_mode):
+            return self.__plan_copy(row, dest, src, None, metadata.byte_size)
+        return Operation(OperationKind.CONVERT, row, dest, src, None, metadata.byte_size, self.__estimate_bytes(metadata.byte_size, metadata.size))
+
+    def plan_mask(self, mask_reps: List[MaskRepresentation], dest: str, base_img_src: str, row: int) -> Operation:
+        base_img = self.__get_image_metadata(base_img_src)
+        mask_paths = [mask_repr.mask_path for mask_repr in mask_reps if not mask_repr.is_of_color()]
+        mask_sizes = [self.metadata_index.get(mask_path).byte_size for mask_path in mask_paths]
+
+        if len(mask_reps) > 1:
+            if len(mask_paths) == 0 or any(self.__is_white_mask(mask_repr) for mask_repr in mask_reps):
+                return Operation(OperationKind.SYNTHESIZE, row, dest, base_img_src, mask_reps, 0, 0)
+            for mask_path in mask_paths:
+                self.__get_image_metadata(mask_path)
+            return Operation(OperationKind.MERGE, row, dest, base_img_src, mask_reps, sum(mask_sizes), self.__estimate_bytes(max(mask_sizes), base_img.size))
+        elif len(mask_reps) == 1:
+            if len(mask_paths) == 0 or self.metadata_index.get(mask_paths[0]).is_empty_file():
+                return Operation(OperationKind.SYNTHESIZE, row, dest, base_img_src, mask_reps, 0, 0)
+            metadata = self.__get_image_metadata(mask_paths[0])
+            if self.__can_copy(mask_paths[0], dest, metadata, self.mask_mode):
+                return self.__plan_copy(row, dest, base_img_src, mask_reps, metadata.byte_size)
+            return Operation(OperationKind.CONVERT, row, dest, base_img_src, mask_reps, metadata.byte_size, self.__estimate_bytes(metadata.byte_size, metadata.size))
+        else:
+            raise ValueError("Invalid State: plan_mask method called with empty source list.")
+
+    def plan_copy_output(self, src: str, dest: str, row: int, src_estimated_bytes: int) -> Operation:
+        estimated_bytes = src_estimated_bytes if self.copy_kind == OperationKind.COPY else 0
+        return Operation(OperationKind.COPY_OUTPUT, row, dest, src, None, 0, estimated_bytes)
+
+    def execute(self, operation: Operation) -> None:
+        self.record_images.begin(operation.row)
+        if operation.kind == OperationKind.COPY_OUTPUT:
+            try:
+                self.copy_output(operation.src, operation.dest)
+            except FileNotFoundError:
+                # Copied output is missing when its record failed in the configuration that computed it
+                if operation.fallback is None:
+                    raise
+                metrics.count('computed_outputs_recomputed')
+                self.execute(operation.fallback)
+        elif operation.mask_reps is None:
+            self.write_frame(operation.src, operation.dest)
+        else:
+            self.write_mask(operation.mask_reps, operation.dest, base_img_src=operation.src)
+
+    def release_images(self) -> None:
+        self.record_images.release()
+
+    def constant_mask_value(self, mask_reps: List[MaskRepresentation]) -> bool:
+        # Value of every pixel of a mask planned as synthesized, known without drawing it
+        return any(self.__is_white_mask(mask_repr) for mask_repr in mask_reps)
+
+    def output_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        return self.target_size if self.target_size is not None else size
+
+    def resize_key(self) -> Tuple:
+        return (self.target_size, self.crop, str(self.resample)) if self.target_size is not None else ()
+
+    def __plan_copy(self, row: int, dest: str, src: str, mask_reps: Optional[List[MaskRepresentation]], source_bytes: int) -> Operation:
+        estimated_bytes = source_bytes if self.copy_kind == OperationKind.COPY else 0
+        return Operation(self.copy_kind, row, dest, src, mask_reps, source_bytes, estimated_bytes)
+
     def __write_single_mask_repr(self, mask_repr: MaskRepresentation, dest: str, base_img_src: str) -> None:
         if mask_repr.is_of_color():
-            img = self.__create_mask_based_on_frame(color_str=self.__convert_to_pil_color_str(mask_repr.color), desired_mode=self.mask_mode, base_img_src=base_img_src)
-            img.save(dest)
+            self.__write_mask_based_on_frame(color_str=self.__convert_to_pil_color_str(mask_repr.color), dest=dest, base_img_src=base_img_src)
         else:
             self.__write_mask_from_path(src=mask_repr.mask_path, dest=dest, base_img_src=base_img_src)
 
 
     def __write_mask_from_path(self, src: str, dest: str, base_img_src: str) -> None:
-        if os.path.getsize(src) == 0:
-            img = self.__create_mask_based_on_frame(color_str='white', desired_mode=self.mask_mode, base_img_src=base_img_src)
-            img.save(dest)
+        if self.metadata_index.get(src).is_empty_file():
+            self.__write_mask_based_on_frame(color_str='white', dest=dest, base_img_src=base_img_src)
         else:
-            img = Image.open(src)
-            is_img_in_desired_mode = self.mask_mode is None or img.mode == self.mask_mode
-            if is_img_in_desired_mode:
-                self.default_copy_strategy.copy(src, dest)
+            metadata = self.__get_image_metadata(src)
+            if self.__can_copy(src, dest, metadata, self.mask_mode):
+                self.output.copy_source(src, dest, metadata.byte_size)
             else:
-                img = img.convert(self.mask_mode)
-                img.save(dest)
+                img = self.record_images.get((src, 'mask', self.mask_mode), lambda: self.__resize(self.__convert_mask(self.__decode_image(src, metadata), self.mask_mode), Image.Resampling.NEAREST))
+                self.output.save(img, dest)
             
     def __write_merged_masks(self, mask_reps: List[MaskRepresentation], dest: str, base_img_src: str) -> None:
-        base_img = Image.open(base_img_src)
-        desired_size = base_img.size
+        base_img = self.__get_image_metadata(base_img_src)
+        desired_size = self.output_size(base_img.size)
         desired_mode = self.mask_mode if self.mask_mode is not None else base_img.mode
 
-        img = Image.new(mode='L', size=desired_size, color='black')     
+        # Masks are merged in size of the frame, the result is resized
+        merged_mask = self.__merge_masks(mask_reps, base_img.size)
+        if isinstance(merged_mask, np.ndarray):
+            img = self.__resize(self.__convert_mask(Image.fromarray(merged_mask, mode='L'), desired_mode), Image.Resampling.NEAREST)
+            self.output.save(img, dest)
+        else:
+            create_img = lambda: self.__convert_mask(Image.new(mode='L', size=desired_size, color=merged_mask), desired_mode)
+            self.__write_constant_mask(('merged', desired_size, desired_mode, merged_mask), create_img, dest)
+
+    def __merge_masks(self, mask_reps: List[MaskRepresentation], size: Tuple[int, int]) -> Union[np.ndarray, int]:
+        # Constant masks are never materialized: a white one makes the whole result white, a black one changes nothing.
+        # Returns either merged pixels in mode 'L' or a constant color of the whole mask.
+        # Every mask is composited in white over the masks before it, as by PIL paste('white', mask=mask), pixel by pixel
+        # merged + (255 - merged) * mask / 255 rounded as PIL does. Binary masks are merged by OR, partially opaque
+        # (gray or anti-aliased) pixels are blended, e.g. two pixels of 100 give 161.
+        merged_mask = None
         for mask_repr in mask_reps:
-            img_to_merge = self.__prepare_mask_image_to_merge(mask_repr, base_img_src=base_img_src)
-            img.paste(im='white', mask=img_to_merge)
+            if self.__is_white_mask(mask_repr):
+                return WHITE
+            if mask_repr.is_of_color():
+                continue
 
-        img = img.convert(desired_mode)
-        img.save(dest)
+            mask = self.__load_mask_to_merge(mask_repr.mask_path, size)
+            if merged_mask is None:
+                merged_mask = mask.astype(np.uint16)
+            else:
+                blended = (255 - merged_mask) * mask + 128
+                merged_mask += (blended + (blended >> 8)) >> 8
+
+        return merged_mask.astype(np.uint8) if merged_mask is not None else BLACK
 
-    def __prepare_mask_image_to_merge(self, mask_repr: MaskRepresentation, base_img_src: str) -> Image:
+    def __is_white_mask(self, mask_repr: MaskRepresentation) -> bool:
         if mask_repr.is_of_color():
-            return self.__create_mask_based_on_frame(color_str=self.__convert_to_pil_color_str(mask_repr.color), desired_mode='L', base_img_src=base_img_src)
-
-        if os.path.getsize(mask_repr.mask_path) == 0:
-            return self.__create_mask_based_on_frame(color_str='white', desired_mode='L', base_img_src=base_img_src)
-        
-        img = Image.open(mask_repr.mask_path)
-        img = img.convert('L')
-        return img 
-
-    def __create_mask_based_on_frame(self, color_str: str, desired_mode: Optional[str], base_img_src: str) -> Image:
-        base_img = Image.open(base_img_src)
-        desired_size = base_img.size
-        desired_mode = desired_mode if desired_mode is not None else base_img.mode
-        color = ImageColor.getcolor(color_str, desired_mode)
-
-        return Image.new(mode=desired_mode, size=desired_size, color=color)
+            return mask_repr.color == MaskColor.WHITE
+        return self.metadata_index.get(mask_repr.mask_path).is_empty_file()
+
+    def __load_mask_to_merge(self, mask_path: str, size: Tuple[int, int]) -> np.ndarray:
+        img = self.__decode_image(mask_path, self.metadata_index.get(mask_path))
+        if img.size != size:
+            raise ValueError(f"Mask {mask_path} of size {img.size} does not match frame size {size}")
+        return self.record_images.get((mask_path, 'merge', 'L'), lambda: np.asarray(img.convert('L')))
+
+    def __write_mask_based_on_frame(self, color_str: str, dest: str, base_img_src: str) -> None:
+        base_img = self.__get_image_metadata(base_img_src)
+        desired_size = self.output_size(base_img.size)
+        desired_mode = self.mask_mode if self.mask_mode is not None else base_img.mode
+
+        create_img = lambda: Image.new(mode=desired_mode, size=desired_size, color=ImageColor.getcolor(color_str, desired_mode))
+        self.__write_constant_mask(('filled', desired_size, desired_mode, color_str), create_img, dest)
+
+    def __write_constant_mask(self, key: Tuple, create_img: Callable[[], Image.Image], dest: str) -> None:
+        if key in self.constant_mask_paths:
+            self.output.copy_output(self.constant_mask_paths[key], dest)
+            return
+
+        self.output.save(create_img(), dest)
+        self.output.retain(dest)
+        self.constant_mask_paths[key] = dest
+        self.constant_mask_keys[dest] = key
+
+    def __forget_constant_mask(self, dest: str) -> None:
+        # Overwritten output can no longer be used as a source of constant mask
+        key = self.constant_mask_keys.pop(dest, None)
+        if key is not None:
+            del self.constant_mask_paths[key]
+
+    def __can_copy(self, src: str, dest: str, metadata: ImageMetadata, mode: Optional[str]) -> bool:
+        # Destinations without extension (e.g. arrays) take decoded pixels of any format
+        dest_format = ImageEncoder.format_of(dest)
+        is_in_desired_format = dest_format is None or dest_format == ImageEncoder.format_of(src)
+        is_in_desired_size = self.target_size is None or metadata.size == self.target_size
+        return is_in_desired_format and is_in_desired_size and (mode is None or metadata.mode == mode)
+
+    def __resize(self, img: Image.Image, resample: Image.Resampling) -> Image.Image:
+        if self.target_size is None or img.size == self.target_size:
+            return img
+        return img.resize(self.target_size, resample, box=self.__crop_box(img.size), reducing_gap=REDUCING_GAP)
+
+    def __crop_box(self, size: Tuple[int, int]) -> Tuple[float, float, float, float]:
+        (width, height) = size
+        if not self.crop:
+            return (0, 0, width, height)
+        # Largest centered box with the aspect ratio of the target size
+        (target_width, target_height) = self.target_size
+        crop_width = min(width, height * target_width / target_height)
+        crop_height = min(height, width * target_height / target_width)
+        (left, top) = ((width - crop_width) / 2, (height - crop_height) / 2)
+        return (left, top, left + crop_width, top + crop_height)
+
+    def __estimate_bytes(self, byte_size: int, size: Tuple[int, int]) -> int:
+        # Resized outputs are estimated to shrink with the number of pixels
+        if self.target_size is None:
+            return byte_size
+        return byte_size * self.target_size[0] * self.target_size[1] // max(size[0] * size[1], 1)
+
+    def __convert_frame(self, img: Image.Image) -> Image.Image:
+        return img.convert(self.img_mode) if self.img_mode is not None else img
+
+    @staticmethod
+    def __convert_mask(img: Image.Image, mode: Optional[str]) -> Image.Image:
+        # Conversion to mode '1' would dither gray pixels (e.g. JPEG artifacts at edges), masks are thresholded instead
+        if mode is None:
+            return img
+        if mode == '1' and img.mode != '1':
+            return img.convert('L').point(lambda value: WHITE if value >= MASK_THRESHOLD else BLACK, '1')
+        return img.convert(mode)
+
+    def __decode_image(self, src: str, metadata: ImageMetadata) -> Image.Image:
+        return self.record_images.decode(src, lambda: self.__open_image(src, metadata))
+
+    def __open_image(self, src: str, metadata: ImageMetadata) -> Image.Image:
+        metrics.count('image_opens')
+        metrics.count('image_decodes')
+        metrics.count('bytes_read', metadata.byte_size)
+        img = Image.open(src)
+        img.load()
+        return img
+
+    def __get_image_metadata(self, src: str) -> ImageMetadata:
+        metadata = self.metadata_index.get(src)
+        if not metadata.is_image():
+            raise UnidentifiedImageError(f"cannot identify image file {src!r}")
+        return metadata
 
     def __convert_to_pil_color_str(self, mask_color: MaskColor) -> str:
         if mask_color == MaskColor.BLACK:
@@ -0,0 +1,90 @@
+import json
+import os
+import numpy as np
+from typing import Dict, List, Tuple
+
+# Masks are stored as uncompressed COCO run-length encoding: lengths of alternating runs of 0 and 1 pixels in
+# column-major order, starting with a run of zeros (possibly empty). Files can be read by COCO tools as well.
+
+
+def encode_rle(mask: np.ndarray) -> List[int]:
+    pixels = np.asarray(mask, dtype=bool).ravel(order='F')
+    if len(pixels) == 0:
+        return []
+    run_starts = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], run_starts, [len(pixels)])))
+    return ([0] if pixels[0] else []) + counts.tolist()
+
+
+def encode_constant_rle(value: bool, size: Tuple[int, int]) -> List[int]:
+    # Constant masks are encoded from their value, without pixels
+    (width, height) = size
+    return [0, width * height] if value else [width * height]
+
+
+def decode_rle(counts: List[int], size: List[int]) -> np.ndarray:
+    # Returns a boolean mask of shape (height, width), size is [height, width] as in COCO
+    # Runs of ones are filled by slices, masks are made of a few hundred runs at most, far fewer than pixels
+    (height, width) = size
+    pixels = np.zeros(height * width, dtype=bool)
+    run_ends = np.cumsum(counts).tolist()
+    for (start, end) in zip(run_ends[0::2], run_ends[1::2]):
+        pixels[start:end] = True
+    return pixels.reshape((height, width), order='F')
+
+
+# Annotations of a split are streamed into the file as records are written, images and categories are small
+# and written when the split ends
+class MaskAnnotationsWriter:
+    def __init__(self, path: str, categories: List[str]) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.stream = open(path, "w")
+        self.stream.write('{"annotations": [')
+        self.categories = categories
+        self.category_ids = {name: id for id, name in enumerate(categories, start=1)}
+        self.images: List[Dict] = []
+        self.annotations_count = 0
+
+    def add_image(self, file_name: str, size: Tuple[int, int], masks: List[Tuple[str, List[int]]]) -> None:
+        (width, height) = size
+        image_id = len(self.images) + 1
+        self.images.append({'id': image_id, 'file_name': file_name, 'width': width, 'height': height})
+        for category, counts in masks:
+            self.annotations_count += 1
+            annotation = {
+                'id': self.annotations_count,
+                'image_id': image_id,
+                'category_id': self.category_ids[category],
+                'segmentation': {'size': [height, width], 'counts': counts},
+                'area': sum(counts[1::2]),
+                'iscrowd': 1
+            }
+            self.stream.write(("," if self.annotations_count > 1 else "") + "\n" + json.dumps(annotation))
+
+    def close(self) -> None:
+        categories = [{'id': id, 'name': name} for name, id in self.category_ids.items()]
+        self.stream.write(f'\n], "images": {json.dumps(self.images)}, "categories": {json.dumps(categories)}}}\n')
+        self.stream.close()
+
+
+# Reads annotations of a split once, masks of an image are decoded in memory on request, e.g. in a training dataset:
+#   annotations = MaskAnnotations("output/annotations/train.json")
+#   masks = annotations.masks("train/ers/images/0001_samples_000001.png") # {class name: boolean array of shape (H, W)}
+class MaskAnnotations:
+    def __init__(self, path: str) -> None:
+        with open(path, "r") as stream:
+            data = json.load(stream)
+        self.categories: Dict[int, str] = {category['id']: category['name'] for category in data['categories']}
+        self.images: Dict[str, Dict] = {image['file_name']: image for image in data['images']}
+        self.image_annotations: Dict[int, List[Dict]] = {}
+        for annotation in data['annotations']:
+            self.image_annotations.setdefault(annotation['image_id'], []).append(annotation)
+
+    def file_names(self) -> List[str]:
+        return list(self.images)
+
+    def masks(self, file_name: str) -> Dict[str, np.ndarray]:
+        annotations = self.image_annotations.get(self.images[file_name]['id'], [])
+        return {
+            self.categories[annotation['category_id']]: decode_rle(annotation['segmentation']['counts'], annotation['segmentation']['size'])
+            for annotation in annotations}
@@ -1,62 +1,96 @@
-from typing import List, Optional
+import numpy as np
+from typing import Dict, List, Optional, Tuple
 from src.training_type import TrainingType
-from src.class_mappers import AbstractClassMapper
-from src.structs import UnmergedMaskData, MergedMaskData, MaskRepresentation, MaskColor
+from src.class_mappers import ClassLookupTable
+from src.structs import MergedMaskData, MaskRepresentation, MaskColor
+
+
+# Masks of a batch of frames as arrays. A pair is a mask matched to a frame, a row is a class code found in the name
+# of the mask of a pair. Rows are ordered by frame, then by mask and by position of the code in the mask name.
+class MaskTable:
+    __slots__ = ('frames_count', 'mask_paths', 'pair_frames', 'pair_masks', 'row_pairs', 'row_codes')
+
+    def __init__(self, frames_count: int, mask_paths: List[str], pair_frames: np.ndarray, pair_masks: np.ndarray, row_pairs: np.ndarray, row_codes: np.ndarray) -> None:
+        self.frames_count = frames_count
+        self.mask_paths = mask_paths
+        self.pair_frames = pair_frames
+        self.pair_masks = pair_masks
+        self.row_pairs = row_pairs
+        self.row_codes = row_codes
+
 
 class MaskDataMerger:
     def __init__(self, args) -> None:
         self.binary = args.training_type == TrainingType.BINARY_SEG
         self.allow_ambiguous_mappings = args.training_type == TrainingType.MULTILABEL_CLASSIFICATION
 
-    def merge(self, masks_data: List[UnmergedMaskData], mapper: AbstractClassMapper) -> Optional[List[MergedMaskData]]:
-        unmerged_mask_data_with_mapped_classes = self.__map_classes(masks_data, mapper)
-        all_mapped_classes = {mask_data.class_name for mask_data in unmerged_mask_data_with_mapped_classes}
+    def merge(self, table: MaskTable, lookup: ClassLookupTable) -> List[Optional[List[MergedMaskData]]]:
+        # Returns merged masks of every frame of the table, None for frames without mapped classes.
+        # Classes of a frame are ordered by their first mask, masks of a class keep the order of rows.
+        rows = np.arange(len(table.row_codes))
+        if not self.allow_ambiguous_mappings: # For binary segmentation this drop is justified. For multilabel - it's debatable
+            rows = rows[~self.__find_ambiguously_mapped_rows(table, lookup)]
 
-        merged_mask_data = []
-        for processed_class in all_mapped_classes:
-            if self.binary and not mapper.is_positive(processed_class):
-                merged_mask_data.append(MergedMaskData(processed_class, [MaskRepresentation.of_color(MaskColor.BLACK)]))
-            else:
-                masks_paths_of_class = [mask_data.mask_path for mask_data in unmerged_mask_data_with_mapped_classes if mask_data.class_name == processed_class]
-                merged_mask = self.__merge_masks_data(masks_paths_of_class, processed_class)
-                merged_mask_data.append(merged_mask)
+        # Every row is expanded to mapped classes of its code
+        (rows, class_ids) = expand_lists(lookup.class_offsets, lookup.class_ids, table.row_codes[rows], rows)
+        pairs = table.row_pairs[rows]
+        frames = table.pair_frames[pairs]
 
-        return merged_mask_data if len(merged_mask_data) > 0 else None
+        # Rows of a class of a frame are grouped, groups are ordered by their first row
+        (_, first_rows, groups) = np.unique(frames * max(len(lookup.class_names), 1) + class_ids, return_index=True, return_inverse=True)
+        group_ranks = np.empty(len(first_rows), dtype=np.int64)
+        group_ranks[np.argsort(first_rows)] = np.arange(len(first_rows))
+        row_ranks = group_ranks[groups]
+        order = np.argsort(row_ranks, kind='stable')
+        group_starts = np.flatnonzero(np.diff(row_ranks[order], prepend=-1))
 
+        merged_mask_data: List[Optional[List[MergedMaskData]]] = [None] * table.frames_count
+        masks = table.pair_masks[pairs[order]]
+        # Representations are never modified, so a mask used by several classes shares one
+        mask_reps: Dict[int, MaskRepresentation] = {mask: MaskRepresentation.of_path(table.mask_paths[mask]) for mask in np.unique(masks).tolist()}
+        masks = masks.tolist()
+        for (start, end, frame, class_id) in zip(group_starts.tolist(), np.append(group_starts[1:], len(order)).tolist(), frames[order][group_starts].tolist(), class_ids[order][group_starts].tolist()):
+            class_name = lookup.class_names[class_id]
+            if self.binary and not lookup.positive[class_id]:
+                mask_data = MergedMaskData(class_name, [MaskRepresentation.of_color(MaskColor.BLACK)])
+            else:
+                mask_data = MergedMaskData(class_name, [mask_reps[mask] for mask in masks[start:end]])
+            if merged_mask_data[frame] is None:
+                merged_mask_data[frame] = []
+            merged_mask_data[frame].append(mask_data)
+        return merged_mask_data
 
-    def __map_classes(self, masks_data: List[UnmergedMaskData], mapper: AbstractClassMapper) -> List[UnmergedMaskData]:
-        if not self.allow_ambiguous_mappings: # For binary segmentation this drop is justified. For multilabel - it's debatable
-            masks_data = self.__drop_records_where_single_mask_is_mapped_to_multiple_sets_of_classes(masks_data, mapper)
-
-        result = []
-        for mask_data in masks_data:
-            mapped_classes = mapper.map(mask_data.class_name)
-            for mapped_class in mapped_classes:
-                result.append(UnmergedMaskData(mapped_class, mask_data.mask_path))
-            
-        return result
-
-    def __drop_records_where_single_mask_is_mapped_to_multiple_sets_of_classes(self, masks_data: List[UnmergedMaskData], mapper: AbstractClassMapper) -> List[UnmergedMaskData]:
-        mask_paths_to_drop = set()
-        mapped_classes_per_mask = {}
-        for mask_data in masks_data:
-            class_name = mask_data.class_name
-            mask_path = mask_data.mask_path
-            mapped_classes = set(mapper.map(class_name))
-            if len(mapped_classes) == 0:
-                continue
+    def __find_ambiguously_mapped_rows(self, table: MaskTable, lookup: ClassLookupTable) -> np.ndarray:
+        # A mask is dropped from a frame when codes in its name are mapped to different non-empty sets of classes.
+        # Rows of a pair are contiguous, so sets are compared within runs of equal pairs.
+        set_ids = lookup.set_ids[table.row_codes]
+        if len(set_ids) == 0:
+            return np.zeros(0, dtype=bool)
+        is_mapped = set_ids != 0
+        run_starts = np.flatnonzero(np.diff(table.row_pairs, prepend=-1))
+        min_set_ids = np.minimum.reduceat(np.where(is_mapped, set_ids, np.iinfo(np.int64).max), run_starts)
+        max_set_ids = np.maximum.reduceat(np.where(is_mapped, set_ids, 0), run_starts)
+        ambiguous_runs = (max_set_ids != 0) & (min_set_ids != max_set_ids)
 
-            if mask_path in mapped_classes_per_mask:
-                if mapped_classes_per_mask[mask_path] != mapped_classes:
-                    print(f"[WARN] Skipping mask at location {mask_path}. It is mapped to multiple different sets of classes. Conflict {mapped_classes_per_mask[mask_path]} vs {mapped_classes}.")
-                    mask_paths_to_drop.add(mask_path)
-            else:
-                mapped_classes_per_mask[mask_path] = mapped_classes
+        for run in np.flatnonzero(ambiguous_runs).tolist():
+            end = run_starts[run + 1] if run + 1 < len(run_starts) else len(set_ids)
+            self.__warn_about_ambiguous_mapping(table, lookup, run_starts[run], end)
+        return np.repeat(ambiguous_runs, np.diff(np.append(run_starts, len(set_ids))))
 
-        return [mask_data for mask_data in masks_data if mask_data.mask_path not in mask_paths_to_drop]
-        
+    def __warn_about_ambiguous_mapping(self, table: MaskTable, lookup: ClassLookupTable, start: int, end: int) -> None:
+        mask_path = table.mask_paths[table.pair_masks[table.row_pairs[start]]]
+        first_code = None
+        for code in table.row_codes[start:end].tolist():
+            if lookup.set_ids[code] == 0:
+                continue
+            if first_code is None:
+                first_code = code
+            elif lookup.set_ids[code] != lookup.set_ids[first_code]:
+                print(f"[WARN] Skipping mask at location {mask_path}. It is mapped to multiple different sets of classes. Conflict {lookup.code_class_sets[first_code]} vs {lookup.code_class_sets[code]}.")
 
-    def __merge_masks_data(self, masks_paths: List[str], class_name: str) -> MergedMaskData:
-        masks_repr = [MaskRepresentation.of_path(mask_path) for mask_path in masks_paths]
-        return MergedMaskData(class_name, masks_repr)
 
+def expand_lists(offsets: np.ndarray, values: np.ndarray, ids: np.ndarray, owners: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Lists stored as values[offsets[i]:offsets[i + 1]] are concatenated for given ids, every value with its owner
+    counts = offsets[ids + 1] - offsets[ids]
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(owners, counts), values[np.repeat(offsets[ids], counts) + positions]
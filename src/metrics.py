@@ -0,0 +1,95 @@
+import bisect
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError: # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+# Upper bounds of buckets of per-record latency histogram in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+# Counters and phase timings of a single process. Counting is cheap, so it is always on.
+# Workers send what they collected to the main process with results of every chunk.
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: Dict[str, int] = {}
+        self.phases: Dict[str, float] = {}
+        self.latency_buckets: List[int] = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        # Time of a phase entered several times is summed up
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start
+
+    def observe_latency(self, seconds: float) -> None:
+        self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+        self.latency_sum += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def take(self) -> 'Metrics':
+        taken = Metrics()
+        taken.merge(self)
+        self.reset()
+        return taken
+
+    def merge(self, other: 'Metrics') -> None:
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for phase, seconds in other.phases.items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self.latency_buckets = [count + other_count for count, other_count in zip(self.latency_buckets, other.latency_buckets)]
+        self.latency_sum += other.latency_sum
+        self.latency_max = max(self.latency_max, other.latency_max)
+
+    def create_report(self) -> Dict:
+        write_time = sum(seconds for phase, seconds in self.phases.items() if phase.startswith("write_"))
+        records_count = sum(self.latency_buckets)
+        return {
+            'phases_s': self.phases,
+            'records_per_s': self.counters.get('records_written', 0) / write_time if write_time > 0 else None,
+            'record_latency': {
+                'count': records_count,
+                'mean_ms': self.latency_sum / records_count * 1000 if records_count > 0 else None,
+                'max_ms': self.latency_max * 1000,
+                'histogram_ms': [
+                    {'le': bound, 'count': count}
+                    for bound, count in zip(LATENCY_BUCKETS_MS + [None], self.latency_buckets)]
+            },
+            'counters': dict(sorted(self.counters.items())),
+            'memory': Metrics.__measure_memory()
+        }
+
+    @staticmethod
+    def __measure_memory() -> Dict[str, Optional[int]]:
+        memory = {
+            'peak_rss_bytes': None,
+            'peak_workers_rss_bytes': None,
+            'peak_traced_bytes': tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+        }
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            unit = 1 if sys.platform == "darwin" else 1024
+            memory['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+            memory['peak_workers_rss_bytes'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+        return memory
+
+
+metrics = Metrics()
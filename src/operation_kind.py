@@ -0,0 +1,25 @@
+from src.extended_enum import ExtendedEnum
+
+
+# Planned operations are executed grouped by kind in the order of EXECUTION_STAGES, copies of outputs come last,
+# after the outputs they copy are written
+class OperationKind(ExtendedEnum):
+    LINK = "link"
+    COPY = "copy"
+    CONVERT = "convert"
+    MERGE = "merge"
+    SYNTHESIZE = "synthesize"
+    COPY_OUTPUT = "copy_output"
+
+    def __str__(self):
+        return self.value.lower()
+
+
+# Kinds that decode sources are executed in one stage, so operations of a record run one after another and share
+# decoded frame and masks
+EXECUTION_STAGES = [
+    [OperationKind.LINK],
+    [OperationKind.COPY],
+    [OperationKind.CONVERT, OperationKind.MERGE, OperationKind.SYNTHESIZE],
+    [OperationKind.COPY_OUTPUT],
+]
@@ -0,0 +1,11 @@
+from src.extended_enum import ExtendedEnum
+
+
+class OutputFormat(ExtendedEnum):
+    DIRECTORY = "directory"
+    SHARDS = "shards"
+    MEMMAP = "memmap"
+    COCO = "coco"
+
+    def __str__(self):
+        return self.value.lower()
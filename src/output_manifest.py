@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, Optional, Set, Tuple
+from src.structs import RecordOutput
+
+MANIFEST_FILE_NAME = ".manifest.json"
+JOURNAL_FILE_NAME = ".manifest.journal"
+MANIFEST_OPTIONS = ['training_type', 'img_mode', 'mask_mode', 'copy_strategy']
+# Options added later are part of the digest only when set, so outputs of earlier manifests stay up to date
+OPTIONAL_MANIFEST_OPTIONS = ['frame_format', 'mask_format', 'png_compress_level', 'target_size', 'crop', 'resample']
+PARTIAL_FILE_PATTERN = re.compile(r"^\.manifest\.part-(\d+)-of-(\d+)\.(json|journal)$")
+
+
+# Written outputs are appended to the journal right away and flushed with every record, so an interrupted run resumes
+# from the last written record. Files of records that were not journaled are removed and written again on resume,
+# since their records are not up to date. The journal is compacted into the manifest when the run finishes.
+# A partition of a partitioned run keeps a partial manifest of its own outputs, see merge_partial_manifests.
+# Without resume, outputs of a previous run are not loaded and the manifest lists outputs of this run only.
+class OutputManifest:
+
+    def __init__(self, output_path: str, options: Dict, partition: Optional[Tuple[int, int]] = None, resume: bool = True) -> None:
+        self.output_path = output_path
+        self.options = options
+        self.options_digest = OutputManifest.__digest(options)
+        self.manifest_path = os.path.join(output_path, partial_file_name(MANIFEST_FILE_NAME, partition) if partition is not None else MANIFEST_FILE_NAME)
+        self.journal_path = os.path.join(output_path, partial_file_name(JOURNAL_FILE_NAME, partition) if partition is not None else JOURNAL_FILE_NAME)
+        self.outputs: Dict[str, Dict] = self.__load() if resume else {}
+        self.journal_mode = "a" if resume else "w"
+        self.seen_outputs: Set[str] = set()
+        self.source_fingerprints: Dict[str, List] = {}
+        self.journal = None
+
+    @staticmethod
+    def exists(output_path: str) -> bool:
+        return os.path.isfile(os.path.join(output_path, MANIFEST_FILE_NAME)) or os.path.isfile(os.path.join(output_path, JOURNAL_FILE_NAME))
+
+    @staticmethod
+    def options_from_args(args) -> Dict:
+        options = {option: str(getattr(args, option)) if getattr(args, option) is not None else None for option in MANIFEST_OPTIONS}
+        options.update({option: str(getattr(args, option)) for option in OPTIONAL_MANIFEST_OPTIONS if getattr(args, option) is not None and getattr(args, option) is not False})
+        return options
+
+    def is_up_to_date(self, outputs: List[RecordOutput]) -> bool:
+        for path, entry in self.__create_entries(outputs).items():
+            if self.outputs.get(path) != entry or not os.path.lexists(os.path.join(self.output_path, path)):
+                return False
+        return True
+
+    def keep(self, outputs: List[RecordOutput]) -> None:
+        self.seen_outputs.update(self.__relative_path(output.path) for output in outputs)
+
+    def remove_outputs(self, outputs: List[RecordOutput]) -> None:
+        for output in outputs:
+            self.__remove_output(self.__relative_path(output.path))
+
+    def add(self, outputs: List[RecordOutput]) -> None:
+        entries = self.__create_entries(outputs)
+        self.outputs.update(entries)
+        self.seen_outputs.update(entries.keys())
+
+        self.open_journal()
+        self.journal.write(json.dumps(entries) + "\n")
+        self.journal.flush()
+
+    def open_journal(self) -> None:
+        # Opened before anything is written, so a run interrupted before its first record is resumed as well
+        if self.journal is None:
+            os.makedirs(self.output_path, exist_ok=True)
+            self.journal = open(self.journal_path, self.journal_mode)
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def remove_unseen_outputs(self) -> int:
+        unseen_outputs = [path for path in self.outputs if path not in self.seen_outputs]
+        for path in unseen_outputs:
+            self.__remove_output(path)
+            del self.outputs[path]
+        return len(unseen_outputs)
+
+    def save(self, partition: Optional[Dict] = None) -> None:
+        # Partial manifests describe their partition as well, to be validated when they are merged
+        self.close()
+
+        os.makedirs(self.output_path, exist_ok=True)
+        temp_path = self.manifest_path + ".tmp"
+        manifest = {'options': self.options, 'outputs': self.outputs}
+        if partition is not None:
+            manifest['partition'] = partition
+        with open(temp_path, "w") as stream:
+            json.dump(manifest, stream)
+        os.replace(temp_path, self.manifest_path)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+
+    def __load(self) -> Dict[str, Dict]:
+        outputs = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as stream:
+                outputs = json.load(stream)['outputs']
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, "r") as stream:
+                for line in stream:
+                    try:
+                        outputs.update(json.loads(line))
+                    except json.JSONDecodeError:
+                        break # Last line of interrupted run may be incomplete
+        return outputs
+
+    def __create_entries(self, outputs: List[RecordOutput]) -> Dict[str, Dict]:
+        # Several outputs may share a destination (e.g. binary segmentation masks), their sources are combined
+        sources_per_path = {}
+        for output in outputs:
+            sources = sources_per_path.setdefault(self.__relative_path(output.path), [])
+            sources.extend(source for source in output.sources if source not in sources)
+
+        return {
+            path: {'sources': [self.__fingerprint(source) for source in sources], 'options': self.options_digest}
+            for path, sources in sources_per_path.items()}
+
+    def __fingerprint(self, source: str) -> Optional[List]:
+        if source not in self.source_fingerprints:
+            source_path = os.path.abspath(source)
+            try:
+                stat = os.stat(source_path)
+                self.source_fingerprints[source] = [source_path, stat.st_size, stat.st_mtime_ns]
+            except FileNotFoundError:
+                self.source_fingerprints[source] = [source_path, None, None]
+        return self.source_fingerprints[source]
+
+    def __remove_output(self, path: str) -> None:
+        output_file_path = os.path.join(self.output_path, path)
+        if not os.path.lexists(output_file_path):
+            return
+        os.remove(output_file_path)
+
+        directory = os.path.dirname(output_file_path)
+        while os.path.abspath(directory) != os.path.abspath(self.output_path) and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    def __relative_path(self, path: str) -> str:
+        return os.path.relpath(path, self.output_path)
+
+    @staticmethod
+    def __digest(options: Dict) -> str:
+        return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def partial_file_name(file_name: str, partition: Tuple[int, int]) -> str:
+    # e.g. .manifest.part-00001-of-00004.json for the second of 4 partitions
+    (index, count) = partition
+    (base, extension) = os.path.splitext(file_name)
+    return f"{base}.part-{index:05d}-of-{count:05d}{extension}"
+
+
+def merge_partial_manifests(output_path: str) -> int:
+    # Combines partial manifests of all partitions of a run into the manifest of the output directory, so the result is
+    # the same as of a single run and can be updated with --incremental. Returns the number of outputs. Raises ValueError
+    # when partitions are missing or unfinished, were run with different options or splits, failed on some records,
+    # wrote the same file or when a listed file does not exist.
+    partials: Dict[int, Dict] = {}
+    counts: Set[int] = set()
+    for name in sorted(os.listdir(output_path)):
+        match = PARTIAL_FILE_PATTERN.match(name)
+        if match is None:
+            continue
+        (index, count, extension) = (int(match.group(1)), int(match.group(2)), match.group(3))
+        if extension == "journal":
+            raise ValueError(f"Partition {index} of {count} has not finished, journal {name} found")
+        with open(os.path.join(output_path, name), "r") as stream:
+            partials[index] = json.load(stream)
+        counts.add(count)
+
+    if len(partials) == 0:
+        raise ValueError(f"No partial manifests found in {output_path}")
+    if len(counts) > 1:
+        raise ValueError(f"Partial manifests of different numbers of partitions {sorted(counts)} found, remove manifests of stale runs")
+    missing_indices = sorted(set(range(counts.pop())).difference(partials))
+    if len(missing_indices) > 0:
+        raise ValueError(f"Partial manifests of partitions {missing_indices} not found")
+
+    (first_partial, outputs) = (partials[0], {})
+    for index, partial in sorted(partials.items()):
+        if partial['options'] != first_partial['options']:
+            raise ValueError(f"Partition {index} was run with options {partial['options']}, partition 0 with {first_partial['options']}")
+        if partial['partition']['splits'] != first_partial['partition']['splits']:
+            raise ValueError(f"Partition {index} computed a different split than partition 0, sources or split options differ")
+        failures = partial['partition']['failures']
+        if len(failures) > 0:
+            raise ValueError(f"Partition {index} failed to process {len(failures)} records, e.g. {failures[0]}, run it again")
+        for path, entry in partial['outputs'].items():
+            if path in outputs:
+                raise ValueError(f"File {path} was written by more than one partition")
+            if not os.path.lexists(os.path.join(output_path, path)):
+                raise ValueError(f"File {path} written by partition {index} not found")
+            outputs[path] = entry
+
+    manifest = OutputManifest(output_path, first_partial['options'], resume=False)
+    manifest.outputs = outputs
+    manifest.save()
+    return len(outputs)
@@ -1,18 +1,52 @@
 import os
+import csv
+import json
 import shutil
-import pandas as pd
+import numpy as np
+from PIL import Image
 from abc import ABC, abstractmethod
-from typing import Tuple, Hashable
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 from src.training_type import TrainingType
+from src.copy_strategy import CopyStrategy
 from src.image_writer import ImageWriter
-from src.path_creator import SegmentationPathCreator, ClassificationPathCreator
+from src.image_encoder import ImageEncoder
+from src.image_format import ImageFormat
+from src.image_output import AbstractImageOutput, FileImageOutput, MemoryImageOutput, ArrayImageOutput
+from src.image_metadata_index import ImageMetadataIndex
+from src.path_creator import SegmentationPathCreator, ClassificationPathCreator, ShardPathCreator, MemmapPathCreator, CocoPathCreator
+from src.shard_writer import ShardWriter
+from src.metrics import metrics
+from src.operation_kind import OperationKind
+from src.record_images import RecordImages
+from src.resample_filter import ResampleFilter
+from src.mask_annotations import MaskAnnotationsWriter, encode_rle, encode_constant_rle
+from src.structs import RecordOutput, MergedMaskData, Record, Operation
+
+FRAMES_ARRAY = "frames"
+MASKS_ARRAY = "masks"
+LABELS_ARRAY = "labels"
+MASK_CATEGORY = "mask" # Category of binary masks in annotations
+COMPUTED_KINDS = [OperationKind.CONVERT, OperationKind.MERGE, OperationKind.SYNTHESIZE]
 
 
 class OutputRecordGenerator(ABC):
+    # Returned value is passed to commit_output_record in the main process, also when records are generated by workers
     @abstractmethod
-    def generate_output_record(self, data: Tuple[Hashable, pd.Series], type: str) -> None:
+    def generate_output_record(self, data: Tuple[int, Record], type: str) -> Optional[Any]:
         raise NotImplementedError
 
+    def begin_dataset(self, records: Iterable[Record]) -> None:
+        pass
+
+    def begin_split(self, records_count: int, type: str) -> None:
+        pass
+
+    def commit_output_record(self, result: Any, type: str) -> None:
+        pass
+
+    def end_split(self, type: str) -> None:
+        pass
+
     @staticmethod
     def clean_output_dir(output_path: str) -> None:
         if os.path.isdir(output_path):
@@ -21,37 +55,135 @@ class OutputRecordGenerator(ABC):
             print("Output path cleaned")
 
     @staticmethod
-    def prepare_image_writer(args) -> ImageWriter:
+    def prepare_image_writer(args, metadata_index: ImageMetadataIndex, output: Optional[AbstractImageOutput] = None) -> ImageWriter:
         img_mode = args.img_mode
         mask_mode = args.mask_mode
         copy_strategy=args.copy_strategy
+        # Symlink to another output file would dangle or change when that file is rewritten
+        output_copy_strategy = CopyStrategy.HARDLINK if copy_strategy == CopyStrategy.SYMLINK else copy_strategy
+        copy_kind = OperationKind.LINK if copy_strategy in [CopyStrategy.SYMLINK, CopyStrategy.HARDLINK] else OperationKind.COPY
 
         return ImageWriter(
             img_mode=img_mode,
             mask_mode=mask_mode,
-            copy_strategy=copy_strategy.create())
+            output=output if output is not None else FileImageOutput(copy_strategy.create(), output_copy_strategy.create(), ImageEncoder(args.png_compress_level)),
+            metadata_index=metadata_index,
+            copy_kind=copy_kind,
+            target_size=args.target_size,
+            crop=args.crop,
+            resample=args.resample if args.resample is not None else ResampleFilter.BILINEAR)
 
+    @staticmethod
+    def create_file_name(proposed_name: str, format: Optional[ImageFormat]) -> str:
+        # Frames or masks written in a chosen format get its extension
+        if format is None:
+            return proposed_name
+        return os.path.splitext(proposed_name)[0] + format.extension
 
-class SegmentationOutputRecordGenerator(OutputRecordGenerator):
-    def __init__(self, args) -> None:
+    @staticmethod
+    def plan_masks(image_writer: ImageWriter, masks_data: List[MergedMaskData], dest_mask_paths: List[str], frame_path: str, row: int) -> List[Operation]:
+        operations: Dict[str, Operation] = {} # Output path -> operation writing it
+        written_masks = {} # Mask sources -> output path holding them, a source mapped to several classes is written once
+        for mask_data, dest_mask_path in zip(masks_data, dest_mask_paths):
+            mask_sources = tuple((mask_repr.mask_path, mask_repr.color) for mask_repr in mask_data.repr)
+
+            written_mask_path = written_masks.get(mask_sources)
+            if written_mask_path == dest_mask_path:
+                continue
+            if dest_mask_path in operations:
+                # Binary masks of all classes share the path, the mask planned last is the one written
+                del operations[dest_mask_path]
+                written_masks = {sources: path for sources, path in written_masks.items() if path != dest_mask_path}
+
+            if written_mask_path is not None:
+                operations[dest_mask_path] = image_writer.plan_copy_output(written_mask_path, dest_mask_path, row, operations[written_mask_path].estimated_bytes)
+            else:
+                operations[dest_mask_path] = image_writer.plan_mask(mask_data.repr, dest_mask_path, base_img_src=frame_path, row=row)
+            written_masks[mask_sources] = dest_mask_path
+        return list(operations.values())
+
+
+# Records written as separate files are planned as operations of the image writer first. The plan can be listed
+# without writing anything, or executed grouped by kind of operation after all output directories are created.
+# Files of every record are listed, so they can be tracked in a manifest.
+class PlannedOutputRecordGenerator(OutputRecordGenerator):
+    @abstractmethod
+    def plan_output_record(self, data: Tuple[int, Record], type: str) -> List[Operation]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_outputs(self, data: Tuple[int, Record], type: str) -> List[RecordOutput]:
+        raise NotImplementedError
+
+    def generate_output_record(self, data: Tuple[int, Record], type: str) -> None:
+        for operation in self.plan_output_record(data, type):
+            self.execute_operation(operation)
+        self.image_writer.release_images()
+
+    def execute_operation(self, operation: Operation) -> None:
+        self.image_writer.execute(operation)
+
+    def create_dirs(self, dirs: Iterable[str]) -> None:
+        self.image_writer.output.create_dirs(dirs)
+
+    def computed_output_key(self, operation: Operation) -> Optional[Tuple]:
+        # Outputs decoded from equal sources and encoded with equal modes and parameters are equal, also when planned
+        # by generators of other configurations. Copies of sources are not keyed, copying an output costs the same.
+        if operation.kind not in COMPUTED_KINDS:
+            return None
+        mask_sources = tuple((mask_repr.mask_path, mask_repr.color) for mask_repr in operation.mask_reps) if operation.mask_reps is not None else None
+        mode = self.image_writer.img_mode if operation.mask_reps is None else self.image_writer.mask_mode
+        return (str(operation.kind), operation.src, mask_sources, mode, ImageEncoder.format_of(operation.dest), self.image_writer.output.encoder.key(), self.image_writer.resize_key())
+
+
+class SegmentationOutputRecordGenerator(PlannedOutputRecordGenerator):
+    def __init__(self, args, metadata_index: ImageMetadataIndex) -> None:
         self.binary = args.training_type == TrainingType.BINARY_SEG
+        self.frame_format = args.frame_format
+        self.mask_format = args.mask_format
         self.path_creator = SegmentationOutputRecordGenerator.__prepare_path_creator(args)
-        self.image_writer = OutputRecordGenerator.prepare_image_writer(args)
+        self.image_writer = OutputRecordGenerator.prepare_image_writer(args, metadata_index)
+        self.unpacked_masks_reported = False
 
-    def generate_output_record(self, data: Tuple[Hashable, pd.Series], type: str) -> None:
-        (_, record) = data
-        dataset_name = record['dataset']
-        frame_path = record['frame_path']
-        dest_frame_name = record['proposed_name']
-        masks_data = record['mask_data']
+    def plan_output_record(self, data: Tuple[int, Record], type: str) -> List[Operation]:
+        (row, record) = data
+        dataset_name = record.dataset
+        frame_path = record.frame_path
+        dest_frame_name = record.proposed_name
+        masks_data = record.mask_data
+
+        dest_frame_path = self.path_creator.create_frame_path(dataset_type=type, dataset_name=dataset_name, file_name=OutputRecordGenerator.create_file_name(dest_frame_name, self.frame_format))
+        operations = [self.image_writer.plan_frame(frame_path, dest_frame_path, row)]
+
+        dest_mask_paths = [
+            self.path_creator.create_mask_path(dataset_type=type, dataset_name=dataset_name, class_name=mask_data.class_name if not self.binary else None, file_name=OutputRecordGenerator.create_file_name(dest_frame_name, self.mask_format))
+            for mask_data in masks_data]
+        self.__report_unpacked_masks(dest_mask_paths)
+        return operations + OutputRecordGenerator.plan_masks(self.image_writer, masks_data, dest_mask_paths, frame_path, row)
 
-        dest_frame_path = self.path_creator.create_frame_path(dataset_type=type, dataset_name=dataset_name, file_name=dest_frame_name)
-        self.image_writer.write_frame(frame_path, dest_frame_path)
+    def __report_unpacked_masks(self, dest_mask_paths: List[str]) -> None:
+        # Without --mask-format masks keep the format of the frame name, which is known only per record
+        if self.image_writer.mask_mode != '1' or self.unpacked_masks_reported:
+            return
+        formats = {ImageEncoder.format_of(path) for path in dest_mask_paths}.difference(['PNG'])
+        if len(formats) > 0:
+            print(f"[INFO] 1-bit masks are stored in 1 bit per pixel only as PNG, masks are written as {sorted(formats)}. Use '--mask-format png'")
+            self.unpacked_masks_reported = True
 
+    def list_outputs(self, data: Tuple[int, Record], type: str) -> List[RecordOutput]:
+        (_, record) = data
+        dataset_name = record.dataset
+        frame_path = record.frame_path
+        dest_frame_name = record.proposed_name
+        masks_data = record.mask_data
+
+        outputs = [RecordOutput(self.path_creator.create_frame_path(dataset_type=type, dataset_name=dataset_name, file_name=OutputRecordGenerator.create_file_name(dest_frame_name, self.frame_format)), [frame_path])]
         for mask_data in masks_data:
             class_name = mask_data.class_name if not self.binary else None
-            dest_mask_path = self.path_creator.create_mask_path(dataset_type=type, dataset_name=dataset_name, class_name=class_name, file_name=dest_frame_name)
-            self.image_writer.write_mask(mask_data.repr, dest_mask_path, base_img_src=frame_path)
+            dest_mask_path = self.path_creator.create_mask_path(dataset_type=type, dataset_name=dataset_name, class_name=class_name, file_name=OutputRecordGenerator.create_file_name(dest_frame_name, self.mask_format))
+            mask_paths = [mask_repr.mask_path for mask_repr in mask_data.repr if not mask_repr.is_of_color()]
+            outputs.append(RecordOutput(dest_mask_path, [frame_path] + mask_paths))
+        return outputs
 
     @staticmethod
     def __prepare_path_creator(args) -> SegmentationPathCreator:
@@ -66,22 +198,33 @@ class SegmentationOutputRecordGenerator(OutputRecordGenerator):
             ignore_dataset_name=args.path_ignore_dataset_name)
             
 
-class ClassificationOutputRecordGenerator(OutputRecordGenerator):
-    def __init__(self, args) -> None:
+class ClassificationOutputRecordGenerator(PlannedOutputRecordGenerator):
+    def __init__(self, args, metadata_index: ImageMetadataIndex) -> None:
+        self.frame_format = args.frame_format
         self.path_creator = ClassificationOutputRecordGenerator.__prepare_path_creator(args)
-        self.image_writer = OutputRecordGenerator.prepare_image_writer(args)
+        self.image_writer = OutputRecordGenerator.prepare_image_writer(args, metadata_index)
 
-    def generate_output_record(self, data: Tuple[Hashable, pd.Series], type: str) -> None:
-        (_, record) = data
-        dataset_name = record['dataset']
-        frame_path = record['frame_path']
-        dest_frame_name = record['proposed_name']
-        masks_data = record['mask_data']
+    def plan_output_record(self, data: Tuple[int, Record], type: str) -> List[Operation]:
+        (row, record) = data
+        dataset_name = record.dataset
+        frame_path = record.frame_path
+        dest_frame_name = OutputRecordGenerator.create_file_name(record.proposed_name, self.frame_format)
+        masks_data = record.mask_data
 
-        for mask_data in masks_data:
-            dest_frame_path = self.path_creator.create_frame_path(dataset_type=type, dataset_name=dataset_name, class_name=mask_data.class_name, file_name=dest_frame_name)
-            self.image_writer.write_frame(frame_path, dest_frame_path)
+        return [
+            self.image_writer.plan_frame(frame_path, self.path_creator.create_frame_path(dataset_type=type, dataset_name=dataset_name, class_name=mask_data.class_name, file_name=dest_frame_name), row)
+            for mask_data in masks_data]
+
+    def list_outputs(self, data: Tuple[int, Record], type: str) -> List[RecordOutput]:
+        (_, record) = data
+        dataset_name = record.dataset
+        frame_path = record.frame_path
+        dest_frame_name = OutputRecordGenerator.create_file_name(record.proposed_name, self.frame_format)
+        masks_data = record.mask_data
 
+        return [
+            RecordOutput(self.path_creator.create_frame_path(dataset_type=type, dataset_name=dataset_name, class_name=mask_data.class_name, file_name=dest_frame_name), [frame_path])
+            for mask_data in masks_data]
 
     @staticmethod
     def __prepare_path_creator(args) -> SegmentationPathCreator:
@@ -94,3 +237,311 @@ class ClassificationOutputRecordGenerator(OutputRecordGenerator):
             output_path,
             ignore_dataset_type=args.path_ignore_dataset_type,
             ignore_dataset_name=args.path_ignore_dataset_name)
+
+
+# Writes every record as a group of tar members (frame, masks and JSON with class labels) sharing one key
+class ShardOutputRecordGenerator(OutputRecordGenerator):
+    def __init__(self, args, metadata_index: ImageMetadataIndex) -> None:
+        self.binary = args.training_type == TrainingType.BINARY_SEG
+        self.classification = args.training_type == TrainingType.MULTILABEL_CLASSIFICATION
+        self.frame_format = args.frame_format
+        self.mask_format = args.mask_format
+        self.path_creator = ShardPathCreator()
+        self.output = MemoryImageOutput(ImageEncoder(args.png_compress_level))
+        self.image_writer = OutputRecordGenerator.prepare_image_writer(args, metadata_index, self.output)
+        self.shard_writer = ShardOutputRecordGenerator.__prepare_shard_writer(args)
+
+    def generate_output_record(self, data: Tuple[int, Record], type: str) -> List[Tuple[str, bytes]]:
+        (row, record) = data
+        dataset_name = record.dataset
+        frame_path = record.frame_path
+        dest_frame_name = record.proposed_name
+        masks_data = record.mask_data
+
+        key = self.path_creator.create_key(dataset_name=dataset_name, file_name=dest_frame_name)
+        operations = [self.image_writer.plan_frame(frame_path, self.path_creator.create_frame_path(key, file_name=OutputRecordGenerator.create_file_name(dest_frame_name, self.frame_format)), row)]
+        if not self.classification:
+            dest_mask_paths = [
+                self.path_creator.create_mask_path(key, class_name=mask_data.class_name if not self.binary else None, file_name=OutputRecordGenerator.create_file_name(dest_frame_name, self.mask_format))
+                for mask_data in masks_data]
+            operations += OutputRecordGenerator.plan_masks(self.image_writer, masks_data, dest_mask_paths, frame_path, row)
+        # Members of a single record are kept in memory, so its operations are executed right away
+        for operation in operations:
+            self.image_writer.execute(operation)
+        self.image_writer.release_images()
+
+        labels = {
+            'dataset': dataset_name,
+            'name': dest_frame_name,
+            'classes': [mask_data.class_name for mask_data in masks_data]
+        }
+        return self.output.take() + [(self.path_creator.create_labels_path(key), json.dumps(labels).encode())]
+
+    def commit_output_record(self, result: List[Tuple[str, bytes]], type: str) -> None:
+        self.shard_writer.write_sample(type, result)
+
+    def end_split(self, type: str) -> None:
+        self.shard_writer.close(type)
+
+    def __getstate__(self):
+        # Shards are written by the main process only, workers return samples to it
+        state = self.__dict__.copy()
+        state['shard_writer'] = None
+        return state
+
+    @staticmethod
+    def __prepare_shard_writer(args) -> ShardWriter:
+        clean_output = args.force
+        output_path = args.output_path
+        if clean_output:
+            OutputRecordGenerator.clean_output_dir(output_path)
+
+        return ShardWriter(output_path, max_shard_size=args.shard_max_size * 1024 * 1024)
+
+
+# Writes every split as preallocated arrays of frames (N x H x W x C), masks of classes (N x H x W) or labels (N x classes)
+# in .npy files, which are filled in place record by record and can be read with np.load(path, mmap_mode='r')
+class MemmapOutputRecordGenerator(OutputRecordGenerator):
+    def __init__(self, args, metadata_index: ImageMetadataIndex) -> None:
+        self.binary = args.training_type == TrainingType.BINARY_SEG
+        self.classification = args.training_type == TrainingType.MULTILABEL_CLASSIFICATION
+        self.img_mode = args.img_mode
+        self.target_size = args.target_size
+        self.crop = args.crop
+        self.resample = args.resample if args.resample is not None else ResampleFilter.BILINEAR
+        self.metadata_index = metadata_index
+        self.path_creator = MemmapOutputRecordGenerator.__prepare_path_creator(args)
+        self.record_images = RecordImages()
+        self.output = ArrayImageOutput(self.record_images)
+        self.image_writer: Optional[ImageWriter] = None
+        self.frame_size: Optional[Tuple[int, int]] = None
+        self.classes: List[str] = []
+        self.arrays: Dict[str, Dict[str, np.memmap]] = {}
+        self.index_stream = None
+        self.index_writer = None
+
+    def begin_dataset(self, records: Iterable[Record]) -> None:
+        sizes = set()
+        modes = set()
+        classes = set()
+        for record in records:
+            metadata = self.metadata_index.get(record.frame_path)
+            if not metadata.is_image():
+                raise ValueError(f"Frame {record.frame_path} is not an image")
+            sizes.add(metadata.size)
+            modes.add(metadata.mode)
+            classes.update(mask_data.class_name for mask_data in record.mask_data)
+
+        if len(sizes) == 0:
+            return
+        frame_mode = self.__choose_frame_mode(modes)
+        self.frame_size = self.__choose_frame_size(sizes)
+        self.classes = sorted(classes)
+        self.image_writer = ImageWriter(img_mode=frame_mode, mask_mode='L', output=self.output, metadata_index=self.metadata_index, record_images=self.record_images,
+                                        target_size=self.target_size, crop=self.crop, resample=self.resample)
+
+    def begin_split(self, records_count: int, type: str) -> None:
+        if records_count == 0:
+            return
+        (width, height) = self.frame_size
+
+        shapes = {FRAMES_ARRAY: (records_count, height, width, Image.getmodebands(self.image_writer.img_mode))}
+        for array_name in self.__mask_array_names():
+            shapes[array_name] = (records_count, height, width)
+        if self.classification:
+            shapes[LABELS_ARRAY] = (records_count, len(self.classes))
+
+        for array_name, shape in shapes.items():
+            array_path = self.path_creator.create_array_path(type, array_name)
+            os.makedirs(os.path.dirname(array_path), exist_ok=True)
+            # File is allocated without writing its content, rows that are never filled stay zeroed
+            np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8, shape=shape).flush()
+
+        # Rows are appended to the index as they are committed, rows of records that failed are not listed
+        self.index_stream = open(self.path_creator.create_index_path(type), "w", newline="")
+        self.index_writer = csv.writer(self.index_stream)
+        self.index_writer.writerow(['row', 'proposed_name', 'patient_id', 'dataset'])
+
+        info = {
+            'records_count': records_count,
+            'frame_mode': self.image_writer.img_mode,
+            'classes': self.classes,
+            'arrays': {array_name: list(shape) for array_name, shape in shapes.items()}
+        }
+        with open(self.path_creator.create_info_path(type), "w") as stream:
+            json.dump(info, stream, indent=2)
+
+    def generate_output_record(self, data: Tuple[int, Record], type: str) -> List:
+        (row, record) = data
+        frame_path = record.frame_path
+        masks_data = record.mask_data
+        arrays = self.__open_arrays(type)
+
+        operations = [self.image_writer.plan_frame(frame_path, FRAMES_ARRAY, row)]
+        if self.classification:
+            record_classes = {mask_data.class_name for mask_data in masks_data}
+            arrays[LABELS_ARRAY][row] = [class_name in record_classes for class_name in self.classes]
+        else:
+            dest_mask_names = [self.__mask_array_name(mask_data.class_name) for mask_data in masks_data]
+            operations += OutputRecordGenerator.plan_masks(self.image_writer, masks_data, dest_mask_names, frame_path, row)
+        for operation in operations:
+            self.image_writer.execute(operation)
+        self.image_writer.release_images()
+
+        for array_name, img in self.output.take().items():
+            if img.size != self.frame_size:
+                raise ValueError(f"Image written to {array_name} of size {img.size} does not match frame size {self.frame_size}")
+            arrays[array_name][row] = np.asarray(img).reshape(arrays[array_name].shape[1:])
+            metrics.count('bytes_written', arrays[array_name][row].nbytes)
+        return [row, record.proposed_name, record.patient_id, record.dataset]
+
+    def commit_output_record(self, result: List, type: str) -> None:
+        self.index_writer.writerow(result)
+
+    def end_split(self, type: str) -> None:
+        for array in self.arrays.pop(type, {}).values():
+            array.flush()
+        if self.index_stream is not None:
+            self.index_stream.close()
+            self.index_stream = None
+            self.index_writer = None
+
+    def __getstate__(self):
+        # Workers open arrays on their own, mapped memory is shared through the files. Index is written by the main process only
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        state['index_stream'] = None
+        state['index_writer'] = None
+        return state
+
+    def __open_arrays(self, type: str) -> Dict[str, np.memmap]:
+        if type not in self.arrays:
+            array_names = [FRAMES_ARRAY] + self.__mask_array_names() + ([LABELS_ARRAY] if self.classification else [])
+            self.arrays[type] = {
+                array_name: np.load(self.path_creator.create_array_path(type, array_name), mmap_mode='r+')
+                for array_name in array_names}
+        return self.arrays[type]
+
+    def __mask_array_names(self) -> List[str]:
+        if self.classification:
+            return []
+        if self.binary:
+            return [MASKS_ARRAY]
+        return [self.__mask_array_name(class_name) for class_name in self.classes]
+
+    def __mask_array_name(self, class_name: str) -> str:
+        return MASKS_ARRAY if self.binary else f"{MASKS_ARRAY}_{class_name}"
+
+    def __choose_frame_size(self, sizes: Set[Tuple[int, int]]) -> Tuple[int, int]:
+        # Frames of any size are resized to the target size
+        if self.target_size is not None:
+            return self.target_size
+        if len(sizes) > 1:
+            raise ValueError(f"Memmap output requires frames of equal size, found sizes: {sorted(sizes)}. Use --target-size to resize them")
+        return next(iter(sizes))
+
+    def __choose_frame_mode(self, modes: Set[str]) -> str:
+        if self.img_mode is None and len(modes) > 1:
+            raise ValueError(f"Memmap output requires frames of equal mode, found modes: {sorted(modes)}. Use --img-mode to convert them")
+
+        mode = self.img_mode if self.img_mode is not None else next(iter(modes))
+        if Image.getmodetype(mode) != 'L':
+            raise ValueError(f"Memmap output supports only modes with 8-bit channels, got {mode}")
+        return mode
+
+    @staticmethod
+    def __prepare_path_creator(args) -> MemmapPathCreator:
+        clean_output = args.force
+        output_path = args.output_path
+        if clean_output:
+            OutputRecordGenerator.clean_output_dir(output_path)
+
+        return MemmapPathCreator(output_path)
+
+
+# Writes frames as files, like directory output, and masks of every split as run-length encoded annotations in a single
+# COCO-style JSON file, so no file is written per mask. Masks are thresholded as in mode '1'. Constant masks
+# (synthesized from a color or an empty file) are encoded from their value without being drawn.
+class CocoOutputRecordGenerator(OutputRecordGenerator):
+    def __init__(self, args, metadata_index: ImageMetadataIndex) -> None:
+        self.binary = args.training_type == TrainingType.BINARY_SEG
+        self.frame_format = args.frame_format
+        self.output_path = args.output_path
+        self.path_creator = CocoOutputRecordGenerator.__prepare_path_creator(args)
+        self.image_writer = OutputRecordGenerator.prepare_image_writer(args, metadata_index)
+        self.record_images = RecordImages()
+        self.mask_output = ArrayImageOutput(self.record_images)
+        self.mask_writer = ImageWriter(img_mode=None, mask_mode='1', output=self.mask_output, metadata_index=metadata_index, record_images=self.record_images,
+                                       target_size=args.target_size, crop=args.crop, resample=self.image_writer.resample)
+        self.categories: List[str] = []
+        self.annotations_writer: Optional[MaskAnnotationsWriter] = None
+
+    def begin_dataset(self, records: Iterable[Record]) -> None:
+        # Categories are equal in all splits
+        if self.binary:
+            self.categories = [MASK_CATEGORY]
+        else:
+            self.categories = sorted({mask_data.class_name for record in records for mask_data in record.mask_data})
+
+    def begin_split(self, records_count: int, type: str) -> None:
+        if records_count == 0:
+            return
+        self.annotations_writer = MaskAnnotationsWriter(self.path_creator.create_annotations_path(type), self.categories)
+
+    def generate_output_record(self, data: Tuple[int, Record], type: str) -> Tuple[str, Tuple[int, int], List[Tuple[str, List[int]]]]:
+        (row, record) = data
+        frame_path = record.frame_path
+        masks_data = record.mask_data
+
+        dest_frame_path = self.path_creator.create_frame_path(dataset_type=type, dataset_name=record.dataset, file_name=OutputRecordGenerator.create_file_name(record.proposed_name, self.frame_format))
+        self.image_writer.execute(self.image_writer.plan_frame(frame_path, dest_frame_path, row))
+        self.image_writer.release_images()
+        size = self.mask_writer.output_size(self.image_writer.metadata_index.get(frame_path).size)
+
+        dest_mask_names = [MASK_CATEGORY if self.binary else mask_data.class_name for mask_data in masks_data]
+        operations = OutputRecordGenerator.plan_masks(self.mask_writer, masks_data, dest_mask_names, frame_path, row)
+        mask_counts: Dict[str, List[int]] = {}
+        for operation in operations:
+            if operation.kind == OperationKind.SYNTHESIZE:
+                mask_counts[operation.dest] = encode_constant_rle(self.mask_writer.constant_mask_value(operation.mask_reps), size)
+            elif operation.kind != OperationKind.COPY_OUTPUT:
+                self.mask_writer.execute(operation)
+        self.mask_writer.release_images()
+        for mask_name, img in self.mask_output.take().items():
+            if img.size != size:
+                raise ValueError(f"Mask {mask_name} of size {img.size} does not match frame size {size}")
+            mask_counts[mask_name] = encode_rle(np.asarray(img))
+        # Copies of a mask written for another class share its encoding
+        for operation in operations:
+            if operation.kind == OperationKind.COPY_OUTPUT:
+                mask_counts[operation.dest] = mask_counts[operation.src]
+
+        masks = [(mask_name, mask_counts[mask_name]) for mask_name in dict.fromkeys(dest_mask_names)]
+        return os.path.relpath(dest_frame_path, self.output_path), size, masks
+
+    def commit_output_record(self, result: Tuple[str, Tuple[int, int], List[Tuple[str, List[int]]]], type: str) -> None:
+        (file_name, size, masks) = result
+        self.annotations_writer.add_image(file_name, size, masks)
+
+    def end_split(self, type: str) -> None:
+        if self.annotations_writer is not None:
+            self.annotations_writer.close()
+            self.annotations_writer = None
+
+    def __getstate__(self):
+        # Annotations are written by the main process only, workers return encoded masks to it
+        state = self.__dict__.copy()
+        state['annotations_writer'] = None
+        return state
+
+    @staticmethod
+    def __prepare_path_creator(args) -> CocoPathCreator:
+        clean_output = args.force
+        output_path = args.output_path
+        if clean_output:
+            OutputRecordGenerator.clean_output_dir(output_path)
+
+        return CocoPathCreator(
+            output_path,
+            ignore_dataset_type=args.path_ignore_dataset_type,
+            ignore_dataset_name=args.path_ignore_dataset_name)
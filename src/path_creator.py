@@ -28,6 +28,12 @@ class SegmentationPathCreator:
         )
 
 
+class CocoPathCreator(SegmentationPathCreator):
+    # Frames are placed as in directory output, annotations of all splits are next to each other
+    def create_annotations_path(self, dataset_type: str):
+        return os.path.join(self.root, "annotations", f"{dataset_type}.json")
+
+
 class ClassificationPathCreator:
     def __init__(self, root: str, ignore_dataset_type: bool, ignore_dataset_name: bool):
         self.root = root
@@ -42,4 +48,33 @@ class ClassificationPathCreator:
             "" if self.ignore_dataset_name else dataset_name,
             class_name,
             file_name
-        )
\ No newline at end of file
+        )
+
+
+class ShardPathCreator:
+    # Members of one sample share the key, which is everything before the first dot of the member name (WebDataset convention)
+    def create_key(self, dataset_name: str, file_name: str):
+        return f"{dataset_name}/{os.path.splitext(file_name)[0].replace('.', '_')}"
+
+    def create_frame_path(self, key: str, file_name: str):
+        return f"{key}.frame{os.path.splitext(file_name)[1]}"
+
+    def create_mask_path(self, key: str, class_name: Optional[str], file_name: str):
+        return f"{key}.{'mask' if class_name is None else f'mask_{class_name}'}{os.path.splitext(file_name)[1]}"
+
+    def create_labels_path(self, key: str):
+        return f"{key}.json"
+
+
+class MemmapPathCreator:
+    def __init__(self, root: str):
+        self.root = root
+
+    def create_array_path(self, dataset_type: str, array_name: str):
+        return os.path.join(self.root, dataset_type, f"{array_name}.npy")
+
+    def create_index_path(self, dataset_type: str):
+        return os.path.join(self.root, dataset_type, "index.csv")
+
+    def create_info_path(self, dataset_type: str):
+        return os.path.join(self.root, dataset_type, "info.json")
@@ -0,0 +1,34 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+from PIL import Image
+from src.metrics import metrics
+
+
+# Images decoded for outputs of a single record. Every source is decoded at most once and every conversion of it is
+# done once, all outputs of the record share them. Images are released when operations of another record begin and
+# when the caller releases them, e.g. at the end of a chunk, since rows of records start over in every split.
+class RecordImages:
+    def __init__(self) -> None:
+        self.row: Optional[int] = None
+        self.images: Dict[Hashable, Any] = {}
+
+    def begin(self, row: int) -> None:
+        if row != self.row:
+            self.row = row
+            self.images = {}
+
+    def release(self) -> None:
+        self.row = None
+        self.images = {}
+
+    def decode(self, src: str, open_image: Callable[[], Image.Image]) -> Image.Image:
+        # Decoded source, open_image is called only for the first output of the record that needs it
+        key = (src, 'decoded')
+        if key in self.images:
+            metrics.count('image_decodes_reused')
+        return self.get(key, open_image)
+
+    def get(self, key: Hashable, create: Callable[[], Any]) -> Any:
+        # Images are never modified, so cached ones can be returned to every caller
+        if key not in self.images:
+            self.images[key] = create()
+        return self.images[key]
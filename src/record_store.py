@@ -0,0 +1,72 @@
+import os
+import pickle
+import sqlite3
+import tempfile
+import pandas as pd
+from typing import Iterator, List, Tuple
+from src.structs import Record
+
+PENDING_RECORDS_LIMIT = 1000
+FETCH_BATCH_SIZE = 500
+
+
+# Scanned records are spilled to a temporary SQLite file, so memory does not grow with the size of the dataset.
+# Only ids, frame paths and patients of all records are loaded at once, to decide the split.
+class RecordStore:
+    def __init__(self) -> None:
+        self.directory = tempfile.TemporaryDirectory(prefix="endoscopy-records-")
+        self.connection = sqlite3.connect(os.path.join(self.directory.name, "records.sqlite"))
+        self.connection.execute(
+            "CREATE TABLE records (id INTEGER PRIMARY KEY, dataset TEXT, patient_id TEXT, frame_path TEXT, proposed_name TEXT, mask_data BLOB)")
+        self.pending_records: List[Tuple] = []
+        self.records_count = 0
+
+    def add(self, record: Record) -> None:
+        self.pending_records.append((
+            record.dataset,
+            record.patient_id,
+            record.frame_path,
+            record.proposed_name,
+            pickle.dumps(record.mask_data, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.records_count += 1
+        if len(self.pending_records) >= PENDING_RECORDS_LIMIT:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.pending_records) == 0:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO records (dataset, patient_id, frame_path, proposed_name, mask_data) VALUES (?, ?, ?, ?, ?)",
+                self.pending_records)
+        self.pending_records = []
+
+    def load_split_table(self) -> pd.DataFrame:
+        self.flush()
+        return pd.read_sql_query("SELECT id, frame_path, patient_id FROM records ORDER BY id", self.connection)
+
+    def iter_records(self, ids: List[int]) -> Iterator[Record]:
+        # Records are yielded in order of given ids, fetched in batches
+        self.flush()
+        for batch_start in range(0, len(ids), FETCH_BATCH_SIZE):
+            batch_ids = ids[batch_start:batch_start + FETCH_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT id, dataset, patient_id, frame_path, proposed_name, mask_data FROM records WHERE id IN ({','.join('?' * len(batch_ids))})",
+                batch_ids)
+            records_by_id = {row[0]: RecordStore.__to_record(row) for row in rows}
+            for id in batch_ids:
+                yield records_by_id[id]
+
+    def iter_all_records(self) -> Iterator[Record]:
+        self.flush()
+        for row in self.connection.execute("SELECT id, dataset, patient_id, frame_path, proposed_name, mask_data FROM records ORDER BY id"):
+            yield RecordStore.__to_record(row)
+
+    def close(self) -> None:
+        self.connection.close()
+        self.directory.cleanup()
+
+    @staticmethod
+    def __to_record(row: Tuple) -> Record:
+        (_, dataset, patient_id, frame_path, proposed_name, mask_data) = row
+        return Record(dataset, patient_id, frame_path, proposed_name, pickle.loads(mask_data))
@@ -0,0 +1,19 @@
+from src.extended_enum import ExtendedEnum
+from PIL import Image
+
+
+# Filters of PIL used to resize frames, masks are always resized with NEAREST so they keep their values
+class ResampleFilter(ExtendedEnum):
+    NEAREST = "nearest"
+    BOX = "box"
+    BILINEAR = "bilinear"
+    HAMMING = "hamming"
+    BICUBIC = "bicubic"
+    LANCZOS = "lanczos"
+
+    def __str__(self):
+        return self.value.lower()
+
+    @property
+    def pil_filter(self) -> Image.Resampling:
+        return Image.Resampling[self.name]
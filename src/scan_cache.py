@@ -0,0 +1,70 @@
+import json
+import os
+import pickle
+import sqlite3
+from typing import Any, List, Optional, Tuple
+
+PENDING_ENTRIES_LIMIT = 100
+# Directories modified shortly before they were scanned may still change within the same mtime tick,
+# their scans are not cached
+RACY_INTERVAL_NS = 2 * 10**9
+
+# Modification time and number of entries of every scanned directory, None for a missing one
+DirsState = List[Optional[List[int]]]
+
+
+# Scans of source directories are kept in a SQLite file between runs. A scan is reused as long as modification times
+# and numbers of entries of its directories did not change, so only directories with added, removed or renamed files
+# are scanned again. Files modified in place (e.g. a mask truncated to an empty file) are not detected.
+class ScanCache:
+    def __init__(self, cache_path: Optional[str]) -> None:
+        self.cache_path = cache_path
+        self.pending_entries: List[Tuple[str, str, bytes]] = []
+        self.connection = None
+
+    def get(self, path: str) -> Optional[Tuple[DirsState, Any]]:
+        if self.cache_path is None:
+            return None
+        row = self.__connect().execute("SELECT state, scan FROM scans WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        (state, scan) = row
+        return json.loads(state), pickle.loads(scan)
+
+    def put(self, path: str, state: DirsState, scan: Any) -> None:
+        if self.cache_path is None:
+            return
+        self.pending_entries.append((os.path.abspath(path), json.dumps(state), pickle.dumps(scan, protocol=pickle.HIGHEST_PROTOCOL)))
+        if len(self.pending_entries) >= PENDING_ENTRIES_LIMIT:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.pending_entries) == 0:
+            return
+        connection = self.__connect()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO scans (path, state, scan) VALUES (?, ?, ?)", self.pending_entries)
+        self.pending_entries = []
+
+    # Methods below do not use the connection, so they can be called from scanning threads
+    @staticmethod
+    def read_state(dirs: List[str]) -> DirsState:
+        state = []
+        for dir in dirs:
+            try:
+                stat = os.stat(dir)
+                with os.scandir(dir) as entries:
+                    state.append([stat.st_mtime_ns, sum(1 for _ in entries)])
+            except FileNotFoundError:
+                state.append(None)
+        return state
+
+    @staticmethod
+    def is_stable(state: DirsState, scan_start_ns: int) -> bool:
+        return all(dir_state is None or dir_state[0] < scan_start_ns - RACY_INTERVAL_NS for dir_state in state)
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.cache_path, timeout=60)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS scans (path TEXT PRIMARY KEY, state TEXT, scan BLOB)")
+        return self.connection
@@ -0,0 +1,67 @@
+import io
+import os
+import tarfile
+from typing import Dict, List, Tuple
+from src.metrics import metrics
+
+TAR_BLOCK_SIZE = 512
+
+
+class Shard:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tar = tarfile.open(path, "w")
+        self.size = 0
+        self.samples_count = 0
+
+    def write_sample(self, members: List[Tuple[str, bytes]]) -> None:
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            self.tar.addfile(info, io.BytesIO(content))
+        self.size += Shard.estimate_size(members)
+        self.samples_count += 1
+        metrics.count('bytes_written', sum(len(content) for _, content in members))
+
+    def close(self) -> None:
+        self.tar.close()
+
+    @staticmethod
+    def estimate_size(members: List[Tuple[str, bytes]]) -> int:
+        # Every member takes a header block and its content padded to full blocks
+        return sum(TAR_BLOCK_SIZE + -(-len(content) // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE for _, content in members)
+
+
+# Streams samples of each split into consecutive tar files ({split}-000000.tar, {split}-000001.tar, ...).
+# A new shard is started when the next sample would exceed the size limit, samples are never split between shards.
+class ShardWriter:
+    def __init__(self, output_path: str, max_shard_size: int) -> None:
+        self.output_path = output_path
+        self.max_shard_size = max_shard_size
+        self.shards: Dict[str, Shard] = {}
+        self.shards_count: Dict[str, int] = {}
+
+    def write_sample(self, split: str, members: List[Tuple[str, bytes]]) -> None:
+        shard = self.shards.get(split)
+        if shard is not None and shard.samples_count > 0 and shard.size + Shard.estimate_size(members) > self.max_shard_size:
+            self.close(split)
+            shard = None
+        if shard is None:
+            shard = self.__open_shard(split)
+        shard.write_sample(members)
+
+    def close(self, split: str) -> None:
+        shard = self.shards.pop(split, None)
+        if shard is not None:
+            shard.close()
+            print(f"Written shard {shard.path} with {shard.samples_count} samples")
+
+    def __open_shard(self, split: str) -> Shard:
+        shard_index = self.shards_count.get(split, 0)
+        self.shards_count[split] = shard_index + 1
+
+        os.makedirs(self.output_path, exist_ok=True)
+        shard = Shard(os.path.join(self.output_path, f"{split}-{shard_index:06d}.tar"))
+        self.shards[split] = shard
+        return shard
@@ -0,0 +1,9 @@
+from src.extended_enum import ExtendedEnum
+
+
+class SplitMode(ExtendedEnum):
+    GROUP_SHUFFLE = "group-shuffle"
+    HASH = "hash"
+
+    def __str__(self):
+        return self.value.lower()
@@ -1,25 +1,77 @@
+import csv
+import hashlib
 import pandas as pd
 import numpy as np
 from sklearn.model_selection import GroupShuffleSplit
-from typing import Tuple
+from typing import Dict, Optional, Tuple
+from src.split_mode import SplitMode
+
+DEFAULT_SPLIT_SEED = 42
+SPLIT_TYPES = ['train', 'validation', 'test']
 
 class DataSplitter:
-    def __init__(self, train_part: float, val_part: float):
+    def __init__(self, train_part: float, val_part: float, mode: SplitMode = SplitMode.GROUP_SHUFFLE, seed: int = DEFAULT_SPLIT_SEED, import_path: Optional[str] = None, export_path: Optional[str] = None):
         self.train_part = train_part
         self.val_part = val_part
-        self.random_state = 42
+        self.mode = mode
+        self.random_state = seed
+        # Imported groups keep their split in any mode, other groups are then assigned by hash
+        self.imported_splits = DataSplitter.__read_splits(import_path) if import_path is not None else {}
+        self.export_path = export_path
 
+    # Data is a table of record ids, frame paths and patient ids, split records are referenced by their ids
     def split_and_prepare(self, data: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:   
         if data.size == 0:
             print("Data size is 0. Nothing to prepare")
-            return (pd.DataFrame(), pd.DataFrame(), pd.DataFrame())
+            return (data.iloc[:0,:].copy(), data.iloc[:0,:].copy(), data.iloc[:0,:].copy())
 
         if not 'patient_id' in data.columns:
             data['patient_id'] = pd.Series()
+        # Records are grouped by patient, records without patient (e.g. Hyperkvasir) are groups of their own
+        data['group'] = data['patient_id'].where(data['patient_id'].notna(), data['frame_path']).astype(str)
         data = self.__fill_empty_patients_id(data)
         data.sort_values(by=['frame_path'], inplace=True)
 
-        return (self.__prepare(x) for x in self.__split(data))
+        if self.mode == SplitMode.HASH or len(self.imported_splits) > 0:
+            splits = self.__split_by_hash(data)
+        else:
+            splits = self.__split(data)
+        if self.export_path is not None:
+            self.__write_splits(splits)
+        return (self.__prepare(x) for x in splits)
+
+    def __split_by_hash(self, data: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        # Split of a group depends on its key and the seed only, so groups never move when others are added or removed
+        (group_codes, groups) = pd.factorize(data['group'])
+        group_splits = np.array([self.__assign_split(group) for group in groups], dtype=np.int64)
+        record_splits = group_splits[group_codes]
+        return tuple(data[record_splits == split] for split in range(len(SPLIT_TYPES)))
+
+    def __assign_split(self, group: str) -> int:
+        if group in self.imported_splits:
+            return SPLIT_TYPES.index(self.imported_splits[group])
+        digest = hashlib.blake2b(f"{self.random_state}:{group}".encode(), digest_size=8).digest()
+        position = int.from_bytes(digest, 'big') / 2**64 # Uniform in [0, 1)
+        if position < self.train_part:
+            return 0
+        return 1 if position < self.train_part + self.val_part else 2
+
+    def __write_splits(self, splits: Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]) -> None:
+        rows = sorted((group, type) for type, split in zip(SPLIT_TYPES, splits) for group in split['group'].unique())
+        with open(self.export_path, "w", newline="") as stream:
+            writer = csv.writer(stream)
+            writer.writerow(['group', 'split'])
+            writer.writerows(rows)
+        print(f"Split of {len(rows)} groups written to {self.export_path}")
+
+    @staticmethod
+    def __read_splits(import_path: str) -> Dict[str, str]:
+        with open(import_path, "r", newline="") as stream:
+            splits = {row['group']: row['split'] for row in csv.DictReader(stream)}
+        unknown_splits = set(splits.values()).difference(SPLIT_TYPES)
+        if len(unknown_splits) > 0:
+            raise ValueError(f"Unknown splits {sorted(unknown_splits)} in {import_path}, expected one of {SPLIT_TYPES}")
+        return splits
     
     def __split(self, data: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
         train_part = self.train_part
@@ -34,21 +86,19 @@ class DataSplitter:
             return data, data.iloc[:0,:].copy(), data.iloc[:0,:].copy()
 
         X = data
-        y = data[['mask_data']]
         groups = data[['patient_id']]
-        train_idx, temp_idx = self.__split_with_boundary_awareness(train_part, X, y, groups)
+        train_idx, temp_idx = self.__split_with_boundary_awareness(train_part, X, groups)
 
         X_temp = data.iloc[temp_idx]
-        y_temp = X_temp[['mask_data']]
         groups_temp = X_temp[['patient_id']]
 
         rel_test_part = test_part / (test_part + val_part)
         rel_val_part = 1.0 - rel_test_part
-        val_idx, test_idx = self.__split_with_boundary_awareness(rel_val_part, X_temp, y_temp, groups_temp)
+        val_idx, test_idx = self.__split_with_boundary_awareness(rel_val_part, X_temp, groups_temp)
 
         return data.iloc[train_idx], X_temp.iloc[val_idx], X_temp.iloc[test_idx]
 
-    def __split_with_boundary_awareness(self, train_size: float, X: pd.DataFrame, y, groups):
+    def __split_with_boundary_awareness(self, train_size: float, X: pd.DataFrame, groups):
         if train_size == 1.0:
             return range(X.shape[0]), []
 
@@ -56,12 +106,12 @@ class DataSplitter:
             return [], range(X.shape[0])
         
         gss = GroupShuffleSplit(train_size=train_size, random_state=self.random_state, n_splits=1)
-        return next(gss.split(X, y, groups))
+        return next(gss.split(X, groups=groups))
 
     def __prepare(self, data: pd.DataFrame) -> pd.DataFrame:
         data = self.__shuffle_data(data)
-        data = self.__drop_unnecessary_data(data)
-        return data
+        # Index is the position of a record within its split, patient_id stays to trace records back to patients
+        return data.reset_index(drop=True)
 
     def __fill_empty_patients_id(self, df: pd.DataFrame) -> pd.DataFrame:
         update_df = pd.DataFrame(np.arange(len(df), 2*len(df)), columns=['patient_id'])
@@ -70,7 +120,5 @@ class DataSplitter:
         return df
 
     def __shuffle_data(self, data: pd.DataFrame) -> pd.DataFrame:
-        return data.iloc[np.random.permutation(len(data))]
-
-    def __drop_unnecessary_data(self, data: pd.DataFrame) -> pd.DataFrame:
-        return data.drop("patient_id", axis='columns', errors='ignore')
+        # Seeded, so order of records in every split is the same in every run
+        return data.iloc[np.random.default_rng(self.random_state).permutation(len(data))]
@@ -1,18 +1,37 @@
+import os
+import sys
 from enum import Enum
-from typing import List
+from typing import List, Optional, Tuple
+from src.operation_kind import OperationKind
+
+# Records are held and pickled in large numbers, so structs below have no per-instance __dict__
+# and class names, which repeat in every record, are interned. Paths are kept as an interned directory,
+# shared by all files of a data directory, and a file name.
+
+def split_path(path: str) -> Tuple[str, str]:
+    # Directory keeps its trailing separator, so concatenation gives back exactly the same path
+    (dir, separator, name) = path.rpartition(os.sep)
+    return sys.intern(dir + separator), name
 
 class MaskColor(Enum):
     BLACK = "black",
     WHITE = "white"
 
 class MaskRepresentation:
+    __slots__ = ('mask_dir', 'mask_name', 'color')
+
     def __init__(self, mask_path: str, color: MaskColor) -> None:
-        self.mask_path = mask_path
+        (self.mask_dir, self.mask_name) = split_path(mask_path) if mask_path is not None else (None, None)
         self.color = color
 
+    @property
+    def mask_path(self) -> Optional[str]:
+        return self.mask_dir + self.mask_name if self.mask_name is not None else None
+
     @staticmethod
     def of_color(color: MaskColor):
-        return MaskRepresentation(color=color, mask_path=None)
+        # Representations are never modified, so one instance per color is shared by all records
+        return COLOR_REPRESENTATIONS[color]
         
     @staticmethod
     def of_path(mask_path: str):
@@ -21,12 +40,64 @@ class MaskRepresentation:
     def is_of_color(self): 
         return self.color is not None
 
-class UnmergedMaskData:
-    def __init__(self, class_name: str, path: str) -> None:
-        self.class_name = class_name
-        self.mask_path = path
+    def __reduce__(self):
+        # Unpickled representations of colors are the shared ones as well
+        if self.is_of_color():
+            return (MaskRepresentation.of_color, (self.color,))
+        return (MaskRepresentation.of_path, (self.mask_path,))
+
+COLOR_REPRESENTATIONS = {color: MaskRepresentation(mask_path=None, color=color) for color in MaskColor}
 
 class MergedMaskData:
+    __slots__ = ('class_name', 'repr')
+
     def __init__(self, class_name: str, repr: List[MaskRepresentation]) -> None:
-        self.class_name = class_name
-        self.repr = repr
\ No newline at end of file
+        self.class_name = sys.intern(class_name)
+        self.repr = repr
+
+    def __reduce__(self):
+        return (MergedMaskData, (self.class_name, self.repr))
+
+class RecordOutput:
+    __slots__ = ('path', 'sources')
+
+    def __init__(self, path: str, sources: List[str]) -> None:
+        self.path = path
+        self.sources = sources
+
+class Record:
+    __slots__ = ('dataset', 'patient_id', 'frame_dir', 'frame_name', 'proposed_name', 'mask_data')
+
+    def __init__(self, dataset: str, patient_id: Optional[str], frame_path: str, proposed_name: str, mask_data: List[MergedMaskData]) -> None:
+        self.dataset = sys.intern(dataset)
+        self.patient_id = sys.intern(patient_id) if patient_id is not None else None
+        (self.frame_dir, self.frame_name) = split_path(frame_path)
+        self.proposed_name = proposed_name
+        self.mask_data = mask_data
+
+    @property
+    def frame_path(self) -> str:
+        return self.frame_dir + self.frame_name
+
+    def __reduce__(self):
+        return (Record, (self.dataset, self.patient_id, self.frame_path, self.proposed_name, self.mask_data))
+
+class Operation:
+    __slots__ = ('kind', 'row', 'dest', 'src', 'mask_reps', 'source_bytes', 'estimated_bytes', 'fallback')
+
+    # Source of a mask operation is the frame of the record, masks are sized and colored after it.
+    # Fallback of a copy of an output computed for another record or configuration computes it from sources again,
+    # in case the copied output was not written.
+    def __init__(self, kind: OperationKind, row: int, dest: str, src: str, mask_reps: Optional[List[MaskRepresentation]], source_bytes: int, estimated_bytes: int,
+                 fallback: Optional['Operation'] = None) -> None:
+        self.kind = kind
+        self.row = row
+        self.dest = dest
+        self.src = src
+        self.mask_reps = mask_reps
+        self.source_bytes = source_bytes
+        self.estimated_bytes = estimated_bytes
+        self.fallback = fallback
+
+    def __reduce__(self):
+        return (Operation, (self.kind, self.row, self.dest, self.src, self.mask_reps, self.source_bytes, self.estimated_bytes, self.fallback))
@@ -1,10 +1,4 @@
-from enum import Enum
-
-
-class ExtendedEnum(Enum):
-    @classmethod
-    def list(cls):
-        return list(map(lambda c: c.value, cls))
+from src.extended_enum import ExtendedEnum
 
 
 class TrainingType(ExtendedEnum):
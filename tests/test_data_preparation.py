@@ -1,7 +1,85 @@
+import contextlib
+import csv
+import errno
+import filecmp
+import io
+import json
+import os
+import re
+import shutil
+import struct
+import tarfile
+import time
 import main as program
+import merge_partitions
+import numpy as np
 import unittest
+import yaml
+from unittest import mock
+from PIL import Image
 
 from tests.file_comperer import are_dir_trees_equal
+from src.output_manifest import MANIFEST_FILE_NAME, partial_file_name
+from src.mask_annotations import MaskAnnotations
+from src.image_metadata_index import ImageMetadata
+from src.output_record_generator import MemmapOutputRecordGenerator, PlannedOutputRecordGenerator
+from src.structs import Record
+from src.copy_strategy import CopyStrategy
+
+
+# FLEVEL field of the zlib header starting the first IDAT chunk, 0 for the fastest levels and 3 for the best ones
+def png_zlib_level(path):
+    with open(path, "rb") as file:
+        file.read(8)
+        while True:
+            (length, kind) = struct.unpack(">I4s", file.read(8))
+            if kind == b"IDAT":
+                return file.read(2)[1] >> 6
+            file.seek(length + 4, os.SEEK_CUR)
+
+
+# Labels of earlier sequences are listed with a delay, so concurrent scans of later directories complete first
+def scandir_with_delays(scandir):
+    def delayed_scandir(path="."):
+        if str(path).endswith(os.path.join("seq_a", "labels")):
+            time.sleep(0.05)
+        return scandir(path)
+    return delayed_scandir
+
+
+# Directories modified less than 2 seconds before a scan are not cached, so tests date them back
+def set_dirs_mtime(root, mtime):
+    for directory, _, _ in os.walk(root):
+        os.utime(directory, (mtime, mtime))
+
+
+# Inode and modification time of every output file except the manifest, a rewritten file gets new ones
+def snapshot_files(root):
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name == MANIFEST_FILE_NAME:
+                continue
+            path = os.path.join(directory, name)
+            stat = os.lstat(path)
+            files[os.path.relpath(path, root)] = (stat.st_ino, stat.st_mtime_ns)
+    return files
+
+
+def run_and_count_skipped(args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        program.main(args)
+    return sum(int(count) for count in re.findall(r"Skipped (\d+) up-to-date images", output.getvalue()))
+
+
+# Metadata of frames given up front, to check frames of dataset without reading files
+class FixedMetadataIndex:
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def get(self, path):
+        return self.metadata[path]
 
 
 class TestDataPreparation(unittest.TestCase):
@@ -67,3 +145,714 @@ class TestDataPreparation(unittest.TestCase):
         )
         result = are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/expected_data")
         self.assertTrue(result)
+
+    def test_multilabel_classification_with_workers(self):
+        program.main(
+            [
+                "--ers-path",
+                "ers",
+                "--ers-class-mapper-path",
+                "multilabel-classification/4-class.yaml",
+                "--ers-use-empty-masks",
+                "--training-type",
+                "multilabel-classification",
+                "--train-size",
+                "1",
+                "--workers",
+                "2",
+                "-f",
+                "--output-path",
+                "multilabel-classification/data"
+            ]
+        )
+        result = are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/expected_data")
+        self.assertTrue(result)
+
+    def test_multilabel_classification_incremental_rerun(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-class-mapper-path",
+            "multilabel-classification/4-class.yaml",
+            "--ers-use-empty-masks",
+            "--training-type",
+            "multilabel-classification",
+            "--train-size",
+            "1",
+            "--incremental",
+            "--output-path",
+            "multilabel-classification/data"
+        ]
+        self.assertEqual(run_and_count_skipped(args + ["-f"]), 0)
+        files = snapshot_files("multilabel-classification/data")
+        self.assertEqual(run_and_count_skipped(args), 5)
+        self.assertEqual(snapshot_files("multilabel-classification/data"), files)
+        result = are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/expected_data", ignore=[MANIFEST_FILE_NAME])
+        self.assertTrue(result)
+
+    def test_multilabel_classification_incremental_rerun_after_source_change(self):
+        shutil.rmtree("multilabel-classification/data", ignore_errors=True)
+        shutil.copytree("ers", "multilabel-classification/data/ers")
+        args = [
+            "--ers-path",
+            "multilabel-classification/data/ers",
+            "--ers-class-mapper-path",
+            "multilabel-classification/4-class.yaml",
+            "--ers-use-empty-masks",
+            "--training-type",
+            "multilabel-classification",
+            "--train-size",
+            "1",
+            "--copy-strategy",
+            "duplicate",
+            "--incremental",
+            "--output-path",
+            "multilabel-classification/data/output"
+        ]
+        run_and_count_skipped(args + ["-f"])
+        files = snapshot_files("multilabel-classification/data/output")
+        changed_frame_path = "multilabel-classification/data/ers/0001/samples/frames/000002.png"
+        stat = os.stat(changed_frame_path)
+        os.utime(changed_frame_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        self.assertEqual(run_and_count_skipped(args), 4)
+        changed_files = {path for path, file in snapshot_files("multilabel-classification/data/output").items() if files.get(path) != file}
+        self.assertTrue(len(changed_files) > 0)
+        self.assertTrue(all(os.path.basename(path) == "0001_samples_000002.png" for path in changed_files))
+
+    def test_hash_split_imported(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-class-mapper-path",
+            "multilabel-seg/2-class.yaml",
+            "--ers-use-seq",
+            "--training-type",
+            "multilabel-seg",
+            "--train-size",
+            "0.5",
+            "--test-size",
+            "0.5",
+            "-f"
+        ]
+        os.makedirs("multilabel-seg/data", exist_ok=True)
+        program.main(args + ["--split-mode", "hash", "--split-out", "multilabel-seg/data/split.csv", "--output-path", "multilabel-seg/data/hash"])
+        program.main(args + ["--split-seed", "7", "--split-in", "multilabel-seg/data/split.csv", "--output-path", "multilabel-seg/data/imported"])
+        result = are_dir_trees_equal("multilabel-seg/data/hash", "multilabel-seg/data/imported")
+        self.assertTrue(result)
+
+    def test_coco_masks_match_directory_masks(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-class-mapper-path",
+            "multilabel-seg/2-class.yaml",
+            "--ers-use-seq",
+            "--ers-use-empty-masks",
+            "--training-type",
+            "multilabel-seg",
+            "--train-size",
+            "1",
+            "-f"
+        ]
+        program.main(args + ["--mask-mode", "1", "--output-path", "multilabel-seg/data/directory"])
+        program.main(args + ["--output-format", "coco", "--output-path", "multilabel-seg/data/coco"])
+        annotations = MaskAnnotations("multilabel-seg/data/coco/annotations/train.json")
+        self.assertTrue(len(annotations.file_names()) > 0)
+        for file_name in annotations.file_names():
+            self.assertTrue(os.path.lexists(os.path.join("multilabel-seg/data/coco", file_name)))
+            for class_name, mask in annotations.masks(file_name).items():
+                mask_path = os.path.join("multilabel-seg/data/directory", file_name.replace("/images/", f"/masks/{class_name}/"))
+                self.assertTrue(np.array_equal(mask, np.asarray(Image.open(mask_path))))
+
+    def test_multilabel_classification_partitions_merged(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-class-mapper-path",
+            "multilabel-classification/4-class.yaml",
+            "--ers-use-empty-masks",
+            "--training-type",
+            "multilabel-classification",
+            "--train-size",
+            "1",
+            "--num-partitions",
+            "2",
+            "--output-path",
+            "multilabel-classification/data"
+        ]
+        shutil.rmtree("multilabel-classification/data", ignore_errors=True) # Partitions share the output directory, so it is not cleared with -f
+        program.main(args + ["--partition-index", "1"])
+        program.main(args + ["--partition-index", "0"])
+        merge_partitions.main(["multilabel-classification/data"])
+        manifest_names = [MANIFEST_FILE_NAME] + [partial_file_name(MANIFEST_FILE_NAME, (index, 2)) for index in range(2)]
+        result = are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/expected_data", ignore=manifest_names)
+        self.assertTrue(result)
+
+    def test_shards_match_directory_output(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-class-mapper-path",
+            "multilabel-seg/2-class.yaml",
+            "--ers-use-seq",
+            "--ers-use-empty-masks",
+            "--training-type",
+            "multilabel-seg",
+            "--train-size",
+            "1",
+            "-f"
+        ]
+        program.main(args + ["--copy-strategy", "duplicate", "--output-path", "multilabel-seg/data/directory"])
+        program.main(args + ["--output-format", "shards", "--output-path", "multilabel-seg/data/shards"])
+        images_count = 0
+        with tarfile.open("multilabel-seg/data/shards/train-000000.tar") as shard:
+            for member in shard.getmembers():
+                if not member.name.endswith(".png"):
+                    continue
+                (key, part, extension) = member.name.rsplit(".", 2)
+                (dataset_name, frame_name) = key.split("/")
+                directory = "images" if part == "frame" else os.path.join("masks", part[len("mask_"):])
+                image = Image.open(io.BytesIO(shard.extractfile(member).read()))
+                expected_image = Image.open(os.path.join("multilabel-seg/data/directory/train", dataset_name, directory, f"{frame_name}.{extension}"))
+                self.assertTrue(np.array_equal(np.asarray(image), np.asarray(expected_image)))
+                images_count += 1
+        self.assertEqual(images_count, sum(len(files) for _, _, files in os.walk("multilabel-seg/data/directory")))
+
+    def test_memmap_matches_directory_output(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-class-mapper-path",
+            "multilabel-seg/2-class.yaml",
+            "--ers-use-seq",
+            "--ers-use-empty-masks",
+            "--training-type",
+            "multilabel-seg",
+            "--train-size",
+            "1",
+            "--img-mode",
+            "RGB",
+            "-f"
+        ]
+        program.main(args + ["--mask-mode", "L", "--copy-strategy", "duplicate", "--output-path", "multilabel-seg/data/directory"])
+        program.main(args + ["--output-format", "memmap", "--output-path", "multilabel-seg/data/memmap"])
+        frames = np.load("multilabel-seg/data/memmap/train/frames.npy", mmap_mode='r')
+        with open("multilabel-seg/data/memmap/train/index.csv", "r", newline="") as stream:
+            index = list(csv.DictReader(stream))
+        self.assertEqual(len(index), frames.shape[0])
+        for entry in index:
+            row = int(entry['row'])
+            expected_frame = Image.open(os.path.join("multilabel-seg/data/directory/train/ers/images", entry['proposed_name']))
+            self.assertTrue(np.array_equal(frames[row], np.asarray(expected_frame)))
+            for class_name in ["disease", "normal"]:
+                masks = np.load(f"multilabel-seg/data/memmap/train/masks_{class_name}.npy", mmap_mode='r')
+                mask_path = os.path.join("multilabel-seg/data/directory/train/ers/masks", class_name, entry['proposed_name'])
+                expected_mask = np.asarray(Image.open(mask_path)) if os.path.isfile(mask_path) else np.zeros(masks.shape[1:], dtype=np.uint8)
+                self.assertTrue(np.array_equal(masks[row], expected_mask))
+
+    def test_memmap_rejects_frames_of_different_sizes_and_modes(self):
+        args = program.parse_args(["--ers-path", "ers", "--training-type", "multilabel-seg", "--output-format", "memmap", "--output-path", "multilabel-seg/data/rejected"])
+        records = [Record("ers", "0001", "1.png", "1.png", []), Record("ers", "0001", "2.png", "2.png", [])]
+        different_sizes = FixedMetadataIndex({"1.png": ImageMetadata(768, 576, "RGB", 1, 0), "2.png": ImageMetadata(640, 480, "RGB", 1, 0)})
+        with self.assertRaisesRegex(ValueError, "frames of equal size"):
+            MemmapOutputRecordGenerator(args, different_sizes).begin_dataset(records)
+        different_modes = FixedMetadataIndex({"1.png": ImageMetadata(768, 576, "RGB", 1, 0), "2.png": ImageMetadata(768, 576, "L", 1, 0)})
+        with self.assertRaisesRegex(ValueError, "frames of equal mode"):
+            MemmapOutputRecordGenerator(args, different_modes).begin_dataset(records)
+
+    def test_configs_fan_out_matches_separate_runs(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-use-empty-masks",
+            "--train-size",
+            "1",
+            "--img-mode",
+            "L",
+            "--copy-strategy",
+            "duplicate",
+            "-f"
+        ]
+        configs = [
+            {"training-type": "multilabel-seg", "ers-class-mapper-path": "multilabel-seg/2-class.yaml", "output-path": "multilabel-seg/data/fan-out/seg"},
+            {"training-type": "binary-seg", "ers-class-mapper-path": "binary-seg/2-class.yaml", "output-path": "multilabel-seg/data/fan-out/binary"},
+            {"training-type": "multilabel-classification", "ers-class-mapper-path": "multilabel-classification/4-class.yaml", "output-path": "multilabel-seg/data/fan-out/classification"}
+        ]
+        os.makedirs("multilabel-seg/data", exist_ok=True)
+        with open("multilabel-seg/data/configs.yaml", "w") as stream:
+            yaml.safe_dump(configs, stream)
+        program.main(args + ["--configs-path", "multilabel-seg/data/configs.yaml", "--metrics-out", "multilabel-seg/data/metrics.json"])
+        with open("multilabel-seg/data/metrics.json", "r") as stream:
+            self.assertTrue(json.load(stream)['counters']['computed_outputs_reused'] > 0)
+
+        for config in configs:
+            separate_output_path = config["output-path"].replace("fan-out", "separate")
+            program.main(args + program.config_to_args({**config, "output-path": separate_output_path}, program.setup_argument_parser()))
+            self.assertTrue(are_dir_trees_equal(config["output-path"], separate_output_path))
+
+    def test_configs_fan_out_recomputes_outputs_of_failed_records(self):
+        # Frames converted for the first configuration are copied into the second one, a frame that failed in the first
+        # configuration is converted again from its source
+        args = ["--ers-path", "ers", "--train-size", "1", "--img-mode", "L", "--copy-strategy", "duplicate", "-f"]
+        configs = [
+            {"training-type": "multilabel-seg", "ers-class-mapper-path": "multilabel-seg/2-class.yaml", "output-path": "multilabel-seg/data/fan-out/seg"},
+            {"training-type": "binary-seg", "ers-class-mapper-path": "binary-seg/2-class.yaml", "output-path": "multilabel-seg/data/fan-out/binary"}
+        ]
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        os.makedirs("multilabel-seg/data")
+        with open("multilabel-seg/data/configs.yaml", "w") as stream:
+            yaml.safe_dump(configs, stream)
+        execute_operation = PlannedOutputRecordGenerator.execute_operation
+
+        def fail_in_first_config(generator, operation):
+            if operation.dest.startswith(configs[0]["output-path"]) and operation.dest.endswith("images/0001_samples_000001.png"):
+                raise OSError("Simulated write failure")
+            execute_operation(generator, operation)
+
+        with mock.patch.object(PlannedOutputRecordGenerator, "execute_operation", fail_in_first_config), self.assertRaises(RuntimeError):
+            program.main(args + ["--configs-path", "multilabel-seg/data/configs.yaml", "--metrics-out", "multilabel-seg/data/metrics.json"])
+        with open("multilabel-seg/data/metrics.json", "r") as stream:
+            # The frame and masks of the failed record that are equal in both configurations
+            self.assertGreater(json.load(stream)['counters']['computed_outputs_recomputed'], 0)
+
+        separate_output_path = configs[1]["output-path"].replace("fan-out", "separate")
+        program.main(args + program.config_to_args({**configs[1], "output-path": separate_output_path}, program.setup_argument_parser()))
+        self.assertTrue(os.path.isfile(os.path.join(configs[1]["output-path"], "train/ers/images/0001_samples_000001.png")))
+        self.assertTrue(are_dir_trees_equal(configs[1]["output-path"], separate_output_path))
+
+    def test_constant_masks_encoded_once(self):
+        # Masks of class normal are empty files, all of them are written black
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        frames_path = "multilabel-seg/data/ers/0001/samples/frames"
+        labels_path = "multilabel-seg/data/ers/0001/samples/labels"
+        os.makedirs(frames_path)
+        os.makedirs(labels_path)
+        for name in ["000001", "000002", "000003"]:
+            Image.new("RGB", (30, 20), "red").save(os.path.join(frames_path, f"{name}.png"))
+            Image.new("L", (30, 20), 255).save(os.path.join(labels_path, f"{name}_c01.png"))
+            open(os.path.join(labels_path, f"{name}_h01.png"), "w").close()
+        args = ["--ers-path", "multilabel-seg/data/ers", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg", "--train-size", "1",
+                "--metrics-out", "multilabel-seg/data/metrics.json", "-f"]
+
+        for copy_strategy in [CopyStrategy.DUPLICATE, CopyStrategy.SYMLINK, CopyStrategy.HARDLINK]:
+            with self.subTest(copy_strategy=copy_strategy):
+                output_path = f"multilabel-seg/data/{copy_strategy}"
+                stdout = io.StringIO()
+                with contextlib.redirect_stdout(stdout):
+                    program.main(args + ["--copy-strategy", str(copy_strategy), "--output-path", output_path])
+                with open("multilabel-seg/data/metrics.json") as file:
+                    self.assertEqual(json.load(file)["counters"]["image_encodes"], 1)
+                self.assertEqual("are hard links to them" in stdout.getvalue(), copy_strategy == CopyStrategy.SYMLINK)
+
+                masks_path = os.path.join(output_path, "train/ers/masks/normal")
+                mask_paths = [os.path.join(masks_path, name) for name in sorted(os.listdir(masks_path))]
+                self.assertEqual(len(mask_paths), 3)
+                self.assertFalse(any(os.path.islink(path) for path in mask_paths))
+                self.assertTrue(all(filecmp.cmp(mask_paths[0], path, shallow=False) for path in mask_paths))
+                inodes = {os.stat(path).st_ino for path in mask_paths}
+                self.assertEqual(len(inodes), 3 if copy_strategy == CopyStrategy.DUPLICATE else 1)
+
+    def test_configs_with_different_shared_options_rejected(self):
+        configs = [
+            {"training-type": "multilabel-seg", "ers-class-mapper-path": "multilabel-seg/2-class.yaml", "output-path": "multilabel-seg/data/fan-out/seg"},
+            {"training-type": "multilabel-seg", "ers-use-seq": True, "output-path": "multilabel-seg/data/fan-out/seq"}
+        ]
+        os.makedirs("multilabel-seg/data", exist_ok=True)
+        with open("multilabel-seg/data/configs.yaml", "w") as stream:
+            yaml.safe_dump(configs, stream)
+        with contextlib.redirect_stderr(io.StringIO()) as errors, self.assertRaises(SystemExit):
+            program.main(["--ers-path", "ers", "--train-size", "1", "-f", "--configs-path", "multilabel-seg/data/configs.yaml"])
+        self.assertIn("Option 'ers_use_seq' should be equal in all configurations", errors.getvalue())
+
+    def test_target_size_resizes_frames_and_masks(self):
+        program.main(
+            [
+                "--ers-path",
+                "ers",
+                "--ers-class-mapper-path",
+                "multilabel-seg/2-class.yaml",
+                "--ers-use-seq",
+                "--ers-use-empty-masks",
+                "--training-type",
+                "multilabel-seg",
+                "--train-size",
+                "1",
+                "--target-size",
+                "320x256",
+                "--crop",
+                "--resample",
+                "lanczos",
+                "--mask-mode",
+                "1",
+                "-f",
+                "--output-path",
+                "multilabel-seg/data"
+            ]
+        )
+        masks_count = 0
+        for directory, _, names in os.walk("multilabel-seg/data/train/ers"):
+            for name in names:
+                image = Image.open(os.path.join(directory, name))
+                self.assertEqual(image.size, (320, 256))
+                if os.path.basename(os.path.dirname(directory)) == "masks":
+                    masks_count += 1
+                    self.assertEqual(image.mode, "1")
+                    self.assertTrue(set(np.unique(np.asarray(image.convert("L"))).tolist()) <= {0, 255})
+        self.assertTrue(masks_count > 0)
+
+    def test_multilabel_classification_copy_strategies(self):
+        for copy_strategy in ["hardlink", "reflink", "auto"]:
+            with self.subTest(copy_strategy=copy_strategy):
+                program.main(
+                    [
+                        "--ers-path",
+                        "ers",
+                        "--ers-class-mapper-path",
+                        "multilabel-classification/4-class.yaml",
+                        "--ers-use-empty-masks",
+                        "--training-type",
+                        "multilabel-classification",
+                        "--train-size",
+                        "1",
+                        "--copy-strategy",
+                        copy_strategy,
+                        "-f",
+                        "--output-path",
+                        "multilabel-classification/data"
+                    ]
+                )
+                result = are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/expected_data")
+                self.assertTrue(result)
+
+    def test_hardlink_falls_back_to_duplicate_across_devices(self):
+        os.makedirs("multilabel-classification/data", exist_ok=True)
+        dest = "multilabel-classification/data/000001.png"
+        copy_strategy = CopyStrategy.HARDLINK.create()
+        with mock.patch("src.copy_strategy.os.link", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")) as link:
+            copy_strategy.copy("ers/0001/samples/frames/000001.png", dest)
+        link.assert_called_once()
+        self.assertFalse(os.path.islink(dest))
+        self.assertFalse(os.path.samefile("ers/0001/samples/frames/000001.png", dest))
+        self.assertTrue(filecmp.cmp("ers/0001/samples/frames/000001.png", dest, shallow=False))
+
+    def test_ers_class_mapping_matches_baseline(self):
+        # Masks of one class are merged, codes of different classes in one mask name drop the mask in segmentation,
+        # unmapped codes are ignored and frames without mapped masks are left out
+        mappers = {"binary-seg": "binary-seg/2-class.yaml", "multilabel-seg": "multilabel-seg/2-class.yaml", "multilabel-classification": "multilabel-classification/4-class.yaml"}
+        for training_type, mapper_path in mappers.items():
+            with self.subTest(training_type=training_type):
+                stdout = io.StringIO()
+                with contextlib.redirect_stdout(stdout):
+                    program.main(["--ers-path", "ers-mapping", "--ers-class-mapper-path", mapper_path, "--training-type", training_type, "--train-size", "1",
+                                  "--copy-strategy", "duplicate", "-f", "--output-path", f"{training_type}/data"])
+                self.assertEqual("Skipping mask at location ers-mapping/0001/samples/labels/000002_c01_h01.png" in stdout.getvalue(), training_type != "multilabel-classification")
+                result = are_dir_trees_equal(f"{training_type}/data", f"{training_type}/ers_mapping_expected_data")
+                self.assertTrue(result)
+
+    def test_hyperkvasir_segmentation_matches_baseline(self):
+        for training_type in ["binary-seg", "multilabel-seg"]:
+            with self.subTest(training_type=training_type):
+                program.main(["--hyperkvasir-path", "hyperkvasir", "--training-type", training_type, "--train-size", "1", "--copy-strategy", "duplicate", "-f", "--output-path", f"{training_type}/data"])
+                result = are_dir_trees_equal(f"{training_type}/data", f"{training_type}/hyperkvasir_expected_data")
+                self.assertTrue(result)
+
+    def test_hyperkvasir_segmentation_without_index_matches_baseline(self):
+        # Segmented images are listed from directories when bounding-boxes.json is missing
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        shutil.copytree("hyperkvasir", "multilabel-seg/data/hyperkvasir")
+        os.remove("multilabel-seg/data/hyperkvasir/segmented-images/bounding-boxes.json")
+        program.main(["--hyperkvasir-path", "multilabel-seg/data/hyperkvasir", "--training-type", "multilabel-seg", "--train-size", "1", "--copy-strategy", "duplicate", "--output-path", "multilabel-seg/data/output"])
+        result = are_dir_trees_equal("multilabel-seg/data/output", "multilabel-seg/hyperkvasir_expected_data")
+        self.assertTrue(result)
+
+    def test_hyperkvasir_classification_adds_labeled_images(self):
+        program.main(["--hyperkvasir-path", "hyperkvasir", "--training-type", "multilabel-classification", "--train-size", "1", "--copy-strategy", "duplicate", "-f", "--output-path", "multilabel-classification/data"])
+        # Segmented images are classified as before, labeled images are added in directories of their findings
+        labeled_images = {"polyps": "aa000001.jpg", "cecum": "aa000002.jpg", "z-line": "aa000003.jpg"}
+        result = are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/hyperkvasir_expected_data", ignore=list(labeled_images))
+        self.assertTrue(result)
+        for finding, file_name in labeled_images.items():
+            self.assertTrue(os.path.isfile(os.path.join("multilabel-classification/data/train/hyperkvasir", finding, file_name)))
+        self.assertFalse(os.path.exists("multilabel-classification/data/train/hyperkvasir/esophagitis-a"))
+
+    def test_multilabel_classification_incremental_resume_after_interrupt(self):
+        args = [
+            "--ers-path",
+            "ers",
+            "--ers-class-mapper-path",
+            "multilabel-classification/4-class.yaml",
+            "--ers-use-empty-masks",
+            "--training-type",
+            "multilabel-classification",
+            "--train-size",
+            "1",
+            "--incremental",
+            "--output-path",
+            "multilabel-classification/data"
+        ]
+        execute_operation = PlannedOutputRecordGenerator.execute_operation
+        # Records have 3, 1, 1, 1 and 2 operations, completed one by one in chunks of a single operation. Interrupted in
+        # the first record, one of its files is left but not journaled. Interrupted in the third record, the first two
+        # are journaled.
+        for (interrupted_operation, journaled_count) in [(2, 0), (5, 2)]:
+            with self.subTest(interrupted_operation=interrupted_operation):
+                executed_count = 0
+
+                def execute_until_interrupted(output_record_generator, operation):
+                    nonlocal executed_count
+                    executed_count += 1
+                    if executed_count == interrupted_operation:
+                        raise KeyboardInterrupt
+                    execute_operation(output_record_generator, operation)
+
+                with mock.patch.object(PlannedOutputRecordGenerator, "execute_operation", execute_until_interrupted), \
+                        mock.patch("src.dataset_creator.ITEMS_PER_CHUNK", 1), self.assertRaises(KeyboardInterrupt):
+                    program.main(args + ["-f"])
+                self.assertFalse(os.path.exists(os.path.join("multilabel-classification/data", MANIFEST_FILE_NAME)))
+
+                self.assertEqual(run_and_count_skipped(args), journaled_count)
+                result = are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/expected_data", ignore=[MANIFEST_FILE_NAME])
+                self.assertTrue(result)
+
+    def test_merged_gray_masks_are_composited(self):
+        # Gray masks c01 and c02 of class disease overlap in the middle third of the frame
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        frames_path = "multilabel-seg/data/ers/0001/samples/frames"
+        labels_path = "multilabel-seg/data/ers/0001/samples/labels"
+        os.makedirs(frames_path)
+        os.makedirs(labels_path)
+        Image.new("RGB", (30, 20), "red").save(os.path.join(frames_path, "000001.png"))
+        for (code, box) in [("c01", (0, 0, 20, 20)), ("c02", (10, 0, 30, 20))]:
+            mask = Image.new("L", (30, 20), 0)
+            mask.paste(100, box)
+            mask.save(os.path.join(labels_path, f"000001_{code}.png"))
+        program.main(["--ers-path", "multilabel-seg/data/ers", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg", "--train-size", "1", "--output-path", "multilabel-seg/data/output"])
+        merged_mask = np.asarray(Image.open("multilabel-seg/data/output/train/ers/masks/disease/0001_samples_000001.png").convert("L"))
+        self.assertTrue(np.all(merged_mask[:, :10] == 100))
+        self.assertTrue(np.all(merged_mask[:, 10:20] == 161))
+        self.assertTrue(np.all(merged_mask[:, 20:] == 100))
+
+    def test_png_encoder_options(self):
+        args = ["--ers-path", "ers", "--ers-class-mapper-path", "binary-seg/2-class.yaml", "--training-type", "binary-seg", "--train-size", "1", "--img-mode", "L", "--mask-mode", "1"]
+        sizes = {}
+        for level in [0, 9]:
+            output_path = f"binary-seg/data/level-{level}"
+            shutil.rmtree(output_path, ignore_errors=True)
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                program.main(args + ["--png-compress-level", str(level), "--output-path", output_path])
+            self.assertNotIn("1 bit per pixel only as PNG", stdout.getvalue())
+            frame_path = os.path.join(output_path, "train/ers/images/0001_samples_000001.png")
+            self.assertEqual(png_zlib_level(frame_path), 0 if level == 0 else 3)
+            sizes[level] = os.path.getsize(frame_path)
+            masks_path = os.path.join(output_path, "train/ers/masks")
+            for name in os.listdir(masks_path):
+                with Image.open(os.path.join(masks_path, name)) as mask:
+                    self.assertEqual((mask.format, mask.mode), ("PNG", "1"))
+        self.assertGreater(sizes[0], sizes[9])
+
+    def test_scan_cache_invalidated_by_changed_dirs(self):
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        shutil.copytree("ers/0001/samples", "multilabel-seg/data/ers/0001/seq1")
+        shutil.copytree("ers/0001/samples", "multilabel-seg/data/ers/0001/seq2")
+        labels_path = "multilabel-seg/data/ers/0001/seq1/labels"
+        old_mtime = os.stat("ers").st_mtime - 3600
+        set_dirs_mtime("multilabel-seg/data/ers", old_mtime)
+        args = ["--ers-path", "multilabel-seg/data/ers", "--ers-use-seq", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg",
+                "--train-size", "1", "--copy-strategy", "duplicate", "-f"]
+
+        # Every run with the cache is compared with a run that scans all directories
+        def run_with_cache():
+            shutil.rmtree("multilabel-seg/data/uncached", ignore_errors=True)
+            program.main(args + ["--output-path", "multilabel-seg/data/uncached"])
+            program.main(args + ["--output-path", "multilabel-seg/data/cached", "--scan-cache-path", "multilabel-seg/data/scan.sqlite", "--metrics-out", "multilabel-seg/data/metrics.json"])
+            self.assertTrue(are_dir_trees_equal("multilabel-seg/data/cached", "multilabel-seg/data/uncached"))
+            with open("multilabel-seg/data/metrics.json") as file:
+                counters = json.load(file)["counters"]
+            return counters.get("scan_cache_hits", 0), counters.get("scan_cache_misses", 0)
+
+        self.assertEqual(run_with_cache(), (0, 2))
+        self.assertEqual(run_with_cache(), (2, 0))
+
+        with self.subTest("changed mtime"):
+            os.utime(labels_path, (old_mtime + 60, old_mtime + 60))
+            self.assertEqual(run_with_cache(), (1, 1))
+
+        with self.subTest("changed number of entries"):
+            labels_mtime = os.stat(labels_path).st_mtime_ns
+            os.remove(os.path.join(labels_path, "000005_c01_c02_h01.png"))
+            os.utime(labels_path, ns=(labels_mtime, labels_mtime))
+            self.assertEqual(run_with_cache(), (1, 1))
+
+        with self.subTest("added sequence"):
+            shutil.copytree("ers/0001/samples", "multilabel-seg/data/ers/0001/seq3")
+            set_dirs_mtime("multilabel-seg/data/ers/0001/seq3", old_mtime)
+            self.assertEqual(run_with_cache(), (2, 1))
+
+        with self.subTest("removed sequence"):
+            shutil.rmtree("multilabel-seg/data/ers/0001/seq2")
+            self.assertEqual(run_with_cache(), (2, 0))
+
+    def test_dry_run_plan_matches_executed_operations(self):
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        os.makedirs("multilabel-seg/data")
+        args = ["--ers-path", "ers", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg", "--train-size", "1",
+                "--copy-strategy", "duplicate", "--output-path", "multilabel-seg/data/output"]
+
+        def read_plan(path):
+            with open(path) as file:
+                return [json.loads(line) for line in file]
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            program.main(args + ["--dry-run", "--plan-out", "multilabel-seg/data/dry-run-plan.jsonl"])
+        self.assertFalse(os.path.exists("multilabel-seg/data/output"))
+        planned_counts = {}
+        for (kind, count) in re.findall(r"^ +(\w+): +(\d+) operations", stdout.getvalue(), re.MULTILINE):
+            planned_counts[kind] = planned_counts.get(kind, 0) + int(count)
+        dry_run_plan = read_plan("multilabel-seg/data/dry-run-plan.jsonl")
+        self.assertGreater(len(dry_run_plan), 0)
+        self.assertEqual(len(dry_run_plan), sum(planned_counts.values()))
+
+        program.main(args + ["--plan-out", "multilabel-seg/data/plan.jsonl", "--metrics-out", "multilabel-seg/data/metrics.json"])
+        self.assertEqual(read_plan("multilabel-seg/data/plan.jsonl"), dry_run_plan)
+        with open("multilabel-seg/data/metrics.json") as file:
+            counters = json.load(file)["counters"]
+        executed_counts = {kind: counters.get(f"operations_{kind}", 0) for kind in planned_counts}
+        self.assertEqual(executed_counts, planned_counts)
+        self.assertEqual(sum(count for (name, count) in counters.items() if name.startswith("operations_")), len(dry_run_plan))
+        for entry in dry_run_plan:
+            self.assertTrue(os.path.isfile(entry["dest"]), entry["dest"])
+
+    def test_image_headers_read_once(self):
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        os.makedirs("multilabel-seg/data")
+        args = ["--ers-path", "ers", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg", "--train-size", "1",
+                "--img-mode", "L", "--metrics-out", "multilabel-seg/data/metrics.json", "-f"]
+
+        def count_header_reads(run_args):
+            program.main(args + run_args)
+            with open("multilabel-seg/data/metrics.json") as file:
+                return json.load(file)["counters"].get("image_header_reads", 0)
+
+        with self.subTest("second run with index file"):
+            index_args = ["--metadata-index-path", "multilabel-seg/data/metadata.sqlite", "--output-path", "multilabel-seg/data/indexed"]
+            self.assertGreater(count_header_reads(index_args), 0)
+            self.assertEqual(count_header_reads(index_args), 0)
+            self.assertEqual(count_header_reads(index_args + ["--output-format", "shards", "--workers", "2"]), 0)
+
+        with self.subTest("workers without index file"):
+            # Shard workers read headers of images, they share entries of the main process and of each other
+            shards_args = ["--output-format", "shards", "--output-path", "multilabel-seg/data/shards"]
+            single_process_reads = count_header_reads(shards_args)
+            self.assertGreater(single_process_reads, 0)
+            self.assertEqual(count_header_reads(shards_args + ["--workers", "2"]), single_process_reads)
+
+    def test_ers_masks_matched_to_frames_with_common_prefix(self):
+        # Frame names contain '_' and one is a prefix of the other, masks are matched to whole frame names only
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        frames_path = "multilabel-seg/data/ers/0001/samples/frames"
+        labels_path = "multilabel-seg/data/ers/0001/samples/labels"
+        os.makedirs(frames_path)
+        os.makedirs(labels_path)
+        for (name, box) in [("a_1", (0, 0, 10, 20)), ("a_10", (10, 0, 20, 20))]:
+            Image.new("RGB", (30, 20), "red").save(os.path.join(frames_path, f"{name}.png"))
+            mask = Image.new("L", (30, 20), 0)
+            mask.paste(255, box)
+            mask.save(os.path.join(labels_path, f"{name}_c01.png"))
+        Image.new("L", (30, 20), 255).save(os.path.join(labels_path, "a_10_h01.png"))
+        program.main(["--ers-path", "multilabel-seg/data/ers", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg", "--train-size", "1",
+                      "--copy-strategy", "duplicate", "--output-path", "multilabel-seg/data/output"])
+
+        masks_path = "multilabel-seg/data/output/train/ers/masks"
+        self.assertEqual(sorted(os.listdir(os.path.join(masks_path, "disease"))), ["0001_samples_a_1.png", "0001_samples_a_10.png"])
+        self.assertEqual(os.listdir(os.path.join(masks_path, "normal")), ["0001_samples_a_10.png"])
+        for name in ["a_1", "a_10"]:
+            self.assertTrue(filecmp.cmp(os.path.join(masks_path, "disease", f"0001_samples_{name}.png"), os.path.join(labels_path, f"{name}_c01.png"), shallow=False))
+
+    def test_records_streamed_in_small_batches_match_expected_output(self):
+        # Every record is spilled to the record store and read back on its own, output does not depend on batching
+        with mock.patch("src.record_store.PENDING_RECORDS_LIMIT", 1), mock.patch("src.record_store.FETCH_BATCH_SIZE", 1), \
+                mock.patch("src.ers_preparator.SCAN_BATCH_SIZE", 1), mock.patch("src.dataset_creator.ITEMS_PER_CHUNK", 1):
+            with self.subTest(training_type="multilabel-classification"):
+                program.main(["--ers-path", "ers", "--ers-class-mapper-path", "multilabel-classification/4-class.yaml", "--ers-use-empty-masks", "--training-type", "multilabel-classification",
+                              "--train-size", "1", "-f", "--output-path", "multilabel-classification/data"])
+                self.assertTrue(are_dir_trees_equal("multilabel-classification/data", "multilabel-classification/expected_data"))
+            with self.subTest(training_type="multilabel-seg"):
+                program.main(["--ers-path", "ers-mapping", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg",
+                              "--train-size", "1", "--copy-strategy", "duplicate", "-f", "--output-path", "multilabel-seg/data"])
+                self.assertTrue(are_dir_trees_equal("multilabel-seg/data", "multilabel-seg/ers_mapping_expected_data"))
+
+    def test_concurrent_ers_scan_is_deterministic(self):
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        for patient in ["0002", "0001"]:
+            for sequence in ["seq_b", "seq_a"]:
+                shutil.copytree("ers/0001/samples", f"multilabel-seg/data/ers/{patient}/{sequence}")
+            os.makedirs(f"multilabel-seg/data/ers/{patient}/seq_a/frames/thumbnails")
+            open(f"multilabel-seg/data/ers/{patient}/notes.txt", "w").close()
+        open("multilabel-seg/data/ers/notes.txt", "w").close()
+        args = ["--ers-path", "multilabel-seg/data/ers", "--ers-use-seq", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg",
+                "--train-size", "0.5", "--validation-size", "0.5", "--copy-strategy", "duplicate", "-f"]
+
+        # Files next to patient and sequence directories and directories next to frames are not listed
+        with mock.patch("src.ers_preparator.SCAN_THREADS", 1):
+            program.main(args + ["--output-path", "multilabel-seg/data/sequential", "--plan-out", "multilabel-seg/data/sequential.jsonl"])
+        with mock.patch("src.ers_preparator.SCAN_THREADS", 4), mock.patch("os.scandir", scandir_with_delays(os.scandir)):
+            program.main(args + ["--output-path", "multilabel-seg/data/concurrent", "--plan-out", "multilabel-seg/data/concurrent.jsonl"])
+        with open("multilabel-seg/data/sequential.jsonl") as sequential_plan, open("multilabel-seg/data/concurrent.jsonl") as concurrent_plan:
+            self.assertEqual(sequential_plan.read().replace("data/sequential/", "data/concurrent/"), concurrent_plan.read())
+        self.assertTrue(are_dir_trees_equal("multilabel-seg/data/sequential", "multilabel-seg/data/concurrent"))
+        frame_names = [name for directory in ["train", "validation"] for name in os.listdir(os.path.join("multilabel-seg/data/concurrent", directory, "ers/images"))]
+        self.assertEqual(len(frame_names), 4 * 3)
+
+    def test_metrics_report_matches_written_output(self):
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        os.makedirs("multilabel-seg/data")
+        program.main(["--ers-path", "ers", "--ers-class-mapper-path", "multilabel-seg/2-class.yaml", "--training-type", "multilabel-seg", "--train-size", "1", "--img-mode", "L",
+                      "--copy-strategy", "duplicate", "--output-path", "multilabel-seg/data/output", "--metrics-out", "multilabel-seg/data/metrics.json", "--profile"])
+        with open("multilabel-seg/data/metrics.json") as file:
+            report = json.load(file)
+
+        for phase in ["scan", "map_merge", "split", "prepare_output", "write_train", "write_validation", "write_test", "plan", "execute", "total"]:
+            self.assertIn(phase, report["phases_s"])
+        self.assertLessEqual(report["phases_s"]["scan"], report["phases_s"]["total"])
+        counters = report["counters"]
+        frames_count = len(os.listdir("multilabel-seg/data/output/train/ers/images"))
+        self.assertEqual(counters["records_written"], frames_count)
+        self.assertEqual(report["record_latency"]["count"], frames_count)
+        self.assertEqual(sum(bucket["count"] for bucket in report["record_latency"]["histogram_ms"]), frames_count)
+        self.assertGreater(report["records_per_s"], 0)
+
+        # Frames are converted, masks are copied in full or encoded, every written byte is counted once
+        output_files = [os.path.join(directory, name) for directory, _, names in os.walk("multilabel-seg/data/output") for name in names]
+        self.assertEqual(counters["bytes_written"], sum(os.path.getsize(path) for path in output_files))
+        self.assertEqual(counters["image_encodes"] + counters.get("files_duplicated", 0), len(output_files))
+        self.assertGreater(report["memory"]["peak_rss_bytes"], 0)
+        self.assertGreater(report["memory"]["peak_traced_bytes"], 0)
+
+    def test_sources_decoded_once_per_record(self):
+        # Mask c01 belongs to both classes, class both merges it with mask c02; frames and masks are converted
+        shutil.rmtree("multilabel-seg/data", ignore_errors=True)
+        frames_path = "multilabel-seg/data/ers/0001/samples/frames"
+        labels_path = "multilabel-seg/data/ers/0001/samples/labels"
+        os.makedirs(frames_path)
+        os.makedirs(labels_path)
+        for name in ["000001", "000002"]:
+            Image.new("RGB", (30, 20), "red").save(os.path.join(frames_path, f"{name}.png"))
+            for (code, box) in [("c01", (0, 0, 20, 20)), ("c02", (10, 0, 30, 20))]:
+                mask = Image.new("L", (30, 20), 0)
+                mask.paste(255, box)
+                mask.save(os.path.join(labels_path, f"{name}_{code}.png"))
+        with open("multilabel-seg/data/mapper.yaml", "w") as stream:
+            yaml.safe_dump({"first": {"classes": ["c01"]}, "both": {"classes": ["c01", "c02"]}}, stream)
+        program.main(["--ers-path", "multilabel-seg/data/ers", "--ers-class-mapper-path", "multilabel-seg/data/mapper.yaml", "--training-type", "multilabel-seg", "--train-size", "1",
+                      "--img-mode", "L", "--mask-mode", "1", "--output-path", "multilabel-seg/data/output", "--metrics-out", "multilabel-seg/data/metrics.json"])
+        with open("multilabel-seg/data/metrics.json") as file:
+            counters = json.load(file)["counters"]
+        # Frame, c01 and c02 of each of 2 records
+        self.assertEqual(counters["image_decodes"], 2 * 3)
+        self.assertGreater(counters["image_decodes_reused"], 0)
+        for name in ["000001", "000002"]:
+            with Image.open(f"multilabel-seg/data/output/train/ers/masks/both/0001_samples_{name}.png") as mask:
+                self.assertTrue(np.all(np.asarray(mask)))